@@ -0,0 +1,88 @@
+"""
+Microbenchmark of broadcast forwarding: receivers/sec of encoding and sealing a chat packet for every receiver,
+comparing encoding per receiver with a SharedPacket, and forwarding a received packet with a SharedPacket,
+where the payload is not decoded again if the routing envelope is enabled
+
+Usage: python benchmarks/broadcast_benchmark.py
+"""
+import os
+import sys
+import time
+from typing import Callable, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatbridge.core.network.cryptor import AESCryptor
+from chatbridge.core.network.protocol import ChatBridgePacket, PacketType, LoginPacket, LoginResultPacket
+from chatbridge.core.network.session import NetworkSession, SharedPacket
+
+DURATION = 1.0  # second
+RECEIVER_COUNT = 30
+MESSAGE_SIZES = (32, 1024)
+
+
+def measure(func: Callable[[], None]) -> float:
+	count = 0
+	start = time.perf_counter()
+	while True:
+		func()
+		count += 1
+		elapsed = time.perf_counter() - start
+		if elapsed >= DURATION:
+			return count * RECEIVER_COUNT / elapsed
+
+
+def create_session_pair(cryptor: AESCryptor, features: List[str]) -> Tuple[NetworkSession, NetworkSession]:
+	client, server = NetworkSession(cryptor, max_message_size=1 << 24), NetworkSession(cryptor, max_message_size=1 << 24)
+	login_packet = client.create_login_packet('name', 'password')
+	login_packet.features = [feature for feature in login_packet.features if feature in features]
+	result = server.accept_login(LoginPacket.deserialize(login_packet.serialize()))
+	client.on_login_result(login_packet, LoginResultPacket.deserialize(result.serialize()))
+	server.on_login_result_sent()
+	return client, server
+
+
+def create_sessions(cryptor: AESCryptor, features: List[str]) -> List[NetworkSession]:
+	return [create_session_pair(cryptor, features)[1] for _ in range(RECEIVER_COUNT)]
+
+
+def main():
+	cryptor = AESCryptor('ThisIstheSecret')
+	setups = (
+		('legacy', []),
+		('binary_frame', ['chatbridge.binary_frame']),
+		('session_cipher', ['chatbridge.binary_frame', 'chatbridge.session_cipher']),
+		('msgpack', ['chatbridge.binary_frame', 'chatbridge.codec.msgpack']),
+		('envelope', ['chatbridge.binary_frame', 'chatbridge.routing_envelope']),
+		('msgpack+envelope', ['chatbridge.binary_frame', 'chatbridge.codec.msgpack', 'chatbridge.routing_envelope']),
+	)
+	print('{:>16} {:>8} {:>16} {:>16} {:>16}'.format('features', 'size', 'per receiver', 'shared', 'forwarded'))
+	for name, features in setups:
+		sessions = create_sessions(cryptor, features)
+		# the session cipher rejects replayed frames, so the sender link doesn't use it
+		sender, sender_server = create_session_pair(cryptor, [feature for feature in features if feature != 'chatbridge.session_cipher'])
+		for size in MESSAGE_SIZES:
+			packet = ChatBridgePacket(sender='survival', receivers=[], broadcast=True, type=PacketType.chat, payload={'author': 'Steve', 'message': 'x' * size})
+
+			def per_receiver():
+				for session in sessions:
+					session.encode_packet(packet)
+
+			def shared():
+				shared_packet = SharedPacket(packet)
+				for session in sessions:
+					session.encode_packet(shared_packet)
+
+			frame = sender.encode_packet(packet)
+
+			def forwarded():
+				shared_packet = SharedPacket(sender_server.decode_chatbridge_packet(frame))
+				for session in sessions:
+					session.encode_packet(shared_packet)
+
+			results = (measure(per_receiver), measure(shared), measure(forwarded))
+			print('{:>16} {:>8} {}'.format(name, size, ' '.join('{:>12.0f} r/s'.format(r) for r in results)))
+
+
+if __name__ == '__main__':
+	main()
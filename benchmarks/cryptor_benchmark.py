@@ -0,0 +1,53 @@
+"""
+Microbenchmark of the frame ciphers: packets/sec of an encrypt + decrypt round trip
+
+The session cipher is the only authenticated one, and hashes each frame with BLAKE2b on both sides,
+so it falls behind the binary AES-CBC frames once packets are tens of KiB
+
+Usage: python benchmarks/cryptor_benchmark.py
+"""
+import os
+import sys
+import time
+from typing import Callable
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatbridge.core.network.cryptor import AESCryptor
+
+DURATION = 1.0  # second
+PACKET_SIZES = (64, 512, 4096, 32768)
+
+
+def measure(func: Callable[[], None]) -> float:
+	count = 0
+	start = time.perf_counter()
+	while True:
+		for _ in range(100):
+			func()
+		count += 100
+		elapsed = time.perf_counter() - start
+		if elapsed >= DURATION:
+			return count / elapsed
+
+
+def main():
+	cryptor = AESCryptor('ThisIstheSecret')
+	client_nonce, server_nonce = os.urandom(16), os.urandom(16)
+	client = cryptor.create_session_cipher(client_nonce, server_nonce, is_client=True)
+	server = cryptor.create_session_cipher(client_nonce, server_nonce, is_client=False)
+
+	print('{:>8} {:>16} {:>16} {:>16}'.format('size', 'AES-CBC hex', 'AES-CBC binary', 'session cipher'))
+	for size in PACKET_SIZES:
+		text = ('{"message": "' + 'x' * size)[:size]
+		data = text.encode('utf8')
+		results = (
+			measure(lambda: cryptor.decrypt(cryptor.encrypt(text))),
+			measure(lambda: cryptor.decrypt_bytes(cryptor.encrypt_bytes(data)).decode('utf8')),
+			measure(lambda: server.decrypt(client.encrypt(data)).decode('utf8')),
+		)
+		print('{:>8} {}'.format(size, ' '.join('{:>12.0f} p/s'.format(r) for r in results)))
+
+
+if __name__ == '__main__':
+	main()
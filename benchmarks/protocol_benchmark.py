@@ -0,0 +1,82 @@
+"""
+Microbenchmark of the packet classes: packets/sec of serialize and deserialize,
+comparing the slot-based packet classes with the reflective mcdreforged Serializable ones
+
+Usage: python benchmarks/protocol_benchmark.py
+"""
+import os
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatbridge.common.serializer import NoMissingFieldSerializable
+from chatbridge.core.network.protocol import ChatBridgePacket, ChatPayload, CommandPayload, PacketType
+
+DURATION = 1.0  # second
+
+
+class LegacyChatBridgePacket(NoMissingFieldSerializable):
+	sender: str
+	receivers: List[str]
+	broadcast: bool
+	type: str
+	payload: dict
+
+
+class LegacyChatPayload(NoMissingFieldSerializable):
+	author: str
+	message: str
+
+
+class LegacyCommandPayload(NoMissingFieldSerializable):
+	cid: str
+	command: str
+	responded: bool
+	params: dict = {}
+	result: dict
+
+
+def measure(func: Callable[[], None]) -> float:
+	count = 0
+	start = time.perf_counter()
+	while True:
+		for _ in range(100):
+			func()
+		count += 100
+		elapsed = time.perf_counter() - start
+		if elapsed >= DURATION:
+			return count / elapsed
+
+
+def main():
+	cases = [
+		('chat', ChatPayload, LegacyChatPayload, {'author': 'Steve', 'message': 'Hello world'}),
+		('command', CommandPayload, LegacyCommandPayload, {'cid': 'a' * 32, 'command': '!!stats rank', 'responded': True, 'params': {'type': 'used'}, 'result': {'success': True}}),
+	]
+	print('{:>10} {:>12} {:>16} {:>16}'.format('payload', 'operation', 'Serializable', 'SlotSerializable'))
+	for name, payload_class, legacy_payload_class, payload in cases:
+		packet = {'sender': 'survival', 'receivers': [], 'broadcast': True, 'type': PacketType.chat, 'payload': payload}
+		decode_results = (
+			measure(lambda: legacy_payload_class.deserialize(LegacyChatBridgePacket.deserialize(packet).payload)),
+			measure(lambda: payload_class.deserialize(ChatBridgePacket.deserialize(packet).payload)),
+		)
+		legacy_packet, legacy_payload = LegacyChatBridgePacket.deserialize(packet), legacy_payload_class.deserialize(payload)
+		slot_packet, slot_payload = ChatBridgePacket.deserialize(packet), payload_class.deserialize(payload)
+
+		def legacy_encode():
+			legacy_packet.payload = legacy_payload.serialize()
+			legacy_packet.serialize()
+
+		def slot_encode():
+			slot_packet.payload = slot_payload.serialize()
+			slot_packet.serialize()
+
+		encode_results = (measure(legacy_encode), measure(slot_encode))
+		for operation, results in (('decode', decode_results), ('encode', encode_results)):
+			print('{:>10} {:>12} {}'.format(name, operation, ' '.join('{:>12.0f} p/s'.format(r) for r in results)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,94 @@
+"""
+Benchmark of shutdown and restart latency: milliseconds until ChatBridgeClient.restart returns with the client online again,
+until ChatBridgeClient.stop returns, and until ChatBridgeServer.stop returns with clients connected, for each server engine
+
+Usage: python benchmarks/restart_benchmark.py
+"""
+import logging
+import os
+import socket
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from chatbridge.core.client import ChatBridgeClient
+from chatbridge.core.config import ClientInfo
+from chatbridge.core.network.basic import Address
+from chatbridge.core.server import ChatBridgeServer, ServerEngine
+
+ROUNDS = 10
+CLIENT_COUNT = 5
+KEY = 'ThisIstheSecret'
+
+
+class _Server(ChatBridgeServer):
+	def get_logging_file_name(self):
+		return None
+
+
+class _Client(ChatBridgeClient):
+	def get_logging_file_name(self):
+		return None
+
+
+def free_address() -> Address:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return Address('127.0.0.1', sock.getsockname()[1])
+
+
+def wait_until(condition: Callable[[], bool]):
+	while not condition():
+		time.sleep(0.001)
+
+
+def start_server(engine: str) -> _Server:
+	server = _Server(KEY, free_address(), engine=engine)
+	for i in range(CLIENT_COUNT):
+		server.add_client(ClientInfo(name='client{}'.format(i), password='pw'))
+	server.start()
+	return server
+
+
+def connect_clients(server: _Server) -> List[_Client]:
+	clients = []
+	for i in range(CLIENT_COUNT):
+		client = _Client(KEY, ClientInfo(name='client{}'.format(i), password='pw'), server_address=server.server_address)
+		client.start()
+		wait_until(server.clients[client.get_name()].is_online)
+		clients.append(client)
+	return clients
+
+
+def timed(func: Callable[[], None]) -> float:
+	start = time.perf_counter()
+	func()
+	return (time.perf_counter() - start) * 1000
+
+
+def main():
+	logging.disable(logging.WARNING)  # connections closing are expected
+	print('{:>8} {:>16} {:>12} {:>12}'.format('engine', 'operation', 'mean', 'max'))
+	for engine in ServerEngine.ALL:
+		results = {'client restart': [], 'client stop': [], 'server stop': []}
+		for _ in range(ROUNDS):
+			server = start_server(engine)
+			clients = connect_clients(server)
+
+			def restart():
+				clients[0].restart()
+				wait_until(server.clients[clients[0].get_name()].is_online)
+
+			results['client restart'].append(timed(restart))
+			results['client stop'].append(timed(clients[0].stop))
+			results['server stop'].append(timed(server.stop))
+			for client in clients[1:]:
+				client.stop()
+		for operation, latencies in results.items():
+			print('{:>8} {:>16} {:>9.1f} ms {:>9.1f} ms'.format(engine, operation, sum(latencies) / len(latencies), max(latencies)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,124 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Thread, Lock
+from typing import Callable, List, Optional, Tuple
+
+from chatbridge.common.logger import ChatBridgeLogger
+
+
+class TimerHandle:
+	"""
+	A callback scheduled in a :class:`TimerScheduler`
+	"""
+	__slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+	def __init__(self, deadline: float, callback: Callable, args: tuple):
+		self.deadline = deadline
+		self.callback = callback
+		self.args = args
+		self.cancelled = False
+
+	def cancel(self):
+		"""
+		Cancel the callback if it's not called yet. It's fine to cancel a handle more than once
+		"""
+		self.cancelled = True
+		self.callback = self.args = None  # release references right away, the entry is removed from the heap lazily
+
+
+class TimerScheduler:
+	"""
+	A heap of deadlines served by a single thread, so periodic jobs like keep-alive pings and login timeouts
+	don't need a sleeping thread each. The thread sleeps until the nearest deadline and doesn't wake up otherwise
+
+	Callbacks are called in the scheduler thread, so they should be short and non-blocking.
+	Hand blocking work over to another thread
+	"""
+	THREAD_NAME = 'ChatBridge-Timer'
+
+	def __init__(self):
+		self.logger = ChatBridgeLogger('Timer')
+		self.__heap: List[Tuple[float, int, TimerHandle]] = []
+		self.__counter = itertools.count()  # breaks ties between equal deadlines, handles are not comparable
+		self.__condition = Condition(Lock())
+		self.__thread: Optional[Thread] = None
+		self.__stopped = False
+
+	def call_later(self, delay: float, callback: Callable, *args) -> TimerHandle:
+		"""
+		Call callback(*args) in the scheduler thread after delay seconds
+		"""
+		handle = TimerHandle(time.monotonic() + max(delay, 0), callback, args)
+		with self.__condition:
+			if self.__stopped:
+				raise RuntimeError('Scheduler stopped')
+			heapq.heappush(self.__heap, (handle.deadline, next(self.__counter), handle))
+			if self.__thread is None:
+				self.__thread = Thread(name=self.THREAD_NAME, target=self.__run, daemon=True)
+				self.__thread.start()
+			elif self.__heap[0][2] is handle:  # new nearest deadline
+				self.__condition.notify()
+		return handle
+
+	def stop(self):
+		"""
+		Stop the thread. Pending callbacks are discarded
+		"""
+		with self.__condition:
+			self.__stopped = True
+			self.__heap.clear()
+			self.__condition.notify()
+			thread = self.__thread
+		if thread is not None:
+			thread.join()
+
+	def __len__(self) -> int:
+		with self.__condition:
+			return sum(1 for entry in self.__heap if not entry[2].cancelled)
+
+	def __pop_due(self) -> Optional[TimerHandle]:
+		"""
+		Wait until the nearest deadline, and pop it. None if the scheduler is stopped
+		"""
+		with self.__condition:
+			while not self.__stopped:
+				while self.__heap and self.__heap[0][2].cancelled:
+					heapq.heappop(self.__heap)
+				if not self.__heap:
+					self.__condition.wait()
+					continue
+				delay = self.__heap[0][0] - time.monotonic()
+				if delay <= 0:
+					return heapq.heappop(self.__heap)[2]
+				self.__condition.wait(delay)
+			return None
+
+	def __run(self):
+		while True:
+			handle = self.__pop_due()
+			if handle is None:
+				break
+			callback, args = handle.callback, handle.args
+			if handle.cancelled or callback is None:  # cancelled after being popped
+				continue
+			handle.cancel()  # mark it as done, so late cancels are no-ops
+			try:
+				callback(*args)
+			except Exception:
+				self.logger.exception('Error in timer callback {}'.format(callback))
+
+
+_scheduler: Optional[TimerScheduler] = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler() -> TimerScheduler:
+	"""
+	The scheduler shared by all clients and servers in the process
+	"""
+	global _scheduler
+	with _scheduler_lock:
+		if _scheduler is None:
+			_scheduler = TimerScheduler()
+		return _scheduler
@@ -1,17 +1,272 @@
-from typing import TypeVar, Type
+import copy
+import functools
+from abc import ABCMeta
+from typing import TypeVar, Type, Dict, Any, List, Tuple, get_type_hints
 
-from mcdreforged.api.utils.serializer import Serializable
+from mcdreforged.api.utils.serializer import Serializable, serialize, deserialize
 
 Self = TypeVar('Self', bound='NoMissingFieldSerializable')
+SlotSelf = TypeVar('SlotSelf', bound='SlotSerializable')
 
 
 class NoMissingFieldSerializable(Serializable):
+	"""
+	Fields without default value are required during deserialization.
+	Fields with default value are optional, so fields added later stay compatible with data from older versions
+	"""
 	@classmethod
 	def deserialize(cls: Type[Self], data: dict, **kwargs) -> Self:
 		kwargs.setdefault('error_at_missing', True)
+		if kwargs['error_at_missing'] and isinstance(data, dict):
+			defaults = cls._get_field_defaults()
+			if not defaults.keys() <= data.keys():
+				data = {**{key: serialize(value) for key, value in defaults.items() if key not in data}, **data}
 		# noinspection PyTypeChecker
 		return super().deserialize(data, **kwargs)
 
+	@classmethod
+	@functools.lru_cache()
+	def _get_field_defaults(cls) -> Dict[str, Any]:
+		return {
+			name: getattr(cls, name)
+			for name in get_type_hints(cls).keys()
+			if not name.startswith('_') and hasattr(cls, name)
+		}
+
 	@classmethod
 	def get_default(cls):
 		return cls.deserialize({}, error_at_missing=False)
+
+
+# ---------------------------
+#     Slot Serializable
+# ---------------------------
+
+_MISSING = object()
+_ELEMENT_CLASSES = (str, int, float, bool, type(None))
+_IMMUTABLE_CLASSES = (str, int, float, bool, type(None), tuple, frozenset)
+
+
+def _mismatch(cls: type, name: str, expected: Any, value: Any) -> TypeError:
+	return TypeError('Mismatched input type of field {} for class {}: expected class {} but found data with class {}'.format(name, cls, expected, type(value)))
+
+
+def _serialize_value(value: Any) -> Any:
+	"""
+	A faster mcdreforged serialize for json-like values. Containers are copied
+	"""
+	value_type = type(value)
+	if value_type in _ELEMENT_CLASSES:
+		return value
+	if value_type is dict:
+		return {_serialize_value(key): _serialize_value(item) for key, item in value.items()}
+	if value_type is list:
+		return [_serialize_value(item) for item in value]
+	if isinstance(value, SlotSerializable):
+		return value.serialize()
+	return serialize(value)
+
+
+def _serialize_partial(obj: 'SlotSerializable') -> dict:
+	result = {}
+	for name in obj._slot_fields:
+		value = getattr(obj, name, _MISSING)
+		if value is not _MISSING:
+			result[name] = _serialize_value(value)
+	return result
+
+
+class _FieldCompiler:
+	"""
+	Generates the source of the per-class __init__, serialize and deserialize of a :class:`SlotSerializable` class
+	"""
+	def __init__(self, fields: Dict[str, Any], defaults: Dict[str, Any]):
+		self.fields = fields
+		self.defaults = defaults
+		self.namespace: Dict[str, Any] = {
+			'_MISSING': _MISSING,
+			'_FIELDS': frozenset(fields.keys()),
+			'_mismatch': _mismatch,
+			'_copy': copy.copy,
+			'_serialize': serialize,
+			'_deserialize': deserialize,
+			'_serialize_partial': _serialize_partial,
+			'_serialize_value': _serialize_value,
+		}
+
+	def __ref(self, prefix: str, index: int, value: Any) -> str:
+		name = '_{}_{}'.format(prefix, index)
+		self.namespace[name] = value
+		return name
+
+	def __element_check(self, index: int, name: str, element_type: Any, var: str) -> List[str]:
+		"""
+		Type checking lines of the value in variable var, or None if the type has no fast path
+		"""
+		if element_type is float:
+			return [
+				'if type({v}) is not float:'.format(v=var),
+				'	if not isinstance({v}, int): raise _mismatch(cls, {n!r}, {e!r}, {v})'.format(v=var, n=name, e='float or int'),
+				'	{v} = float({v})'.format(v=var),
+			]
+		if element_type in _ELEMENT_CLASSES or element_type in (list, dict):
+			type_ref = self.__ref('type', index, element_type)
+			return ['if type({v}) is not {t}: raise _mismatch(cls, {n!r}, {t}, {v})'.format(v=var, t=type_ref, n=name)]
+		return None
+
+	def __compile_field(self, index: int, name: str, annotation: Any) -> Tuple[List[str], str]:
+		"""
+		:return: The lines converting local variable v into the field value, and the expression serializing the field
+		"""
+		getter = 'self.{}'.format(name)
+		lines = self.__element_check(index, name, annotation, 'v')
+		if lines is not None:
+			if annotation in (list, dict):  # the content is unknown, copy it like mcdreforged does
+				return lines, '_serialize_value({})'.format(getter)
+			return lines, getter
+		if getattr(annotation, '__origin__', None) is list and len(getattr(annotation, '__args__', ())) == 1:
+			element_type = annotation.__args__[0]
+			element_lines = self.__element_check(index, name, element_type, 'e')
+			if element_lines is not None and element_type is not float:
+				return [
+					'if type(v) is not list: raise _mismatch(cls, {n!r}, list, v)'.format(n=name),
+					'v = list(v)',
+					'for e in v:',
+					*['	' + line for line in element_lines],
+				], 'list({})'.format(getter)
+		if isinstance(annotation, _SlotSerializableMeta):
+			type_ref = self.__ref('type', index, annotation)
+			return ['v = {}.deserialize(v, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)'.format(type_ref)], '{}.serialize()'.format(getter)
+		# no fast path, let mcdreforged handle it
+		type_ref = self.__ref('type', index, annotation)
+		return ['v = _deserialize(v, {}, error_at_missing=error_at_missing, error_at_redundancy=error_at_redundancy)'.format(type_ref)], '_serialize({})'.format(getter)
+
+	def __default_expr(self, index: int, name: str) -> str:
+		default = self.defaults[name]
+		ref = self.__ref('default', index, default)
+		if type(default) in _IMMUTABLE_CLASSES:
+			return ref
+		return '_copy({})'.format(ref)
+
+	def compile(self, class_name: str) -> Dict[str, Any]:
+		init_lines = [
+			'def __init__(self, **kwargs):',
+			'	if not _FIELDS.issuperset(kwargs):',
+			'		raise KeyError("Unknown key received in __init__ of class {}: {}".format(type(self), set(kwargs).difference(_FIELDS)))',
+		]
+		deserialize_lines = [
+			'def deserialize(cls, data, *, error_at_missing=True, error_at_redundancy=False, **kwargs):',
+			'	if not isinstance(data, dict):',
+			'		raise TypeError("Mismatched input type: expected class {} but found data with class {}".format(dict, type(data)))',
+			'	obj = cls.__new__(cls)',
+		]
+		serialize_items = []
+		for index, (name, annotation) in enumerate(self.fields.items()):
+			init_lines.append('	v = kwargs.get({!r}, _MISSING)'.format(name))
+			init_lines.append('	if v is not _MISSING: self.{} = v'.format(name))
+			if name in self.defaults:
+				init_lines.append('	else: self.{} = {}'.format(name, self.__default_expr(index, name)))
+
+			convert_lines, serialize_expr = self.__compile_field(index, name, annotation)
+			deserialize_lines.append('	v = data.get({!r}, _MISSING)'.format(name))
+			deserialize_lines.append('	if v is not _MISSING:')
+			deserialize_lines.extend('		' + line for line in convert_lines)
+			deserialize_lines.append('		obj.{} = v'.format(name))
+			if name in self.defaults:
+				deserialize_lines.append('	else: obj.{} = {}'.format(name, self.__default_expr(index, name)))
+			else:
+				deserialize_lines.append('	elif error_at_missing:')
+				deserialize_lines.append('		raise ValueError("Missing field {} for class {{}} in input object {{}}".format(cls, data))'.format(name))
+			serialize_items.append('{!r}: {}'.format(name, serialize_expr))
+		init_lines.append('	pass')
+		deserialize_lines.extend([
+			'	if error_at_redundancy and not _FIELDS.issuperset(data):',
+			'		raise ValueError("Unknown input attributes {} for class {} in input object {}".format(set(data).difference(_FIELDS), cls, data))',
+			'	return obj',
+		])
+		serialize_lines = [
+			'def serialize(self):',
+			'	try:',
+			'		return {{{}}}'.format(', '.join(serialize_items)),
+			'	except AttributeError:  # some fields are not set',
+			'		return _serialize_partial(self)',
+		]
+		source = '\n'.join(init_lines + deserialize_lines + serialize_lines) + '\n'
+		exec(compile(source, '<{} serializer>'.format(class_name), 'exec'), self.namespace)
+		return {name: self.namespace[name] for name in ('__init__', 'deserialize', 'serialize')}
+
+
+class _SlotSerializableMeta(ABCMeta):
+	def __new__(mcs, name: str, bases: tuple, namespace: dict, **kwargs):
+		annotations = namespace.get('__annotations__', {})
+		fields: Dict[str, Any] = {}
+		defaults: Dict[str, Any] = {}
+		for base in reversed(bases):
+			fields.update(getattr(base, '_slot_fields', {}))
+			defaults.update(getattr(base, '_slot_defaults', {}))
+		own_fields = [field for field in annotations.keys() if not field.startswith('_')]
+		for field in own_fields:
+			if field in namespace:
+				defaults[field] = namespace.pop(field)
+		namespace['__slots__'] = tuple(namespace.get('__slots__', ())) + tuple(field for field in own_fields if field not in fields)
+		cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+
+		type_hints = get_type_hints(cls)
+		for field in own_fields:
+			fields[field] = type_hints[field]
+		cls._slot_fields = fields
+		cls._slot_defaults = defaults
+		methods = _FieldCompiler(fields, defaults).compile(name)
+		cls.__init__ = methods['__init__']
+		cls.serialize = methods['serialize']
+		cls.deserialize = classmethod(methods['deserialize'])
+		return cls
+
+
+class SlotSerializable(metaclass=_SlotSerializableMeta):
+	"""
+	A lightweight counterpart of :class:`NoMissingFieldSerializable` for classes on the hot path, e.g. network packets
+
+	Fields are declared with annotations in the same way. Instances are backed by __slots__,
+	and __init__, serialize and deserialize are generated for each class at class creation,
+	so they are straight field copies instead of walking the annotations on every call.
+	Field values are checked and copied in the same way as mcdreforged's (de)serialize
+
+	Fields with default value are optional during deserialization, others are required if error_at_missing is set
+	"""
+	_slot_fields: Dict[str, Any]
+	_slot_defaults: Dict[str, Any]
+
+	def __init__(self, **kwargs):  # generated
+		pass
+
+	def serialize(self) -> dict:  # generated
+		raise NotImplementedError()
+
+	@classmethod
+	def deserialize(cls: Type[SlotSelf], data: dict, *, error_at_missing: bool = True, error_at_redundancy: bool = False, **kwargs) -> SlotSelf:  # generated
+		raise NotImplementedError()
+
+	@classmethod
+	def get_field_annotations(cls) -> Dict[str, Any]:
+		return cls._slot_fields.copy()
+
+	@classmethod
+	def get_default(cls: Type[SlotSelf]) -> SlotSelf:
+		return cls.deserialize({}, error_at_missing=False)
+
+	def __eq__(self, other: Any) -> bool:
+		if self is other:
+			return True
+		if not isinstance(other, type(self)):
+			return NotImplemented
+		for name in self._slot_fields:
+			if getattr(self, name, _MISSING) != getattr(other, name, _MISSING):
+				return False
+		return True
+
+	def __repr__(self) -> str:
+		return '{}({})'.format(type(self).__name__, ', '.join(
+			'{}={!r}'.format(name, getattr(self, name))
+			for name in self._slot_fields if hasattr(self, name)
+		))
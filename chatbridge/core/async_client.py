@@ -0,0 +1,285 @@
+import asyncio
+import random
+import time
+from typing import Optional, Union, Iterable, List
+
+from mcdreforged.utils.serializer import Serializable
+
+from chatbridge.common import constants
+from chatbridge.common.serializer import SlotSerializable
+from chatbridge.core.config import ClientInfo, ClientConfig
+from chatbridge.core.network import net_util
+from chatbridge.core.network.basic import ChatBridgeBase, Address
+from chatbridge.core.network.protocol import ChatBridgePacket, PacketType, AbstractPacket, ChatPayload, \
+	KeepAlivePayload, AbstractPayload, CommandPayload, CustomPayload, LoginResultPacket, AcknowledgePacket
+from chatbridge.core.network.sequence import PacketSequence
+from chatbridge.core.network.session import NetworkSession
+
+# asyncio.current_task is new in Python 3.7
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class AsyncChatBridgeClient(ChatBridgeBase):
+	"""
+	A ChatBridge client running in the asyncio event loop of the caller, without any thread.
+	It speaks the same protocol as :class:`chatbridge.core.client.ChatBridgeClient`
+
+	Use :meth:`connect` and :meth:`close` instead of start and stop. Received packets are iterated with ``async for``,
+	and the iteration ends when the connection is closed. Keep-alive is handled by a task, but received packets
+	are only read as fast as they are iterated, so keep iterating as long as the client is connected
+	"""
+	KEEP_ALIVE_INTERVAL = 60
+	KEEP_ALIVE_TIMEOUT = 15
+	TIMEOUT = 10
+	RECEIVE_QUEUE_SIZE = 1024  # packets received but not iterated yet
+	RESEND_BUFFER_SIZE = 1024  # sent packets kept until acknowledged, to be sent again after reconnecting
+
+	def __init__(self, aes_key: str, info: ClientInfo, *, server_address: Optional[Address] = None):
+		super().__init__(info.name, aes_key)
+		self.__server_address: Optional[Address] = server_address
+		self.__info = info
+		self.__session: NetworkSession = self._create_session()
+		self.__sequence = PacketSequence(self.RESEND_BUFFER_SIZE)
+		self.__reader: Optional[asyncio.StreamReader] = None
+		self.__writer: Optional[asyncio.StreamWriter] = None
+		self.__drain_lock: Optional[asyncio.Lock] = None
+		self.__received: Optional[asyncio.Queue] = None
+		self.__tasks: List[asyncio.Task] = []
+		self.__keep_alive_received: Optional[asyncio.Event] = None
+		self.__ping_array: List[float] = []
+		self.__online = False
+
+	@classmethod
+	def create(cls, config: ClientConfig):
+		client = cls(config.aes_key, config.client_info, server_address=config.server_address)
+		client.apply_network_config(config)
+		return client
+
+	def set_server_address(self, addr: Address):
+		self.__server_address = addr
+
+	def get_server_address(self) -> Address:
+		return self.__server_address
+
+	def is_online(self) -> bool:
+		return self.__online
+
+	def get_packet_sequence(self) -> PacketSequence:
+		return self.__sequence
+
+	@property
+	def ping(self) -> float:
+		"""
+		ping in second
+		"""
+		return -1 if len(self.__ping_array) == 0 else sum(self.__ping_array) / len(self.__ping_array)
+
+	def get_ping_text(self) -> str:
+		if self.ping >= 0:
+			return '{}ms'.format(round(self.ping * 1000, 2))
+		else:
+			return 'N/A'
+
+	# --------------
+	#   Connection
+	# --------------
+
+	async def connect(self):
+		"""
+		Connect to the server and login
+		:raise OSError: if the connection fails
+		:raise asyncio.IncompleteReadError: if the server closes the connection, e.g. the password is wrong
+		:raise ValueError: if the server replies garbage
+		:raise asyncio.TimeoutError: if the server doesn't respond in time
+		"""
+		if self.__writer is not None:
+			raise RuntimeError('Already connected')
+		self.logger.info('Connecting to {}'.format(self.__server_address))
+		self.__reader, self.__writer = await asyncio.wait_for(asyncio.open_connection(self.__server_address.hostname, self.__server_address.port), self.TIMEOUT)
+		self.__drain_lock = asyncio.Lock()
+		try:
+			self.__session = self._create_session()
+			self.__session.set_sequence(self.__sequence)
+			login_packet = self.__session.create_login_packet(self.__info.name, self.__info.password)
+			await self._send_packet(login_packet)
+			frame = await asyncio.wait_for(self.__read_frame(), self.TIMEOUT)
+			self.__session.on_login_result(login_packet, LoginResultPacket.deserialize(self.__session.decode_packet(frame)))
+		except BaseException:
+			self.__writer.close()
+			self.__reader = self.__writer = None
+			raise
+		self.logger.debug('Enabled protocol features: {}'.format(', '.join(sorted(self.__session.features)) or 'none'))
+		self.logger.info('Connected to the server')
+		self.__online = True
+		self.__ping_array.clear()
+		self.__received = asyncio.Queue(self.RECEIVE_QUEUE_SIZE)
+		self.__keep_alive_received = asyncio.Event()
+		loop = asyncio.get_event_loop()
+		self.__tasks = [loop.create_task(self.__receive_loop()), loop.create_task(self.__keep_alive_loop())]
+		packets = self.__session.take_resend_packets()
+		if len(packets) > 0:
+			self.logger.info('Sending {} packets not received by the peer before reconnecting'.format(len(packets)))
+			await self.__send_packets(packets)
+
+	async def close(self):
+		"""
+		Close the connection. Iterations of received packets will end
+		"""
+		if self.__writer is None:
+			return
+		writer = self.__writer
+		self.__online = False
+		self.__reader = self.__writer = None
+		for task in self.__tasks:
+			if task is not _current_task():
+				task.cancel()
+		self.__tasks.clear()
+		if self.__received.full():  # make room for the end mark
+			self.__received.get_nowait()
+		self.__received.put_nowait(None)
+		writer.close()
+		try:
+			await writer.wait_closed()
+		except (AttributeError, OSError):  # AttributeError: Python 3.6
+			pass
+		self.logger.info('Disconnected from the server')
+
+	async def __read_frame(self) -> bytes:
+		size = net_util.frame_size(await self.__reader.readexactly(net_util.FRAME_HEADER_SIZE))
+		if size > self.max_frame_size:
+			raise net_util.FrameTooLarge('Frame size {} exceeds the limit {}'.format(size, self.max_frame_size))
+		return await self.__reader.readexactly(size)
+
+	async def __receive_loop(self):
+		try:
+			while True:
+				packet = self.__session.decode_chatbridge_packet(await self.__read_frame())
+				if self.__session.should_acknowledge():
+					await self._send_packet(AcknowledgePacket())
+				if packet is None:  # an acknowledgement, or a packet received before reconnecting
+					continue
+				self.logger.debug('Received packet with type {}'.format(packet.type))
+				if packet.type == PacketType.keep_alive:
+					await self.__on_keep_alive(packet.sender, KeepAlivePayload.deserialize(packet.payload))
+				else:
+					await self.__received.put(packet)
+		except asyncio.CancelledError:
+			raise
+		except (asyncio.IncompleteReadError, ConnectionError) as e:
+			self.logger.warning('Connection closed: {}'.format(e))
+		except Exception:
+			self.logger.exception('Error receiving packets, closing connection')
+		await self.close()
+
+	# -------------
+	#   Iteration
+	# -------------
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self) -> ChatBridgePacket:
+		received = self.__received
+		if received is None:
+			raise StopAsyncIteration()
+		packet = await received.get()
+		if packet is None:
+			received.put_nowait(None)  # for other iterations
+			raise StopAsyncIteration()
+		return packet
+
+	# ---------------------
+	#   Packet core logic
+	# ---------------------
+
+	async def _send_packet(self, packet: AbstractPacket):
+		"""
+		Send the packet, and wait until it's handed to the socket
+		"""
+		await self.__send_packets([packet])
+
+	async def __send_packets(self, packets: List[AbstractPacket]):
+		writer = self.__writer
+		if writer is None:
+			self.logger.warning('Trying to send a packet when not connected')
+			return
+		buffers = []
+		for packet in packets:  # sealed and written in the same order, no await in between
+			frame = self.__session.encode_packet(packet)
+			buffers.append(net_util.frame_header(frame))
+			buffers.append(frame)
+		writer.writelines(buffers)
+		async with self.__drain_lock:  # concurrent drain is not supported before Python 3.10
+			await writer.drain()
+
+	async def send_to(self, type_: str, clients: Union[str, Iterable[str]], payload: AbstractPayload):
+		if isinstance(clients, str):
+			clients = (clients,)
+		await self.__build_and_send_packet(type_, clients, payload, is_broadcast=False)
+
+	async def send_to_all(self, type_: str, payload: AbstractPayload):
+		await self.__build_and_send_packet(type_, [], payload, is_broadcast=True)
+
+	async def __build_and_send_packet(self, type_: str, receiver: Iterable[str], payload: AbstractPayload, *, is_broadcast: bool):
+		await self._send_packet(ChatBridgePacket(
+			sender=self.get_name(),
+			receivers=list(receiver),
+			broadcast=is_broadcast,
+			type=type_,
+			payload=payload.serialize()
+		))
+
+	# -------------------------
+	#   Send packet shortcuts
+	# -------------------------
+
+	async def send_chat(self, target: str, message: str, author: str = ''):
+		await self.send_to(PacketType.chat, target, ChatPayload(author=author, message=message))
+
+	async def broadcast_chat(self, message: str, author: str = ''):
+		await self.send_to_all(PacketType.chat, ChatPayload(author=author, message=message))
+
+	async def send_command(self, target: str, command: str, params: Optional[Union[Serializable, SlotSerializable, dict]] = None):
+		await self.send_to(PacketType.command, target, CommandPayload.ask(command, params))
+
+	async def broadcast_command(self, command: str, params: Optional[Union[Serializable, SlotSerializable, dict]] = None):
+		await self.send_to_all(PacketType.command, CommandPayload.ask(command, params))
+
+	async def reply_command(self, target: str, asker_payload: 'CommandPayload', result: Union[Serializable, SlotSerializable, dict]):
+		await self.send_to(PacketType.command, target, CommandPayload.answer(asker_payload, result))
+
+	async def send_custom(self, target: str, data: dict):
+		await self.send_to(PacketType.custom, target, CustomPayload(data=data))
+
+	async def broadcast_custom(self, data: dict):
+		await self.send_to_all(PacketType.custom, CustomPayload(data=data))
+
+	# -------------------
+	#   Keep Alive Impl
+	# -------------------
+
+	async def __on_keep_alive(self, sender: str, payload: KeepAlivePayload):
+		if payload.is_ping():
+			await self.send_to(PacketType.keep_alive, sender, KeepAlivePayload.pong())
+		elif payload.is_pong():
+			self.__keep_alive_received.set()
+		else:
+			self.logger.warning('Unknown keep alive type: {}'.format(payload.ping_type))
+
+	async def __keep_alive_loop(self):
+		while True:
+			await asyncio.sleep(random.random())
+			self.__keep_alive_received.clear()
+			time_sent = time.monotonic()
+			await self.send_to(PacketType.keep_alive, constants.SERVER_NAME, KeepAlivePayload.ping())
+			try:
+				await asyncio.wait_for(self.__keep_alive_received.wait(), self.KEEP_ALIVE_TIMEOUT)
+			except asyncio.TimeoutError:
+				self.logger.warning('Disconnect due to keep-alive ping timeout')
+				await self.close()
+				return
+			self.__ping_array.append(time.monotonic() - time_sent)
+			if len(self.__ping_array) > 5:
+				self.__ping_array.pop(0)
+			self.logger.debug('Keep-alive responded, ping = {}ms'.format(round(self.ping * 1000, 2)))
+			await asyncio.sleep(self.KEEP_ALIVE_INTERVAL)
@@ -0,0 +1,497 @@
+import asyncio
+import random
+import time
+from concurrent.futures import Future
+from threading import Event, Thread, current_thread
+from typing import Optional, List, TYPE_CHECKING
+
+from chatbridge.common import constants
+from chatbridge.common.logger import ChatBridgeLogger
+from chatbridge.core.client import ChatBridgeClient
+from chatbridge.core.config import ClientInfo
+from chatbridge.core.network import net_util
+from chatbridge.core.network.basic import Address
+from chatbridge.core.network.protocol import LoginPacket, ChatBridgePacket, PacketType, KeepAlivePayload, AcknowledgePacket
+from chatbridge.core.network.sequence import PacketSequence
+from chatbridge.core.network.session import NetworkSession, OutgoingPacket, SharedPacket
+
+if TYPE_CHECKING:
+	from chatbridge.core.server import ChatBridgeServer
+
+# asyncio.BufferedProtocol, all_tasks and current_task are new in Python 3.7
+_ProtocolBase = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+_all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+_current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+
+
+class _ServerProtocol(_ProtocolBase):
+	"""
+	A TCP connection to the server. It logs in, then carries the packets of a :class:`_AsyncClientConnection`
+	"""
+
+	def __init__(self, engine: 'AsyncioServerEngine', number: int):
+		self.engine = engine
+		self.number = number
+		self.server = engine.server
+		self.transport: Optional[asyncio.Transport] = None
+		self.addr: Optional[Address] = None
+		self.session = self.server._create_session()
+		self.connection: Optional[_AsyncClientConnection] = None
+		self.__buffer = net_util.FrameBuffer(max_frame_size=self.server.max_frame_size)
+		self.__login_timer: Optional[asyncio.TimerHandle] = None
+		self.__login_pending = False
+		self.__closed = False
+
+	def connection_made(self, transport: asyncio.Transport):
+		self.transport = transport
+		self.addr = Address(*transport.get_extra_info('peername')[:2])
+		if not self.server._admit_connection(self.addr):
+			self.close()
+			return
+		self.__login_pending = True
+		self.server.logger.info('New connection #{} from {}'.format(self.number, self.addr))
+		self.__login_timer = self.engine.loop.call_later(self.server.MAXIMUM_LOGIN_DURATION, self.__on_login_timeout)
+
+	def connection_lost(self, exc: Optional[Exception]):
+		self.__closed = True
+		if self.__login_timer is not None:
+			self.__login_timer.cancel()
+		self.__end_login()
+		if self.connection is not None:
+			self.connection.on_connection_lost(self, exc)
+
+	def close(self):
+		self.__closed = True
+		self.transport.close()
+
+	# -------------
+	#   Receiving
+	# -------------
+
+	def get_buffer(self, sizehint: int) -> memoryview:
+		return self.__buffer.get_buffer()
+
+	def buffer_updated(self, nbytes: int):
+		self.__buffer.buffer_updated(nbytes)
+		try:
+			frame = self.__buffer.pop_frame()
+			while frame is not None and not self.__closed:
+				if self.connection is None:
+					self.__on_login_frame(frame)
+				else:
+					self.connection.on_frame(frame)
+				frame = self.__buffer.pop_frame()
+		except net_util.FrameTooLarge as e:
+			self.__on_error(e)
+
+	def data_received(self, data: bytes):  # Python 3.6, without BufferedProtocol
+		view = memoryview(data)
+		while len(view) > 0:
+			buffer = self.get_buffer(len(view))
+			size = min(len(buffer), len(view))
+			buffer[:size] = view[:size]
+			view = view[size:]
+			self.buffer_updated(size)
+
+	def __on_error(self, e: Exception):
+		if self.connection is not None:
+			self.connection.disconnect('Connection closed: {}'.format(e))
+		else:
+			self.server.login_stats.increase('malformed')
+			self.server.logger.error('Error on connection from {}: {}'.format(self.addr, e))
+			self.close()
+
+	# -------------
+	#     Login
+	# -------------
+
+	def __end_login(self):
+		if self.__login_pending:
+			self.__login_pending = False
+			self.server.login_stats.increase('pending', -1)
+
+	def __on_login_timeout(self):
+		self.server.login_stats.increase('timed_out')
+		self.server.logger.warning('Terminating coming connection #{} from {} due to login timeout'.format(self.number, self.addr))
+		self.close()
+
+	def __on_login_frame(self, frame: bytes):
+		self.__login_timer.cancel()
+		self.__end_login()
+		try:
+			login_packet = LoginPacket.deserialize(self.session.decode_packet(frame))
+		except Exception as e:
+			self.server.login_stats.increase('malformed')
+			self.server.logger.error('Failed reading client\'s login packet: {}'.format(e))
+			self.close()
+			return
+		self.server.log_packet(login_packet, to_client=False)
+		client = self.server._authenticate(login_packet, self.addr)
+		if client is not None:
+			client.on_login(self, login_packet)
+		else:
+			self.close()
+			self.server.logger.warning('Closed connection from {}'.format(self.addr))
+
+	# -------------
+	#    Sending
+	# -------------
+
+	def pause_writing(self):
+		if self.connection is not None:
+			self.connection.set_writing_paused(True)
+
+	def resume_writing(self):
+		if self.connection is not None:
+			self.connection.set_writing_paused(False)
+
+	def write_frames(self, frames: List[bytes]):
+		buffers = []
+		for frame in frames:
+			buffers.append(net_util.frame_header(frame))
+			buffers.append(frame)
+		self.transport.writelines(buffers)
+
+
+class _AsyncClientConnection:
+	"""
+	A registered client of a server running the asyncio engine. It's the counterpart of the threaded _ClientConnection,
+	with the same interface for the server, but its packets are handled in the event loop.
+	Methods are safe to be called from other threads unless stated otherwise
+	"""
+	KEEP_ALIVE_INTERVAL = ChatBridgeClient.KEEP_ALIVE_INTERVAL
+	KEEP_ALIVE_TIMEOUT = ChatBridgeClient.KEEP_ALIVE_TIMEOUT
+	RESEND_BUFFER_SIZE = ChatBridgeClient.RESEND_BUFFER_SIZE
+
+	def __init__(self, engine: 'AsyncioServerEngine', info: ClientInfo):
+		self.info = info
+		self.engine = engine
+		self.server = engine.server
+		self.logger = ChatBridgeLogger('Server.{}'.format(info.name), file_handler=self.server.logger.file_handler)
+		self.__protocol: Optional[_ServerProtocol] = None
+		self.__session: NetworkSession = self.server._create_session()
+		self.__sequence = PacketSequence(self.RESEND_BUFFER_SIZE)
+		self.__outbound: Optional[net_util.OutboundQueue] = None
+		self.__flush_scheduled = False
+		self.__writing_paused = False
+		self.__keep_alive_task: Optional[asyncio.Task] = None
+		self.__keep_alive_received: Optional[asyncio.Event] = None
+		self.__ping_array: List[float] = []
+
+	def get_connection_client_name(self) -> str:
+		return self.info.name
+
+	def is_online(self) -> bool:
+		return self.__protocol is not None
+
+	def is_running(self) -> bool:
+		return self.is_online()
+
+	@property
+	def ping(self) -> float:
+		"""
+		ping in second
+		"""
+		return -1 if len(self.__ping_array) == 0 else sum(self.__ping_array) / len(self.__ping_array)
+
+	def get_ping_text(self) -> str:
+		if self.ping >= 0:
+			return '{}ms'.format(round(self.ping * 1000, 2))
+		else:
+			return 'N/A'
+
+	def get_outbound_queue_depth(self) -> int:
+		outbound = self.__outbound
+		return outbound.depth if outbound is not None else 0
+
+	def get_dropped_packet_count(self) -> int:
+		"""
+		Amount of packets dropped by the outbound queue of the current connection
+		"""
+		outbound = self.__outbound
+		return outbound.dropped_count if outbound is not None else 0
+
+	def _get_session(self) -> NetworkSession:
+		return self.__session
+
+	def get_packet_sequence(self) -> PacketSequence:
+		return self.__sequence
+
+	# --------------
+	#   Connection
+	# --------------
+
+	def on_login(self, protocol: _ServerProtocol, login_packet: LoginPacket):
+		"""
+		Event loop only. Take over the connection that just logged in
+		"""
+		if self.__protocol is not None:
+			old_protocol = self.__protocol
+			self.__on_disconnected('Replaced by a new connection from {}'.format(protocol.addr))
+			old_protocol.close()
+		protocol.connection = self
+		self.__protocol = protocol
+		self.__session = protocol.session
+		self.__session.set_sequence(self.__sequence)
+		self.__session.set_command_aggregation(self.server.get_command_aggregator() is not None)
+		login_result = self.__session.accept_login(login_packet)
+		self.__outbound = net_util.OutboundQueue(None, self.server.outbound_queue_policy, is_droppable=ChatBridgeClient._is_packet_droppable)
+		self.__flush_scheduled = False
+		self.__writing_paused = False
+		protocol.write_frames([self.__session.encode_packet(login_result)])
+		self.__session.on_login_result_sent()
+		self.server.log_packet(login_result, to_client=True, client_name=self.get_connection_client_name())
+		self.logger.debug('Enabled protocol features: {}'.format(', '.join(sorted(self.__session.features)) or 'none'))
+		self.__ping_array.clear()
+		self.__keep_alive_received = asyncio.Event()
+		self.__keep_alive_task = self.engine.loop.create_task(self.__keep_alive_loop())
+		self.logger.info('Started client connection')
+		packets = self.__session.take_resend_packets()
+		if len(packets) > 0:
+			self.logger.info('Sending {} packets not received by the peer before reconnecting'.format(len(packets)))
+		for packet in packets:
+			self.__send_packet(packet)
+		self.server._send_offline_packets(self, self.__send_packet)  # online already, but nothing else is forwarded until it returns on the loop
+
+	def on_connection_lost(self, protocol: _ServerProtocol, exc: Optional[Exception]):
+		"""
+		Event loop only
+		"""
+		if protocol is self.__protocol:
+			self.__on_disconnected('Connection closed: {}'.format(exc if exc is not None else 'Empty content received'))
+
+	def __on_disconnected(self, reason: Optional[str]):
+		if reason is not None:
+			self.logger.warning(reason)
+		self.__protocol = None
+		self.server._queue_unsent_packets(self, [packet for packet in self.__outbound.close() if ChatBridgeClient._is_packet_kept(packet)])
+		self.__keep_alive_task.cancel()
+		self.logger.info('Stopped client connection')
+
+	def disconnect(self, reason: Optional[str] = None):
+		"""
+		Event loop only
+		:param reason: The warning to be logged, if it's not a normal disconnection
+		"""
+		protocol = self.__protocol
+		if protocol is not None:
+			self.__on_disconnected(reason)
+			protocol.close()
+
+	def stop(self):
+		"""
+		Close the current connection, and wait until it's closed
+		"""
+		if self.engine.in_loop_thread():
+			self.disconnect()
+		else:
+			self.engine.call_and_wait(self.disconnect)
+
+	# -----------
+	#   Packets
+	# -----------
+
+	def on_frame(self, frame: bytes):
+		"""
+		Event loop only
+		"""
+		try:
+			packet = self.__session.decode_chatbridge_packet(frame)
+		except ValueError as e:
+			self.logger.exception('Fail to decode received frame with length {}'.format(len(frame)))
+			self.disconnect('Disconnect due to bad frame: {}'.format(e))
+			return
+		if self.__session.should_acknowledge():
+			self.__send_packet(AcknowledgePacket())
+		if packet is None:  # an acknowledgement, or a packet received before reconnecting
+			return
+		try:
+			if packet.type == PacketType.keep_alive:
+				self.__on_keep_alive(packet.sender, KeepAlivePayload.deserialize(packet.payload))
+			self.server.process_packet(self, packet)
+		except:
+			self.logger.exception('Fail to process packet {}'.format(packet))
+
+	def send_packet_invoker(self, packet: OutgoingPacket):
+		if self.engine.in_loop_thread():
+			self.__send_packet(packet)
+		else:
+			try:
+				self.engine.loop.call_soon_threadsafe(self.__send_packet, packet)
+			except RuntimeError:  # the loop is closed
+				self.logger.warning('Trying to send a packet when not connected')
+
+	def __send_packet(self, packet: OutgoingPacket):
+		if self.__protocol is None:
+			self.logger.warning('Trying to send a packet when not connected')
+			return
+		if not self.__outbound.put(packet):
+			if self.__outbound.error is not None:
+				self.disconnect('Disconnect due to outbound error: {}'.format(self.__outbound.error))
+			return
+		self.server.log_packet(packet.packet if isinstance(packet, SharedPacket) else packet, to_client=True, client_name=self.get_connection_client_name())
+		if not self.__flush_scheduled:
+			self.__flush_scheduled = True
+			if self.server.send_flush_delay > 0:
+				self.engine.loop.call_later(self.server.send_flush_delay, self.__flush, self.__protocol)
+			else:
+				self.engine.loop.call_soon(self.__flush, self.__protocol)
+
+	def set_writing_paused(self, paused: bool):
+		"""
+		Event loop only. Flow control of the transport. Packets stay in the outbound queue while paused
+		"""
+		self.__writing_paused = paused
+		if not paused and not self.__flush_scheduled:
+			self.__flush_scheduled = True
+			self.engine.loop.call_soon(self.__flush, self.__protocol)
+
+	def __flush(self, protocol: _ServerProtocol):
+		"""
+		Seal and write all queued packets together
+		"""
+		if protocol is not self.__protocol:  # the connection is gone
+			return
+		self.__flush_scheduled = False
+		if self.__writing_paused:
+			return
+		try:
+			packets = self.__outbound.poll()
+			if len(packets) > 0:
+				protocol.write_frames([self.__session.encode_packet(packet) for packet in packets])
+		except Exception as e:
+			self.logger.exception('Failed to send packets')
+			self.disconnect('Disconnect due to outbound error: {}'.format(e))
+
+	def __create_packet(self, type_: str, payload: KeepAlivePayload) -> ChatBridgePacket:
+		return ChatBridgePacket(
+			sender=constants.SERVER_NAME,
+			receivers=[self.get_connection_client_name()],
+			broadcast=False,
+			type=type_,
+			payload=payload.serialize()
+		)
+
+	# --------------
+	#   Keep Alive
+	# --------------
+
+	def __on_keep_alive(self, sender: str, payload: KeepAlivePayload):
+		if payload.is_ping():
+			self.__send_packet(self.__create_packet(PacketType.keep_alive, KeepAlivePayload.pong()))
+		elif payload.is_pong():
+			self.__keep_alive_received.set()
+		else:
+			self.logger.warning('Unknown keep alive type: {}'.format(payload.ping_type))
+
+	async def __keep_alive_loop(self):
+		while True:
+			await asyncio.sleep(random.random())
+			self.__keep_alive_received.clear()
+			time_sent = time.monotonic()
+			self.__send_packet(self.__create_packet(PacketType.keep_alive, KeepAlivePayload.ping()))
+			try:
+				await asyncio.wait_for(self.__keep_alive_received.wait(), self.KEEP_ALIVE_TIMEOUT)
+			except asyncio.TimeoutError:
+				self.disconnect('Disconnect due to keep-alive ping timeout')
+				return
+			self.__ping_array.append(time.monotonic() - time_sent)
+			if len(self.__ping_array) > 5:
+				self.__ping_array.pop(0)
+			self.logger.debug('Keep-alive responded, ping = {}ms'.format(round(self.ping * 1000, 2)))
+			await asyncio.sleep(self.KEEP_ALIVE_INTERVAL)
+
+
+class AsyncioServerEngine:
+	"""
+	Serves all connections of a :class:`chatbridge.core.server.ChatBridgeServer` in its main loop thread with an asyncio event loop,
+	instead of a few threads per connection.
+	Server hooks like on_chat are invoked in the event loop, so they should return quickly
+	"""
+
+	def __init__(self, server: 'ChatBridgeServer'):
+		self.server = server
+		self.loop = asyncio.new_event_loop()
+		self.__thread: Optional[Thread] = None
+		self.__stop_event: Optional[asyncio.Event] = None
+		self.__counter = 0
+
+	def create_connection(self, info: ClientInfo) -> _AsyncClientConnection:
+		return _AsyncClientConnection(self, info)
+
+	def in_loop_thread(self) -> bool:
+		return current_thread() is self.__thread
+
+	def call_and_wait(self, func):
+		"""
+		Invoke the function in the event loop, and wait for it to finish. Do nothing if the loop is not running
+		"""
+		future = Future()
+
+		def invoke():
+			try:
+				future.set_result(func())
+			except Exception as e:
+				future.set_exception(e)
+
+		if self.loop.is_running():
+			try:
+				self.loop.call_soon_threadsafe(invoke)
+			except RuntimeError:  # closed
+				return
+			future.result()
+
+	def __create_protocol(self) -> _ServerProtocol:
+		self.__counter += 1
+		return _ServerProtocol(self, self.__counter)
+
+	def run(self, binding_done: Event) -> bool:
+		"""
+		Run the event loop in the current thread until stopped
+		:param binding_done: Will be set after the port binding, no matter if it's successful
+		:return: If the port was bound successfully
+		"""
+		self.__thread = current_thread()
+		asyncio.set_event_loop(self.loop)
+		try:
+			return self.loop.run_until_complete(self.__serve(binding_done))
+		finally:
+			self.loop.close()
+			self.__thread = None
+
+	async def __serve(self, binding_done: Event) -> bool:
+		self.__stop_event = asyncio.Event()
+		try:
+			try:
+				server = await self.loop.create_server(self.__create_protocol, self.server.server_address.hostname, self.server.server_address.port, reuse_address=True)
+			except Exception:
+				self.server.logger.exception('Failed to bind {}'.format(self.server.server_address))
+				return False
+		finally:
+			binding_done.set()
+		self.server.logger.info('Server started at {}'.format(self.server.server_address))
+		await self.__stop_event.wait()
+		server.close()
+		await server.wait_closed()
+		for client in self.server.clients.values():
+			client.disconnect()
+		tasks = [task for task in _all_tasks(self.loop) if task is not _current_task(self.loop)]
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)  # let cancelled tasks, e.g. keep-alive, finish
+		await asyncio.sleep(0)  # let transports close
+		self.server.logger.info('Socket closed')
+		return True
+
+	def stop(self):
+		"""
+		Let :meth:`run` exit
+		"""
+		def set_stop_event():
+			if self.__stop_event is not None:
+				self.__stop_event.set()
+
+		try:
+			self.loop.call_soon_threadsafe(set_stop_event)
+		except RuntimeError:  # the loop is closed
+			pass
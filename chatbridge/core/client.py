@@ -1,22 +1,27 @@
-import json
 import random
 import socket
 import time
+from concurrent import futures
 from enum import Enum, auto
 from socket import timeout
-from threading import Event, RLock
+from threading import Event, RLock, Lock
 from threading import Thread
-from typing import Optional, Iterable, Callable, Any, Union, Collection, TypeVar, Type
+from typing import Optional, Iterable, Callable, Any, Union, Collection, TypeVar, Type, NamedTuple, List, Dict, Set
 
 from mcdreforged.utils.serializer import Serializable
 
 from chatbridge.common import constants
+from chatbridge.common.scheduler import get_scheduler, TimerHandle
+from chatbridge.common.serializer import SlotSerializable
 from chatbridge.core.config import ClientInfo, ClientConfig
 from chatbridge.core.network import net_util
+from chatbridge.core.outbox import Outbox
 from chatbridge.core.network.basic import ChatBridgeBase, Address
 from chatbridge.core.network.protocol import ChatBridgePacket, PacketType, AbstractPacket, ChatPayload, \
 	KeepAlivePayload, AbstractPayload, CommandPayload, CustomPayload
-from chatbridge.core.network.protocol import LoginPacket, LoginResultPacket
+from chatbridge.core.network.protocol import LoginResultPacket, AcknowledgePacket, CommandReceiptPayload, CommandAggregatePayload
+from chatbridge.core.network.sequence import PacketSequence
+from chatbridge.core.network.session import NetworkSession, OutgoingPacket, SharedPacket
 
 
 class ClientStatus(Enum):
@@ -28,9 +33,33 @@ class ClientStatus(Enum):
 	STOPPED = auto()  # stopped
 
 
+class ClientStopEvent(NamedTuple):
+	requested: bool  # if it's stopped by stop() or restart(), instead of a failed or lost connection
+	online_time: float  # seconds the client has been online, 0 if it didn't get online
+
+
+class _PendingCommand:
+	"""
+	A command sent by the client, waiting for replies
+	"""
+	def __init__(self, broadcast: bool):
+		self.future = futures.Future()
+		self.broadcast = broadcast
+		self.receivers: Optional[Set[str]] = None  # the clients expected to reply, if known
+		self.replies: Dict[str, CommandPayload] = {}  # sender -> reply
+		self.timer: Optional[TimerHandle] = None
+
+	def is_complete(self) -> bool:
+		if not self.broadcast:
+			return len(self.replies) > 0
+		return self.receivers is not None and self.receivers.issubset(self.replies.keys())
+
+
 class ChatBridgeClient(ChatBridgeBase):
 	KEEP_ALIVE_INTERVAL = 60
 	KEEP_ALIVE_TIMEOUT = 15
+	COMMAND_TIMEOUT = 5  # seconds to wait for command replies
+	RESEND_BUFFER_SIZE = 1024  # sent packets kept until acknowledged, to be sent again after reconnecting
 	_PACKET_CALLBACK = Callable[[dict], Any]
 	TIMEOUT = 10
 
@@ -38,19 +67,59 @@ class ChatBridgeClient(ChatBridgeBase):
 		super().__init__(info.name, aes_key)
 		self.__server_address: Optional[Address] = server_address
 		self.__sock: Optional[socket.socket] = None
+		self.__reader: Optional[net_util.FrameReader] = None
+		self.__writer: Optional[net_util.FrameWriter] = None
+		self.__outbound: Optional[net_util.OutboundQueue] = None
+		self.__outbox: Optional[Outbox] = None
+		self.__outbox_lock = Lock()
+		self.__unsent: List[OutgoingPacket] = []  # queued but not sent when the previous connection closed
+		self.__sequence = PacketSequence(self.RESEND_BUFFER_SIZE)
+		self.__session = self._create_session()
 		self.__sock_lock = RLock()
 		self.__start_stop_lock = RLock()
 		self.__status = ClientStatus.STOPPED
 		self.__status_lock = RLock()
 		self.__connection_done = Event()
-		self.__keep_alive_received = Event()
+		self.__keep_alive_lock = Lock()
+		self.__keep_alive_timer: Optional[TimerHandle] = None
+		self.__keep_alive_sent: Optional[float] = None  # when the pending ping was sent
+		self.__keep_alive_epoch = 0  # timers of previous connections are ignored
 		self.__ping_array = []
 		self.__info = info
-		self.__thread_keep_alive: Optional[Thread] = None
+		self.__stop_requested = False
+		self.__stop_event: Optional[ClientStopEvent] = None
+		self.__stop_listeners: List[Callable[[ClientStopEvent], Any]] = []
+		self.__thread_writer: Optional[Thread] = None
+		self.__commands: Dict[str, _PendingCommand] = {}  # cid -> command waiting for replies
+		self.__commands_lock = Lock()
 
 	@classmethod
 	def create(cls, config: ClientConfig):
-		return cls(config.aes_key, config.client_info, server_address=config.server_address)
+		client = cls(config.aes_key, config.client_info, server_address=config.server_address)
+		client.apply_network_config(config)
+		client.apply_outbox_config(config)
+		return client
+
+	def apply_outbox_config(self, config: ClientConfig):
+		"""
+		Keep chat and command packets sent while offline in an outbox, according to the config
+		"""
+		if config.outbox_size > 0:
+			self.set_outbox(Outbox(config.outbox_size, config.outbox_max_age, file_path=config.outbox_file or None))
+		else:
+			self.set_outbox(None)
+
+	def set_outbox(self, outbox: Optional[Outbox]):
+		"""
+		:param outbox: The outbox that keeps chat and command packets sent while offline, or None to drop them
+		"""
+		self.__outbox = outbox
+
+	def get_outbox(self) -> Optional[Outbox]:
+		return self.__outbox
+
+	def get_packet_sequence(self) -> PacketSequence:
+		return self.__sequence
 
 	# --------------
 	#     Status
@@ -109,9 +178,25 @@ class ChatBridgeClient(ChatBridgeBase):
 		else:
 			return 'N/A'
 
-	def _set_socket(self, sock: Optional[socket.socket]):
+	def _set_socket(self, sock: Optional[socket.socket], reader: Optional[net_util.FrameReader] = None, session: Optional[NetworkSession] = None):
+		"""
+		:param reader: The frame reader that has been reading the socket, if any. Buffered frames in it will be kept
+		:param session: The network session that has been used on the socket, if any
+		"""
+		if sock is not None:
+			if reader is None:
+				reader = net_util.FrameReader(sock, max_frame_size=self.max_frame_size)
+			if session is None:
+				session = self._create_session()
 		with self.__sock_lock:
 			self.__sock = sock
+			self.__reader = reader
+			self.__writer = net_util.FrameWriter(sock, session) if sock is not None else None
+			if session is not None:
+				self.__session = session
+
+	def _get_session(self) -> NetworkSession:
+		return self.__session
 
 	def __connect(self):
 		"""
@@ -135,6 +220,10 @@ class ChatBridgeClient(ChatBridgeBase):
 		with self.__sock_lock:
 			self._set_status(ClientStatus.DISCONNECTED)  # set the status first so no exception errors get spammed
 			if self.__sock is not None:
+				try:
+					self.__sock.shutdown(socket.SHUT_RDWR)  # wakes up the reader and writer threads blocking on the socket
+				except OSError:  # not connected
+					pass
 				try:
 					self.__sock.close()
 				except:
@@ -144,16 +233,23 @@ class ChatBridgeClient(ChatBridgeBase):
 	def _tick_connection(self):
 		try:
 			# self.logger.debug('Waiting for data received')
-			packet = self._receive_packet(ChatBridgePacket)
+			frames = self.__reader.read_frames(timeout=self.TIMEOUT)
 		except timeout:
 			# self.logger.debug('Timeout, ignore')
 			pass
 		else:
-			self.logger.debug('Received packet with type {}: {}'.format(packet.type, packet.payload))
-			try:
-				self._on_packet(packet)
-			except:
-				self.logger.exception('Fail to process packet {}'.format(packet))
+			for frame in frames:
+				packet = self._decode_packet(frame, ChatBridgePacket)
+				if packet is None:  # an acknowledgement, or a packet received before reconnecting
+					continue
+				if self.logger.is_debug_enabled():  # don't decode the payload just for logging
+					self.logger.debug('Received packet with type {}: {}'.format(packet.type, packet.payload))
+				try:
+					self._on_packet(packet)
+				except:
+					self.logger.exception('Fail to process packet {}'.format(packet))
+			if self.__session.should_acknowledge():
+				self._send_packet(AcknowledgePacket())
 
 	# --------------
 	#   Main Logic
@@ -166,6 +262,7 @@ class ChatBridgeClient(ChatBridgeBase):
 				self.logger.warning('Client is running, cannot start again')
 				return
 			self._set_status(ClientStatus.STARTING)
+			self.__stop_requested = False
 		self.__connection_done.clear()
 		super().start()
 		self.__connection_done.wait()
@@ -177,6 +274,7 @@ class ChatBridgeClient(ChatBridgeBase):
 			if self._is_stopped():
 				self.logger.warning('Client is stopped, cannot stop again')
 				return
+			self.__stop_requested = True
 			self.__disconnect()  # state -> STOPPED or DISCONNECTED
 		super().stop()
 		self.logger.debug('Stopped client')
@@ -190,14 +288,35 @@ class ChatBridgeClient(ChatBridgeBase):
 
 	def _connect_and_login(self):
 		self.__connect()
-		self._send_packet(LoginPacket(name=self.__info.name, password=self.__info.password))
-		self._receive_packet(LoginResultPacket)
+		self.__session.set_sequence(self.__sequence)
+		self.__session.set_command_aggregation(True)
+		login_packet = self.__session.create_login_packet(self.__info.name, self.__info.password)
+		self._send_packet(login_packet)
+		self.__session.on_login_result(login_packet, self._receive_packet(LoginResultPacket))
+		self.logger.debug('Enabled protocol features: {}'.format(', '.join(sorted(self.__session.features)) or 'none'))
 		self.logger.info('Connected to the server')
 
+	def add_stop_listener(self, listener: Callable[[ClientStopEvent], Any]):
+		"""
+		The listener is called in the MainLoop thread every time the client stops, including failed connection attempts.
+		The client can be started again in the listener, but it shouldn't block
+		"""
+		self.__stop_listeners.append(listener)
+
+	def _on_main_loop_exited(self):
+		event = self.__stop_event
+		for listener in self.__stop_listeners:
+			try:
+				listener(event)
+			except:
+				self.logger.exception('Error in stop listener {}'.format(listener))
+
 	def _main_loop(self):
+		online_since: Optional[float] = None
 		try:
 			self._connect_and_login()
-			self._set_status(ClientStatus.ONLINE)
+			self.__go_online()
+			online_since = time.monotonic()
 		except Exception as e:
 			(self.logger.exception if self.logger.is_debug_enabled() else self.logger.error)('Failed to connect to {}: {}'.format(self.__server_address, e))
 			self.__disconnect()
@@ -220,38 +339,141 @@ class ChatBridgeClient(ChatBridgeBase):
 					break
 			self._on_stopped()
 		finally:
+			self.__stop_event = ClientStopEvent(
+				requested=self.__stop_requested,
+				online_time=time.monotonic() - online_since if online_since is not None else 0
+			)
 			self._set_status(ClientStatus.STOPPED)
 
+	def __go_online(self):
+		"""
+		status: CONNECTED -> ONLINE
+		The outbound queue is filled with the packets to be sent first before getting online,
+		so packets sent once online are queued after them
+		"""
+		with self.__outbox_lock:
+			self.__outbound = net_util.OutboundQueue(self.__writer, self.outbound_queue_policy, is_droppable=self._is_packet_droppable, flush_delay=self.send_flush_delay, on_written=self.__on_packets_written)
+			packets = self.__session.take_resend_packets()
+			if len(packets) > 0:
+				self.logger.info('Sending {} packets not received by the peer before reconnecting'.format(len(packets)))
+			if len(self.__unsent) > 0:
+				self.logger.info('Sending {} packets not sent before reconnecting'.format(len(self.__unsent)))
+				packets.extend(self.__unsent)
+				self.__unsent = []
+			if self.__outbox is not None:
+				outbox_packets = self.__outbox.take_all()
+				if len(outbox_packets) > 0:
+					self.logger.info('Sending {} packets kept in the outbox'.format(len(outbox_packets)))
+				packets.extend(outbox_packets)
+			for packet in packets:  # sent in batches by the writer thread
+				self.__outbound.put(packet)
+			self._go_online(self.__outbound.put)
+
+	def __on_packets_written(self, packets: List[OutgoingPacket]):
+		outbox = self.__outbox
+		if outbox is not None:  # packets taken from the outbox can be removed from its file now
+			outbox.on_sent(packets)
+
+	def _go_online(self, put: Callable[[OutgoingPacket], Any]):
+		"""
+		Set the status to ONLINE, after the resend and outbox packets are queued
+		:param put: Queues a packet before the client is online. Subclasses can queue more packets to be sent first with it
+		"""
+		self._set_status(ClientStatus.ONLINE)
+
 	def _on_started(self):
+		self.__thread_writer = self._start_writer_thread(self.__outbound)
 		self.__connection_done.set()
-		self.__thread_keep_alive = self._start_keep_alive_thread()
 		self.__ping_array.clear()
+		self.__start_keep_alive()
 
 	def _on_stopped(self):
 		if self._is_connected():
 			self.__disconnect()
-		self.logger.debug('Joining keep alive thread')
-		self.__thread_keep_alive.join()
-		self.logger.debug('Joined keep alive thread')
+		self._keep_unsent_packets([packet for packet in self.__outbound.close() if self._is_packet_kept(packet)])
+		self.__stop_keep_alive()
+		self.logger.debug('Joining writer thread')
+		self.__thread_writer.join()
+		self.logger.debug('Joined writer thread')
+		self.__outbound = None
 
 	# ---------------------
 	#   Packet core logic
 	# ---------------------
 
-	def _send_packet(self, packet: AbstractPacket):
-		if self._is_connected():
-			net_util.send_data(self.__sock, self._cryptor, packet)
-		else:
+	def _send_packet(self, packet: OutgoingPacket):
+		outbox = self.__outbox
+		if outbox is not None and outbox.accepts(packet):
+			with self.__outbox_lock:  # so it's not put after the outbox is taken by _on_started
+				if not self.is_online() or self.__outbound is None:
+					outbox.put(packet)
+					self.logger.debug('Kept packet in the outbox since the client is offline')
+					return
+		outbound, writer = self.__outbound, self.__writer
+		if not self._is_connected() or writer is None:
 			self.logger.warning('Trying to send a packet when not connected')
+		elif outbound is not None:
+			outbound.put(packet)
+		elif isinstance(packet, AbstractPacket) and not isinstance(packet, ChatBridgePacket):  # logging in
+			writer.write(packet)
+		else:  # sequence numbers are not ready yet
+			self.logger.warning('Trying to send a packet when not online')
+
+	@classmethod
+	def _is_packet_kept(cls, packet: OutgoingPacket) -> bool:
+		"""
+		Packets that are still worth sending on the next connection, if they are not sent when the connection closes
+		"""
+		if isinstance(packet, SharedPacket):
+			packet = packet.packet
+		return isinstance(packet, ChatBridgePacket) and packet.type != PacketType.keep_alive
+
+	def _keep_unsent_packets(self, packets: List[OutgoingPacket]):
+		"""
+		Keep the packets not sent when the connection closed, to be sent first on the next connection, right after the resent ones
+		"""
+		if len(packets) > 0:
+			self.logger.info('Keeping {} packets not sent before the connection closed'.format(len(packets)))
+			with self.__outbox_lock:
+				self.__unsent.extend(packets)
+				del self.__unsent[:-self.RESEND_BUFFER_SIZE]
+
+	@classmethod
+	def _is_packet_droppable(cls, packet: OutgoingPacket) -> bool:
+		"""
+		Packets that can be dropped when the receiver is slow
+		"""
+		if isinstance(packet, SharedPacket):
+			packet = packet.packet
+		return isinstance(packet, ChatBridgePacket) and packet.type == PacketType.chat
+
+	def get_outbound_queue_depth(self) -> int:
+		outbound = self.__outbound
+		return outbound.depth if outbound is not None else 0
+
+	def get_dropped_packet_count(self) -> int:
+		"""
+		Amount of packets dropped by the outbound queue of the current connection
+		"""
+		outbound = self.__outbound
+		return outbound.dropped_count if outbound is not None else 0
 
 	T = TypeVar('T')
 
 	def _receive_packet(self, packet_type: Type[T]) -> T:
-		data_string = net_util.receive_data(self.__sock, self._cryptor, timeout=self.TIMEOUT)
+		return self._decode_packet(self.__reader.read_frame(timeout=self.TIMEOUT), packet_type)
+
+	def _decode_packet(self, frame: bytes, packet_type: Type[T]) -> T:
+		if packet_type is ChatBridgePacket:  # the payload might be decoded lazily
+			try:
+				return self.__session.decode_chatbridge_packet(frame)
+			except ValueError:
+				self.logger.exception('Fail to decode received frame with length {}'.format(len(frame)))
+				raise
 		try:
-			js_dict = json.loads(data_string)
+			js_dict = self.__session.decode_packet(frame)
 		except ValueError:
-			self.logger.exception('Fail to decode received string: {}'.format(data_string))
+			self.logger.exception('Fail to decode received frame with length {}'.format(len(frame)))
 			raise
 		if packet_type is dict:
 			return js_dict
@@ -292,15 +514,23 @@ class ChatBridgeClient(ChatBridgeBase):
 		elif packet.type == PacketType.chat:
 			self.on_chat(packet.sender, ChatPayload.deserialize(packet.payload))
 		elif packet.type == PacketType.command:
-			self.on_command(packet.sender, CommandPayload.deserialize(packet.payload))
+			payload = CommandPayload.deserialize(packet.payload)
+			if payload.responded:
+				self.__on_command_reply(packet.sender, payload)
+			self.on_command(packet.sender, payload)
 		elif packet.type == PacketType.custom:
 			self.on_custom(packet.sender, CustomPayload.deserialize(packet.payload))
+		elif packet.type == PacketType.command_receipt:
+			self.__on_command_receipt(CommandReceiptPayload.deserialize(packet.payload))
+		elif packet.type == PacketType.command_aggregate:
+			for sender, reply in self.__on_command_aggregate(CommandAggregatePayload.deserialize(packet.payload)).items():
+				self.on_command(sender, reply)
 
 	def _on_keep_alive(self, sender: str, payload: KeepAlivePayload):
 		if payload.is_ping():
 			self.send_to(PacketType.keep_alive, sender, KeepAlivePayload.pong())
 		elif payload.is_pong():
-			self.__keep_alive_received.set()
+			self.__on_keep_alive_pong()
 		else:
 			self.logger.warning('Unknown keep alive type: {}'.format(payload.ping_type))
 
@@ -308,6 +538,9 @@ class ChatBridgeClient(ChatBridgeBase):
 		pass
 
 	def on_command(self, sender: str, payload: CommandPayload):
+		"""
+		Called for received commands, and for replies too, including the ones resolving the futures of the commands sent
+		"""
 		pass
 
 	def on_custom(self, sender: str, payload: CustomPayload):
@@ -326,13 +559,30 @@ class ChatBridgeClient(ChatBridgeBase):
 	def broadcast_chat(self, message: str, author: str = ''):
 		self.send_to_all(PacketType.chat, ChatPayload(author=author, message=message))
 
-	def send_command(self, target: str, command: str, params: Optional[Union[Serializable, dict]] = None):
-		self.send_to(PacketType.command, target, CommandPayload.ask(command, params))
-  
-	def broadcast_command(self,command: str, params: Optional[Union[Serializable, dict]] = None):
-		self.send_to_all(PacketType.command, CommandPayload.ask(command, params))
+	def send_command(self, target: str, command: str, params: Optional[Union[Serializable, SlotSerializable, dict]] = None, *, timeout: Optional[float] = None) -> 'futures.Future[CommandPayload]':
+		"""
+		:param timeout: Seconds to wait for the reply, default COMMAND_TIMEOUT. It starts now, so it includes the time the command waits in the outbox while offline
+		:return: The future of the reply. It fails with :class:`concurrent.futures.TimeoutError` if the target doesn't reply in time
+		"""
+		payload = CommandPayload.ask(command, params)
+		future = self.__track_command(payload.cid, broadcast=False, timeout=timeout)
+		self.send_to(PacketType.command, target, payload)
+		return future
+
+	def broadcast_command(self, command: str, params: Optional[Union[Serializable, SlotSerializable, dict]] = None, *, timeout: Optional[float] = None) -> 'futures.Future[Dict[str, CommandPayload]]':
+		"""
+		:param timeout: Seconds to wait for the replies, default COMMAND_TIMEOUT. It starts now, so it includes the time the command waits in the outbox while offline
+		:return: The future of the replies, as a dict from the client names to their replies.
+		It's done once all clients that the command reached have replied, if the server tells them (see ProtocolFeature.command_receipt),
+		or when the server sends the merged replies (see ProtocolFeature.command_aggregate),
+		otherwise after the timeout, with the replies received so far
+		"""
+		payload = CommandPayload.ask(command, params)
+		future = self.__track_command(payload.cid, broadcast=True, timeout=timeout)
+		self.send_to_all(PacketType.command, payload)
+		return future
 
-	def reply_command(self, target: str, asker_payload: 'CommandPayload', result: Union[Serializable, dict]):
+	def reply_command(self, target: str, asker_payload: 'CommandPayload', result: Union[Serializable, SlotSerializable, dict]):
 		self.send_to(PacketType.command, target, CommandPayload.answer(asker_payload, result))
 
 	def send_custom(self, target: str, data: dict):
@@ -341,47 +591,149 @@ class ChatBridgeClient(ChatBridgeBase):
 	def broadcast_custom(self, data: dict):
 		self.send_to_all(PacketType.chat, CustomPayload(data=data))
 
+	# ----------------
+	#   Command Impl
+	# ----------------
+	# Commands sent are kept by cid until all replies arrive or the timeout timer fires.
+	# Futures are completed outside the lock, since their callbacks are invoked right away
+
+	def get_pending_command_count(self) -> int:
+		return len(self.__commands)
+
+	def __track_command(self, cid: str, *, broadcast: bool, timeout: Optional[float]) -> futures.Future:
+		command = _PendingCommand(broadcast)
+		with self.__commands_lock:
+			self.__commands[cid] = command
+			command.timer = get_scheduler().call_later(timeout if timeout is not None else self.COMMAND_TIMEOUT, self.__on_command_timeout, cid)
+		command.future.add_done_callback(lambda _: self.__forget_command(cid))  # e.g. cancelled by the caller
+		return command.future
+
+	def __forget_command(self, cid: str) -> Optional[_PendingCommand]:
+		with self.__commands_lock:
+			command = self.__commands.pop(cid, None)
+		if command is not None:
+			command.timer.cancel()
+		return command
+
+	def __complete_command(self, cid: str):
+		command = self.__forget_command(cid)
+		if command is not None and command.future.set_running_or_notify_cancel():
+			command.future.set_result(command.replies if command.broadcast else next(iter(command.replies.values())))
+
+	def __on_command_reply(self, sender: str, payload: CommandPayload):
+		with self.__commands_lock:
+			command = self.__commands.get(payload.cid)
+			if command is None:
+				return
+			command.replies[sender] = payload
+			complete = command.is_complete()
+		if complete:
+			self.__complete_command(payload.cid)
+
+	def __on_command_receipt(self, payload: CommandReceiptPayload):
+		with self.__commands_lock:
+			command = self.__commands.get(payload.cid)
+			if command is None:
+				return
+			command.receivers = set(payload.receivers)
+			complete = command.is_complete()
+		if complete:
+			self.__complete_command(payload.cid)
+
+	def __on_command_aggregate(self, payload: CommandAggregatePayload) -> Dict[str, CommandPayload]:
+		replies = payload.get_replies()
+		with self.__commands_lock:
+			command = self.__commands.get(payload.cid)
+			if command is None:
+				return replies
+			command.replies.update(replies)
+		self.__complete_command(payload.cid)  # the missing ones are not going to reply
+		return replies
+
+	def __on_command_timeout(self, cid: str):
+		command = self.__forget_command(cid)
+		if command is None or not command.future.set_running_or_notify_cancel():
+			return
+		if command.broadcast:
+			command.future.set_result(command.replies)
+		else:
+			command.future.set_exception(futures.TimeoutError('No reply for command {}'.format(cid)))
+
 	# -------------------
 	#   Keep Alive Impl
 	# -------------------
-
-	def _get_keep_alive_thread_name(self):
-		return 'KeepAlive'
-
-	def _start_keep_alive_thread(self) -> Thread:
-		return self._start_thread(self._keep_alive_loop, self._get_keep_alive_thread_name())
+	# Pings and their timeouts are timers of the shared scheduler instead of a thread per connection.
+	# Timers carry the epoch of the connection they are scheduled for, so a timer firing late is ignored
 
 	def _keep_alive_target(self) -> str:
 		return constants.SERVER_NAME
 
-	def _keep_alive_loop(self):
+	def __start_keep_alive(self):
+		with self.__keep_alive_lock:
+			self.__keep_alive_epoch += 1
+			self.__keep_alive_sent = None
+			self.__keep_alive_timer = get_scheduler().call_later(random.random(), self.__keep_alive_ping, self.__keep_alive_epoch)
+
+	def __stop_keep_alive(self):
+		with self.__keep_alive_lock:
+			self.__keep_alive_epoch += 1
+			self.__keep_alive_sent = None
+			if self.__keep_alive_timer is not None:
+				self.__keep_alive_timer.cancel()
+				self.__keep_alive_timer = None
+
+	def __keep_alive_ping(self, epoch: int):
+		with self.__keep_alive_lock:
+			if epoch != self.__keep_alive_epoch or not self.is_online():
+				return
+			self.__keep_alive_sent = time.monotonic()
+			self.__keep_alive_timer = get_scheduler().call_later(self.KEEP_ALIVE_TIMEOUT, self.__keep_alive_timeout, epoch)
+		try:
+			self._send_keep_alive_ping()
+		except:
+			self.logger.exception('Disconnect due to keep-alive ping error')
+			self.__disconnect()
+
+	def __on_keep_alive_pong(self):
+		with self.__keep_alive_lock:
+			if self.__keep_alive_sent is None:  # not waiting for a pong
+				return
+			ping = time.monotonic() - self.__keep_alive_sent
+			self.__keep_alive_sent = None
+			self.__keep_alive_timer.cancel()
+			self.__keep_alive_timer = get_scheduler().call_later(self.KEEP_ALIVE_INTERVAL, self.__keep_alive_ping, self.__keep_alive_epoch)
+		self.__ping_array.append(ping)
+		if len(self.__ping_array) > 5:
+			self.__ping_array.pop(0)
+		self.logger.debug('Keep-alive responded, ping = {}ms'.format(round(self.ping * 1000, 2)))
+
+	def __keep_alive_timeout(self, epoch: int):
+		with self.__keep_alive_lock:
+			if epoch != self.__keep_alive_epoch or self.__keep_alive_sent is None:
+				return
+			self.__keep_alive_sent = None
+			self.__keep_alive_timer = None
+		if self.is_online():
+			self.logger.warning('Disconnect due to keep-alive ping timeout')
+			self.__disconnect()
+
+	# ---------------
+	#   Writer Impl
+	# ---------------
+
+	def _get_writer_thread_name(self):
+		return 'Writer'
+
+	def _start_writer_thread(self, outbound: net_util.OutboundQueue) -> Thread:
+		return self._start_thread(lambda: self.__writer_loop(outbound), self._get_writer_thread_name())
+
+	def __writer_loop(self, outbound: net_util.OutboundQueue):
 		"""
-		Except to have the same life-span as the connection
+		Drain the outbound queue of the current connection
 		"""
-		while self.is_online():
-			time.sleep(random.random())
-			if not self.is_online():
-				break
-			self.__keep_alive_received.clear()
-			time_sent = time.monotonic()
-			try:
-				self._send_keep_alive_ping()
-			except:
-				self.logger.exception('Disconnect due to keep-alive ping error')
-				self.__disconnect()
-				continue
-			self.__keep_alive_received.wait(self.KEEP_ALIVE_TIMEOUT)
-			if not self.is_online():
-				break
-			if self.__keep_alive_received.is_set():
-				self.__ping_array.append(time.monotonic() - time_sent)
-				if len(self.__ping_array) > 5:
-					self.__ping_array.pop(0)
-				self.logger.debug('Keep-alive responded, ping = {}ms'.format(round(self.ping * 1000, 2)))
-			else:
-				self.logger.warning('Disconnect due to keep-alive ping timeout')
+		try:
+			outbound.run()
+		except Exception as e:
+			if self.is_online():
+				self.logger.warning('Disconnect due to outbound error: {}'.format(e))
 				self.__disconnect()
-			for i in range(self.KEEP_ALIVE_INTERVAL * 10):
-				time.sleep(0.1)
-				if not self.is_online():
-					break
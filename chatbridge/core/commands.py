@@ -0,0 +1,227 @@
+import json
+import time
+from threading import Lock
+from typing import Callable, Dict, List, Set, Tuple, Optional
+
+from chatbridge.common.scheduler import get_scheduler, TimerHandle
+from chatbridge.core.network.protocol import CommandPayload, CommandAggregatePayload
+
+
+class _Aggregation:
+	__slots__ = ('asker', 'payload', 'pending', 'results', 'timer')
+
+	def __init__(self, asker: str, payload: CommandPayload, receivers: List[str]):
+		self.asker = asker
+		self.payload = payload
+		self.pending: Set[str] = set(receivers)
+		self.results: Dict[str, dict] = {}  # replier -> result
+		self.timer: Optional[TimerHandle] = None
+
+	def to_payload(self) -> CommandAggregatePayload:
+		return CommandAggregatePayload(
+			cid=self.payload.cid,
+			command=self.payload.command,
+			params=self.payload.params,
+			results=self.results,
+			missing=sorted(self.pending),
+		)
+
+
+class CommandAggregator:
+	"""
+	Server side. Merges the replies of broadcast commands into a single packet for the asker, see ProtocolFeature.command_aggregate
+
+	The replies are held back instead of forwarded, and the merged payload is sent once the last receiver replies,
+	or at the deadline with the replies received so far
+	"""
+
+	def __init__(self, timeout: float, send: Callable[[str, CommandAggregatePayload], None]):
+		"""
+		:param timeout: Seconds to wait for the replies. It should be shorter than the timeout of the askers
+		:param send: Called with the asker name and the merged payload, in the thread of the last reply or the timer thread
+		"""
+		self.timeout = timeout
+		self.merged_count = 0  # replies merged instead of forwarded
+		self.timed_out_count = 0  # commands with receivers not replied before the deadline
+		self.__send = send
+		self.__lock = Lock()
+		self.__aggregations: Dict[Tuple[str, str], _Aggregation] = {}  # (asker, cid) -> aggregation
+
+	def __len__(self) -> int:
+		return len(self.__aggregations)
+
+	def track(self, asker: str, payload: CommandPayload, receivers: List[str]):
+		"""
+		Start collecting the replies of the command being forwarded to the receivers
+		"""
+		aggregation = _Aggregation(asker, payload, receivers)
+		if len(receivers) == 0:
+			self.__send(asker, aggregation.to_payload())
+			return
+		key = (asker, payload.cid)
+		with self.__lock:
+			self.__aggregations[key] = aggregation
+			aggregation.timer = get_scheduler().call_later(self.timeout, self.__on_timeout, key)
+
+	def on_reply(self, sender: str, asker: str, payload: CommandPayload) -> bool:
+		"""
+		:return: If the reply is merged, so it shouldn't be forwarded
+		"""
+		key = (asker, payload.cid)
+		with self.__lock:
+			aggregation = self.__aggregations.get(key)
+			if aggregation is None or sender not in aggregation.pending:
+				return False
+			aggregation.pending.remove(sender)
+			aggregation.results[sender] = payload.result
+			self.merged_count += 1
+			if len(aggregation.pending) > 0:
+				return True
+			del self.__aggregations[key]
+		aggregation.timer.cancel()
+		self.__send(asker, aggregation.to_payload())
+		return True
+
+	def clear(self):
+		"""
+		Drop all commands without sending anything, e.g. when the server stops
+		"""
+		with self.__lock:
+			aggregations = list(self.__aggregations.values())
+			self.__aggregations.clear()
+		for aggregation in aggregations:
+			aggregation.timer.cancel()
+
+	def __on_timeout(self, key: Tuple[str, str]):
+		with self.__lock:
+			aggregation = self.__aggregations.pop(key, None)
+			if aggregation is None:
+				return
+			self.timed_out_count += 1
+		self.__send(aggregation.asker, aggregation.to_payload())
+
+
+class _Flight:
+	__slots__ = ('key', 'target', 'leader', 'followers', 'timer')
+
+	def __init__(self, key: tuple, target: str, leader: Tuple[str, str]):
+		self.key = key
+		self.target = target
+		self.leader = leader  # (asker, cid) of the command forwarded
+		self.followers: List[Tuple[str, CommandPayload]] = []  # (asker, command) waiting for the same reply
+		self.timer: Optional[TimerHandle] = None
+
+
+class CommandCoalescer:
+	"""
+	Server side. Identical commands in flight to the same client are forwarded once, and the reply is sent to every asker,
+	with the cid and params of their own command. Commands are identical if the target, the command and the params are the same,
+	except ROUTING_PARAMS that askers keep for themselves, e.g. the channel that the command comes from
+
+	With a result ttl, replies are also reused for identical commands within the ttl after they arrive.
+	If the reply doesn't arrive in time, the commands waiting for it are forwarded to the target on their own
+	"""
+	ROUTING_PARAMS = ('from_channel',)
+
+	def __init__(self, timeout: float, result_ttl: float, send: Callable[[str, str, CommandPayload], None]):
+		"""
+		:param timeout: Seconds to wait for the reply, after which the waiting commands and identical ones are forwarded
+		:param result_ttl: Seconds to reuse replies, 0 to disable
+		:param send: Called with the sender, the receiver and the payload, for the replies to askers whose commands are not forwarded,
+		and for the commands forwarded late since the reply timed out
+		"""
+		self.timeout = timeout
+		self.result_ttl = result_ttl
+		self.hit_count = 0  # commands not forwarded at first, i.e. answered or waiting for an identical command
+		self.miss_count = 0
+		self.timed_out_count = 0  # commands forwarded late, since the reply they waited for timed out
+		self.__send = send
+		self.__lock = Lock()
+		self.__flights: Dict[tuple, _Flight] = {}  # key -> command in flight
+		self.__leaders: Dict[Tuple[str, str], _Flight] = {}  # (asker, cid) -> command in flight
+		self.__results: Dict[tuple, Tuple[float, dict]] = {}  # key -> (expiry time, result)
+
+	def __str__(self):
+		return 'hits = {}, misses = {}, timed out = {}, in flight = {}, cached = {}'.format(self.hit_count, self.miss_count, self.timed_out_count, len(self.__flights), len(self.__results))
+
+	def __len__(self) -> int:
+		return len(self.__flights)
+
+	@classmethod
+	def __make_key(cls, target: str, payload: CommandPayload) -> Optional[tuple]:
+		try:
+			params = json.dumps({k: v for k, v in payload.params.items() if k not in cls.ROUTING_PARAMS}, sort_keys=True)
+		except (TypeError, ValueError, AttributeError):
+			return None
+		return target, payload.command, params
+
+	def on_command(self, asker: str, target: str, payload: CommandPayload) -> bool:
+		"""
+		:return: If the command should be forwarded, i.e. it's not answered by or waiting for another identical command
+		"""
+		key = self.__make_key(target, payload)
+		if key is None:
+			return True
+		now = time.monotonic()
+		with self.__lock:
+			cached = self.__results.get(key)
+			if cached is not None and cached[0] <= now:
+				del self.__results[key]
+				cached = None
+			if cached is None:
+				flight = self.__flights.get(key)
+				if flight is None:
+					self.miss_count += 1
+					flight = _Flight(key, target, (asker, payload.cid))
+					self.__flights[key] = self.__leaders[flight.leader] = flight
+					flight.timer = get_scheduler().call_later(self.timeout, self.__on_timeout, flight)
+					return True
+				flight.followers.append((asker, payload))
+			self.hit_count += 1
+		if cached is not None:
+			self.__send(target, asker, CommandPayload.answer(payload, cached[1]))
+		return False
+
+	def on_reply(self, sender: str, asker: str, payload: CommandPayload):
+		"""
+		Send the reply to the askers waiting for it too. The reply itself is forwarded to its asker as usual
+		"""
+		with self.__lock:
+			flight = self.__leaders.get((asker, payload.cid))
+			if flight is None or flight.target != sender:
+				return
+			self.__remove(flight)
+			if self.result_ttl > 0:
+				self.__results[flight.key] = (time.monotonic() + self.result_ttl, payload.result)
+				self.__prune_results()
+		flight.timer.cancel()
+		for follower, command in flight.followers:
+			self.__send(sender, follower, CommandPayload.answer(command, payload.result))
+
+	def clear(self):
+		with self.__lock:
+			flights = list(self.__flights.values())
+			self.__flights.clear()
+			self.__leaders.clear()
+			self.__results.clear()
+		for flight in flights:
+			flight.timer.cancel()
+
+	def __remove(self, flight: _Flight):
+		if self.__flights.get(flight.key) is flight:
+			del self.__flights[flight.key]
+		self.__leaders.pop(flight.leader, None)
+
+	def __prune_results(self):
+		now = time.monotonic()
+		for key in [key for key, (expiry, _) in self.__results.items() if expiry <= now]:
+			del self.__results[key]
+
+	def __on_timeout(self, flight: _Flight):
+		with self.__lock:
+			if self.__leaders.get(flight.leader) is not flight:  # replied or cleared
+				return
+			self.__remove(flight)
+			self.timed_out_count += len(flight.followers)
+		for follower, command in flight.followers:
+			self.__send(follower, flight.target, command)
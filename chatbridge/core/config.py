@@ -4,11 +4,24 @@ from typing import List
 from mcdreforged.utils.serializer import Serializable
 
 from chatbridge.common.serializer import NoMissingFieldSerializable
+from chatbridge.core.network import net_util
 from chatbridge.core.network.basic import Address
 
 
 class BasicConfig(Serializable, ABC):
 	aes_key: str = 'ThisIstheSecret'
+	max_frame_size: int = net_util.DEFAULT_MAX_FRAME_SIZE  # in bytes, larger frames are rejected
+	# compress frames when both sides enable it. Messages of different clients share the compression history of a connection,
+	# so compressed frame lengths leak information across them. Only enable it if all clients are trusted
+	enable_compression: bool = False
+	# seconds to wait for more outgoing packets before sending them together. Senders wait for it too
+	send_flush_delay: float = 0.0
+	# outgoing packets wait in a queue of each connection. When the receiver is slow and the queue is over the high-water mark,
+	# the oldest chat packets are dropped, and the connection is closed if it stays over the mark for slow_consumer_timeout seconds
+	outbound_queue_size: int = 1024
+	outbound_high_water: int = 256
+	drop_oldest_chat: bool = True
+	slow_consumer_timeout: float = 30
 
 
 class ClientInfo(NoMissingFieldSerializable):
@@ -21,6 +34,10 @@ class ClientConfig(BasicConfig):
 	password: str = 'MyClientPassword'
 	server_hostname: str = '127.0.0.1'
 	server_port: int = 30001
+	# chat and command packets sent while offline are kept in an outbox, and sent once online again. 0 to disable
+	outbox_size: int = 256
+	outbox_max_age: float = 300  # seconds, older packets in the outbox are discarded. 0 for no limit
+	outbox_file: str = ''  # keep the outbox in this file too, so it survives restarts. Empty for memory only
 
 	@property
 	def client_info(self) -> ClientInfo:
@@ -34,6 +51,19 @@ class ClientConfig(BasicConfig):
 class ServerConfig(BasicConfig):
 	hostname: str = 'localhost'
 	port: int = 30001
+	# "thread": threads for each connection. "asyncio": a single event loop thread for all connections, for lots of clients
+	engine: str = 'thread'
+	# packets for offline clients are queued, and sent once they are online again.
+	# The oldest packets are dropped when a queue is over the size limits. 0 size to disable
+	offline_queue_size: int = 256
+	offline_queue_bytes: int = 1024 * 1024
+	offline_queue_ttl: float = 600  # seconds, older queued packets are discarded. 0 for no limit
+	# merge the replies of broadcast commands into a single packet for the asker, sent when all replies arrive or at the timeout
+	aggregate_commands: bool = False
+	command_aggregate_timeout: float = 3  # seconds, shorter than the command timeout of the askers
+	# forward identical commands in flight to the same client only once, and send the reply to all askers
+	coalesce_commands: bool = False
+	command_result_ttl: float = 0  # seconds to reuse replies for identical commands afterwards, 0 to disable
 	clients: List[ClientInfo] = [
 		ClientInfo(name='MyClientName', password='MyClientPassword')
 	]
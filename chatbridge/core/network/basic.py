@@ -1,8 +1,13 @@
 from threading import Thread, current_thread, RLock
-from typing import NamedTuple, Callable, Optional
+from typing import NamedTuple, Callable, Optional, TYPE_CHECKING
 
 from chatbridge.common.logger import ChatBridgeLogger
+from chatbridge.core.network import net_util
 from chatbridge.core.network.cryptor import AESCryptor
+from chatbridge.core.network.session import NetworkSession
+
+if TYPE_CHECKING:
+	from chatbridge.core.config import BasicConfig
 
 
 class Address(NamedTuple):
@@ -14,12 +19,21 @@ class Address(NamedTuple):
 
 
 class ChatBridgeBase:
+	MAX_FRAME_SIZE = net_util.DEFAULT_MAX_FRAME_SIZE
+	ENABLE_COMPRESSION = False
+	SEND_FLUSH_DELAY = 0.0
+	OUTBOUND_QUEUE_POLICY = net_util.OutboundQueuePolicy()
+
 	def __init__(self, name: str, aes_key: str):
 		super().__init__()
 		self.__name = name
 		self.logger = ChatBridgeLogger(self.get_logging_name(), file_name=self.get_logging_file_name())
 		self.aes_key = aes_key
 		self._cryptor = AESCryptor(aes_key)
+		self.max_frame_size = self.MAX_FRAME_SIZE
+		self.enable_compression = self.ENABLE_COMPRESSION
+		self.send_flush_delay = self.SEND_FLUSH_DELAY
+		self.outbound_queue_policy = self.OUTBOUND_QUEUE_POLICY
 		self.__thread_run: Optional[Thread] = None
 		self.__thread_run_lock = RLock()
 
@@ -35,6 +49,23 @@ class ChatBridgeBase:
 		"""
 		return type(self).__name__
 
+	def apply_network_config(self, config: 'BasicConfig'):
+		"""
+		Apply the network options in the config. They take effect from the next connection
+		"""
+		self.max_frame_size = config.max_frame_size
+		self.enable_compression = config.enable_compression
+		self.send_flush_delay = config.send_flush_delay
+		self.outbound_queue_policy = net_util.OutboundQueuePolicy(
+			max_size=config.outbound_queue_size,
+			high_water=config.outbound_high_water,
+			drop_oldest_chat=config.drop_oldest_chat,
+			slow_consumer_timeout=config.slow_consumer_timeout,
+		)
+
+	def _create_session(self) -> NetworkSession:
+		return NetworkSession(self._cryptor, max_message_size=self.max_frame_size, compression=self.enable_compression)
+
 	def _start_thread(self, target: Callable, name: str) -> Thread:
 		thread = Thread(target=target, args=(), name=name, daemon=True)
 		thread.start()
@@ -50,6 +81,7 @@ class ChatBridgeBase:
 			self.logger.close_file()
 			with self.__thread_run_lock:
 				self.__thread_run = None
+			self._on_main_loop_exited()
 
 		with self.__thread_run_lock:
 			if self.__thread_run is not None:
@@ -73,3 +105,9 @@ class ChatBridgeBase:
 
 	def _main_loop(self):
 		pass
+
+	def _on_main_loop_exited(self):
+		"""
+		Called in the MainLoop thread at last, when it can be started again
+		"""
+		pass
@@ -0,0 +1,309 @@
+import json
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, Tuple, Iterable, List, Any, Optional, get_type_hints
+
+from chatbridge.core.network.protocol import AbstractPacket, ChatBridgePacket, PacketType, ProtocolFeature, \
+	KeepAlivePayload, ChatPayload, CommandPayload, CustomPayload
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+
+_ENVELOPE_HEADER_SIZE = struct.Struct('<I')
+
+
+class EnvelopePacket(ChatBridgePacket):
+	"""
+	A ChatBridgePacket decoded from a routing envelope
+
+	Only the routing header is decoded, the payload is decoded on first access.
+	The encoded envelope is kept, so it can be forwarded as-is to peers using the same codec,
+	until the payload is replaced
+	"""
+	__slots__ = ('codec', 'envelope', '_payload_data')
+
+	@classmethod
+	def create(cls, codec: 'PacketCodec', envelope: bytes, header: dict, payload_data: bytes) -> 'EnvelopePacket':
+		packet: EnvelopePacket = cls.deserialize({**header, 'payload': {}})
+		packet.codec = codec
+		packet.envelope = envelope
+		packet._payload_data = payload_data
+		return packet
+
+	@property
+	def payload(self) -> dict:
+		"""
+		:raise ValueError: if the payload cannot be decoded
+		"""
+		if self._payload_data is not None:
+			payload = self.codec.decode_payload(self.type, self._payload_data)
+			if not isinstance(payload, dict):
+				raise ValueError('Bad payload {}'.format(payload))
+			_PAYLOAD_SLOT.__set__(self, payload)
+			self._payload_data = None
+		return _PAYLOAD_SLOT.__get__(self, ChatBridgePacket)
+
+	@payload.setter
+	def payload(self, value: dict):
+		_PAYLOAD_SLOT.__set__(self, value)
+		self._payload_data = None
+		self.codec = None  # the envelope doesn't match anymore
+
+
+
+_PAYLOAD_SLOT = ChatBridgePacket.__dict__['payload']
+
+
+class PacketCodec(ABC):
+	"""
+	Converts between packets and the bytes to be sealed into frames
+
+	With the routing envelope, a ChatBridgePacket is encoded as the size of the routing header,
+	the routing header (sender, receivers, broadcast, type), and the payload
+	"""
+	@classmethod
+	def is_available(cls) -> bool:
+		return True
+
+	@abstractmethod
+	def encode(self, packet: AbstractPacket) -> bytes:
+		raise NotImplementedError()
+
+	@abstractmethod
+	def decode(self, data: bytes) -> dict:
+		"""
+		:return: The serialized packet dict
+		:raise ValueError: if the data cannot be decoded
+		"""
+		raise NotImplementedError()
+
+	@abstractmethod
+	def _encode_header(self, packet: ChatBridgePacket) -> bytes:
+		raise NotImplementedError()
+
+	@abstractmethod
+	def _decode_header(self, data: bytes) -> dict:
+		raise NotImplementedError()
+
+	@abstractmethod
+	def _encode_payload(self, type_: str, payload: dict) -> bytes:
+		raise NotImplementedError()
+
+	@abstractmethod
+	def decode_payload(self, type_: str, data: bytes) -> Any:
+		"""
+		:raise ValueError: if the data cannot be decoded
+		"""
+		raise NotImplementedError()
+
+	def encode_envelope(self, packet: ChatBridgePacket) -> bytes:
+		if isinstance(packet, EnvelopePacket) and packet.codec is self:
+			return packet.envelope
+		header = self._encode_header(packet)
+		return _ENVELOPE_HEADER_SIZE.pack(len(header)) + header + self._encode_payload(packet.type, packet.payload)
+
+	def decode_envelope(self, data: bytes) -> EnvelopePacket:
+		"""
+		:raise ValueError: if the routing header cannot be decoded
+		"""
+		if len(data) < _ENVELOPE_HEADER_SIZE.size:
+			raise ValueError('Envelope too short: {}'.format(len(data)))
+		header_end = _ENVELOPE_HEADER_SIZE.size + _ENVELOPE_HEADER_SIZE.unpack_from(data)[0]
+		if header_end > len(data):
+			raise ValueError('Bad envelope header size {}'.format(header_end))
+		header = self._decode_header(data[_ENVELOPE_HEADER_SIZE.size:header_end])
+		if not isinstance(header, dict):
+			raise ValueError('Bad envelope header {}'.format(header))
+		try:
+			return EnvelopePacket.create(self, data, header, data[header_end:])
+		except TypeError as e:
+			raise ValueError('Bad envelope header {}: {}'.format(header, e)) from None
+
+
+class JsonCodec(PacketCodec):
+	"""
+	The basic codec
+	"""
+	def encode(self, packet: AbstractPacket) -> bytes:
+		return json.dumps(packet.serialize(), ensure_ascii=False).encode('utf8')
+
+	def decode(self, data: bytes) -> dict:
+		return json.loads(data)
+
+	def _encode_header(self, packet: ChatBridgePacket) -> bytes:
+		return json.dumps([packet.sender, packet.receivers, packet.broadcast, packet.type], ensure_ascii=False).encode('utf8')
+
+	def _decode_header(self, data: bytes) -> dict:
+		try:
+			sender, receivers, broadcast, type_ = json.loads(data)
+		except TypeError:
+			raise ValueError('Bad envelope header') from None
+		return {'sender': sender, 'receivers': receivers, 'broadcast': broadcast, 'type': type_}
+
+	def _encode_payload(self, type_: str, payload: dict) -> bytes:
+		return json.dumps(payload, ensure_ascii=False).encode('utf8')
+
+	def decode_payload(self, type_: str, data: bytes) -> Any:
+		return json.loads(data)
+
+
+def _get_fields(payload_class: type) -> Tuple[str, ...]:
+	return tuple(name for name in get_type_hints(payload_class).keys() if not name.startswith('_'))
+
+
+def _to_json_key(key: Any) -> Any:
+	"""
+	Convert a map key in the same way as json.dumps does
+	"""
+	if isinstance(key, str):
+		return key
+	if key is True:
+		return 'true'
+	if key is False:
+		return 'false'
+	if key is None:
+		return 'null'
+	if isinstance(key, (int, float)):
+		return json.dumps(key)
+	return key
+
+
+def _json_keys_hook(pairs: List[tuple]) -> dict:
+	return {_to_json_key(key): value for key, value in pairs}
+
+
+class MsgpackCodec(PacketCodec):
+	"""
+	A compact binary codec based on msgpack
+
+	A ChatBridgePacket is encoded as an array [type, sender, receivers, broadcast, payload] instead of a map.
+	Standard packet types are encoded as integer tags, and their payloads are encoded as arrays of field values,
+	unless the payload doesn't have exactly the standard fields.
+	Other packets are encoded as maps
+
+	Decoded values are the same as what the json codec gives: non-str map keys are converted into str,
+	and packets msgpack cannot represent, e.g. with integers out of 64 bits, are sent as json in an ext object
+	"""
+	EXT_JSON = 0
+	TYPE_TAGS: Dict[str, int] = {
+		PacketType.keep_alive: 0,
+		PacketType.chat: 1,
+		PacketType.command: 2,
+		PacketType.custom: 3,
+	}
+	PAYLOAD_FIELDS: Dict[str, Tuple[str, ...]] = {
+		PacketType.keep_alive: _get_fields(KeepAlivePayload),
+		PacketType.chat: _get_fields(ChatPayload),
+		PacketType.command: _get_fields(CommandPayload),
+		PacketType.custom: _get_fields(CustomPayload),
+	}
+	TAG_TYPES: Dict[int, str] = {tag: type_ for type_, tag in TYPE_TAGS.items()}
+
+	@classmethod
+	def is_available(cls) -> bool:
+		return msgpack is not None
+
+	@classmethod
+	def __pack_payload(cls, type_: str, payload: dict):
+		fields = cls.PAYLOAD_FIELDS.get(type_)
+		if fields is not None and len(payload) == len(fields) and all(field in payload for field in fields):
+			return [payload[field] for field in fields]
+		return payload
+
+	def encode(self, packet: AbstractPacket) -> bytes:
+		if isinstance(packet, ChatBridgePacket):
+			obj = [
+				self.TYPE_TAGS.get(packet.type, packet.type),
+				packet.sender,
+				packet.receivers,
+				packet.broadcast,
+				self.__pack_payload(packet.type, packet.payload),
+			]
+		else:
+			obj = packet.serialize()
+		try:
+			return msgpack.packb(obj, use_bin_type=True)
+		except OverflowError:
+			return msgpack.packb(msgpack.ExtType(self.EXT_JSON, JSON_CODEC.encode(packet)), use_bin_type=True)
+
+	def __ext_hook(self, code: int, data: bytes):
+		if code == self.EXT_JSON:
+			return JSON_CODEC.decode(data)
+		raise ValueError('Unknown msgpack ext type {}'.format(code))
+
+	def __unpack(self, data: bytes) -> Any:
+		try:
+			try:
+				return msgpack.unpackb(data, raw=False, ext_hook=self.__ext_hook)
+			except ValueError:  # non-str map keys, which json turns into str
+				return msgpack.unpackb(data, raw=False, ext_hook=self.__ext_hook, strict_map_key=False, object_pairs_hook=_json_keys_hook)
+		except Exception as e:
+			raise ValueError('Bad msgpack data: {}'.format(e)) from None
+
+	def __unpack_payload(self, type_: str, payload: Any) -> Any:
+		if isinstance(payload, list):
+			fields = self.PAYLOAD_FIELDS.get(type_)
+			if fields is None or len(fields) != len(payload):
+				raise ValueError('Bad payload array for type {}: {}'.format(type_, payload))
+			payload = dict(zip(fields, payload))
+		return payload
+
+	def __decode_type(self, type_: Any) -> Any:
+		if isinstance(type_, int):
+			type_ = self.TAG_TYPES.get(type_, type_)
+		return type_
+
+	def decode(self, data: bytes) -> dict:
+		obj = self.__unpack(data)
+		if isinstance(obj, dict):
+			return obj
+		try:
+			type_, sender, receivers, broadcast, payload = obj
+		except (TypeError, ValueError):
+			raise ValueError('Bad packet array: {}'.format(obj)) from None
+		type_ = self.__decode_type(type_)
+		payload = self.__unpack_payload(type_, payload)
+		return {
+			'sender': sender,
+			'receivers': receivers,
+			'broadcast': broadcast,
+			'type': type_,
+			'payload': payload,
+		}
+
+	def _encode_header(self, packet: ChatBridgePacket) -> bytes:
+		return msgpack.packb([self.TYPE_TAGS.get(packet.type, packet.type), packet.sender, packet.receivers, packet.broadcast], use_bin_type=True)
+
+	def _decode_header(self, data: bytes) -> dict:
+		try:
+			type_, sender, receivers, broadcast = self.__unpack(data)
+		except (TypeError, ValueError):
+			raise ValueError('Bad envelope header') from None
+		return {'sender': sender, 'receivers': receivers, 'broadcast': broadcast, 'type': self.__decode_type(type_)}
+
+	def _encode_payload(self, type_: str, payload: dict) -> bytes:
+		try:
+			return msgpack.packb(self.__pack_payload(type_, payload), use_bin_type=True)
+		except OverflowError:
+			return msgpack.packb(msgpack.ExtType(self.EXT_JSON, JSON_CODEC._encode_payload(type_, payload)), use_bin_type=True)
+
+	def decode_payload(self, type_: str, data: bytes) -> Any:
+		return self.__unpack_payload(type_, self.__unpack(data))
+
+
+JSON_CODEC = JsonCodec()
+# in order of preference
+CODECS: Dict[str, PacketCodec] = {
+	ProtocolFeature.codec_msgpack: MsgpackCodec(),
+}
+
+
+def select_codec(features: Iterable[str]) -> PacketCodec:
+	features = set(features)
+	for feature, codec in CODECS.items():
+		if feature in features and codec.is_available():
+			return codec
+	return JSON_CODEC
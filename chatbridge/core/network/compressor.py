@@ -0,0 +1,105 @@
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, Type, Optional
+
+from chatbridge.core.network.protocol import ProtocolFeature
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+class DecompressedTooLarge(ValueError):
+	pass
+
+
+class StreamCompressor(ABC):
+	"""
+	The compression context of a single connection
+
+	Compressed messages form a single stream in each direction, flushed at the end of each message,
+	so the history of previous messages makes small repetitive messages compress well too.
+	Messages need to be decompressed in the same order as they were compressed
+
+	Since compression happens before encryption, and the server forwards messages from all clients through
+	the stream of the receiver, the compressed length of a message reveals how much it shares with
+	messages from other clients (CRIME-like). That's why compression is disabled unless configured
+	"""
+	@classmethod
+	def is_available(cls) -> bool:
+		return True
+
+	@abstractmethod
+	def compress(self, data: bytes) -> bytes:
+		raise NotImplementedError()
+
+	@abstractmethod
+	def decompress(self, data: bytes, max_size: int) -> bytes:
+		"""
+		:raise DecompressedTooLarge: if the decompressed data exceeds max_size
+		"""
+		raise NotImplementedError()
+
+
+class ZlibStreamCompressor(StreamCompressor):
+	def __init__(self):
+		self.__compressor = zlib.compressobj()
+		self.__decompressor = zlib.decompressobj()
+
+	def compress(self, data: bytes) -> bytes:
+		return self.__compressor.compress(data) + self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+
+	def decompress(self, data: bytes, max_size: int) -> bytes:
+		result = self.__decompressor.decompress(data, max_size)
+		if self.__decompressor.unconsumed_tail:
+			raise DecompressedTooLarge('Decompressed data exceeds the limit {}'.format(max_size))
+		return result
+
+
+class ZstdStreamCompressor(StreamCompressor):
+	LEVEL = 3
+	# a zstd block holds at most 128KiB of output and takes at least 4 bytes of input
+	MAX_EXPANSION_RATIO = 128 * 1024 // 4
+
+	def __init__(self):
+		self.__compressor = zstandard.ZstdCompressor(level=self.LEVEL).compressobj()
+		self.__decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+	@classmethod
+	def is_available(cls) -> bool:
+		return zstandard is not None
+
+	def compress(self, data: bytes) -> bytes:
+		return self.__compressor.compress(data) + self.__compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+	def decompress(self, data: bytes, max_size: int) -> bytes:
+		# the decompressor has no output limit, so the input is fed in slices small enough
+		# that even the most compressible input cannot expand far beyond the remaining budget
+		view = memoryview(data)
+		chunks = []
+		size = 0
+		index = 0
+		while index < len(view):
+			step = max(1, (max_size - size) // self.MAX_EXPANSION_RATIO)
+			chunk = self.__decompressor.decompress(view[index:index + step])
+			index += step
+			size += len(chunk)
+			if size > max_size:
+				raise DecompressedTooLarge('Decompressed data exceeds the limit {}'.format(max_size))
+			chunks.append(chunk)
+		return b''.join(chunks)
+
+
+# in order of preference
+COMPRESSORS: Dict[str, Type[StreamCompressor]] = {
+	ProtocolFeature.compress_zstd: ZstdStreamCompressor,
+	ProtocolFeature.compress_zlib: ZlibStreamCompressor,
+}
+
+
+def create_compressor(feature: str) -> Optional[StreamCompressor]:
+	compressor_class = COMPRESSORS.get(feature)
+	if compressor_class is not None and compressor_class.is_available():
+		return compressor_class()
+	return None
@@ -1,38 +1,477 @@
-import json
+import os
 import socket
 import struct
+import time
+from threading import Lock, Condition, RLock
+from collections import deque
+from typing import List, Optional, Iterable, Callable, Deque, NamedTuple, Tuple, Any
 
-from chatbridge.core.network.cryptor import AESCryptor
-from chatbridge.core.network.protocol import AbstractPacket
+from chatbridge.core.network.session import NetworkSession, OutgoingPacket
 
 __all__ = [
-	'send_data',
-	'receive_data',
+	'FrameBuffer',
+	'FrameReader',
+	'FrameWriter',
+	'OutboundQueue',
+	'OutboundQueuePolicy',
+	'OfflineQueue',
+	'OfflineQueuePolicy',
+	'SlowConsumer',
 	'EmptyContent',
+	'FrameTooLarge',
+	'DEFAULT_MAX_FRAME_SIZE',
+	'frame_header',
+	'frame_size',
+	'FRAME_HEADER_SIZE',
 ]
 
-RECEIVE_BUFFER_SIZE = 1024
+RECEIVE_BUFFER_SIZE = 64 * 1024
+DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024  # 16MiB
+_HEADER = struct.Struct('I')
+FRAME_HEADER_SIZE = _HEADER.size
+try:
+	_IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+	_IOV_MAX = 16
 
 
 class EmptyContent(socket.error):
 	pass
 
 
-def send_data(sock: socket.socket, cryptor: AESCryptor, packet: AbstractPacket):
-	encrypted_data = cryptor.encrypt(json.dumps(packet.serialize(), ensure_ascii=False))
-	packet_data = struct.pack('I', len(encrypted_data)) + encrypted_data
-	sock.sendall(packet_data)
-
-
-def receive_data(sock: socket.socket, cryptor: AESCryptor, *, timeout: float) -> str:
-	sock.settimeout(timeout)
-	header = sock.recv(4)
-	if len(header) < 4:
-		raise EmptyContent('Empty content received')
-	remaining_data_length = struct.unpack('I', header)[0]
-	encrypted_data = bytes()
-	while remaining_data_length > 0:
-		buf = sock.recv(min(remaining_data_length, RECEIVE_BUFFER_SIZE))
-		encrypted_data += buf
-		remaining_data_length -= len(buf)
-	return cryptor.decrypt(encrypted_data)
+class FrameTooLarge(socket.error):
+	pass
+
+
+class SlowConsumer(socket.error):
+	pass
+
+
+def frame_header(frame: bytes) -> bytes:
+	"""
+	The length prefix to be sent before the frame
+	"""
+	return _HEADER.pack(len(frame))
+
+
+def frame_size(header: bytes) -> int:
+	"""
+	The size of the frame after the length prefix
+	"""
+	return _HEADER.unpack(header)[0]
+
+
+class FrameBuffer:
+	"""
+	The receive buffer of a connection, which splits the received data into length-prefixed frames
+
+	Data is received into the reusable buffer from :meth:`get_buffer` in large chunks,
+	so all complete frames within a single read can be handed out without extra syscalls
+	"""
+
+	def __init__(self, *, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, buffer_size: int = RECEIVE_BUFFER_SIZE):
+		self.max_frame_size = max_frame_size
+		self.__buffer_size = buffer_size
+		self.__buffer = bytearray(buffer_size)
+		self.__view = memoryview(self.__buffer)
+		self.__start = 0  # index of the first unconsumed byte
+		self.__end = 0  # index after the last received byte
+
+	def pop_frame(self) -> Optional[bytes]:
+		"""
+		:return: The next complete frame, or None if it's not fully received yet
+		:raise FrameTooLarge: if the size of the next frame exceeds the limit
+		"""
+		available = self.__end - self.__start
+		if available < _HEADER.size:
+			return None
+		frame_size = _HEADER.unpack_from(self.__buffer, self.__start)[0]
+		if frame_size > self.max_frame_size:
+			raise FrameTooLarge('Frame size {} exceeds the limit {}'.format(frame_size, self.max_frame_size))
+		if available < _HEADER.size + frame_size:
+			return None
+		frame_start = self.__start + _HEADER.size
+		frame = bytes(self.__view[frame_start:frame_start + frame_size])
+		self.__start = frame_start + frame_size
+		if self.__start == self.__end:
+			self.__start = self.__end = 0
+			if len(self.__buffer) > self.__buffer_size:  # shrink back after a large frame
+				self.__reset_buffer(self.__buffer_size)
+		return frame
+
+	def pop_frames(self) -> List[bytes]:
+		frames = []
+		frame = self.pop_frame()
+		while frame is not None:
+			frames.append(frame)
+			frame = self.pop_frame()
+		return frames
+
+	def __reset_buffer(self, size: int):
+		new_buffer = bytearray(size)
+		pending = self.__end - self.__start
+		new_buffer[:pending] = self.__view[self.__start:self.__end]
+		self.__view.release()
+		self.__buffer = new_buffer
+		self.__view = memoryview(self.__buffer)
+		self.__start, self.__end = 0, pending
+
+	def get_buffer(self) -> memoryview:
+		"""
+		The free space at the tail of the buffer to receive into, large enough for the incoming frame.
+		Call :meth:`buffer_updated` after receiving
+		"""
+		required = _HEADER.size
+		if self.__end - self.__start >= _HEADER.size:
+			required += min(_HEADER.unpack_from(self.__buffer, self.__start)[0], self.max_frame_size)
+		if self.__start + required > len(self.__buffer):
+			if required > len(self.__buffer):
+				self.__reset_buffer(required)
+			else:
+				pending = self.__end - self.__start
+				self.__buffer[:pending] = bytes(self.__view[self.__start:self.__end])  # the regions might overlap
+				self.__start, self.__end = 0, pending
+		return self.__view[self.__end:]
+
+	def buffer_updated(self, size: int):
+		self.__end += size
+
+
+class FrameReader:
+	"""
+	A streaming decoder for the length-prefixed frames of a socket, see :class:`FrameBuffer`
+	"""
+
+	def __init__(self, sock: socket.socket, *, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE, buffer_size: int = RECEIVE_BUFFER_SIZE):
+		self.__sock = sock
+		self.__buffer = FrameBuffer(max_frame_size=max_frame_size, buffer_size=buffer_size)
+
+	@property
+	def max_frame_size(self) -> int:
+		return self.__buffer.max_frame_size
+
+	def __receive(self):
+		received = self.__sock.recv_into(self.__buffer.get_buffer())
+		if received == 0:
+			raise EmptyContent('Empty content received')
+		self.__buffer.buffer_updated(received)
+
+	def read_frames(self, *, timeout: Optional[float]) -> List[bytes]:
+		"""
+		Return all complete frames in the buffer, reading from the socket only if there's none
+		"""
+		self.__sock.settimeout(timeout)
+		while True:
+			frames = self.__buffer.pop_frames()
+			if len(frames) > 0:
+				return frames
+			self.__receive()
+
+	def read_frame(self, *, timeout: Optional[float]) -> bytes:
+		"""
+		Return the next frame, reading from the socket only if it is not buffered yet
+		"""
+		self.__sock.settimeout(timeout)
+		frame = self.__buffer.pop_frame()
+		while frame is None:
+			self.__receive()
+			frame = self.__buffer.pop_frame()
+		return frame
+
+
+class FrameWriter:
+	"""
+	Coalesces the outgoing frames of a connection into as few send syscalls as possible
+
+	Packets are sealed and queued in the order of writing. The writer that finds no flush in progress becomes the flusher,
+	and sends all pending frames with a single scatter/gather sendmsg. Writers arriving during a send queue their frames
+	for the next one. Every writer returns only after its frame is sent, and gets the error if the send failed.
+	With a positive flush delay, the flusher waits that long for more frames before sending
+	"""
+
+	def __init__(self, sock: socket.socket, session: NetworkSession, *, flush_delay: float = 0.0):
+		self.__sock = sock
+		self.__session = session
+		self.flush_delay = flush_delay
+		self.__condition = Condition(Lock())
+		self.__pending: List[bytes] = []  # header and frame buffers
+		self.__queued = 0  # amount of frames queued so far
+		self.__sent = 0  # amount of frames sent so far
+		self.__flushing = False
+		self.__error: Optional[Exception] = None  # the connection is broken
+
+	def write(self, packet: OutgoingPacket):
+		"""
+		Seal the packet and send the frame, possibly together with frames from other threads
+		:raise socket.error: if the connection is broken
+		"""
+		self.write_all([packet])
+
+	def write_all(self, packets: Iterable[OutgoingPacket]):
+		"""
+		Seal the packets and send the frames together
+		:raise socket.error: if the connection is broken
+		"""
+		with self.__condition:
+			if self.__error is not None:
+				raise self.__error
+			for packet in packets:
+				frame = self.__session.encode_packet(packet)  # frames need to be sent in the order of sealing
+				self.__pending.append(frame_header(frame))
+				self.__pending.append(frame)
+				self.__queued += 1
+			ticket = self.__queued
+			while self.__flushing:
+				self.__condition.wait()
+				if self.__sent >= ticket:
+					return
+				if self.__error is not None:
+					raise self.__error
+			self.__flushing = True
+			if self.flush_delay > 0:
+				self.__condition.wait(self.flush_delay)
+		self.__flush_until(ticket)
+
+	def __flush_until(self, ticket: int):
+		"""
+		Send pending frames until the given frame is sent, then let a waiting writer take over
+		"""
+		try:
+			while True:
+				with self.__condition:
+					buffers, self.__pending = self.__pending, []
+					count = self.__queued
+				self.__send_buffers(buffers)
+				with self.__condition:
+					self.__sent = count
+					if self.__sent >= ticket:
+						self.__flushing = False
+						self.__condition.notify_all()
+						return
+		except Exception as e:
+			with self.__condition:
+				self.__error = e
+				self.__pending.clear()
+				self.__flushing = False
+				self.__condition.notify_all()
+			raise
+
+	def __send_buffers(self, buffers: List[bytes]):
+		if not hasattr(self.__sock, 'sendmsg'):  # e.g. Windows
+			self.__sock.sendall(b''.join(buffers))
+			return
+		views = [memoryview(buffer) for buffer in buffers]
+		index = 0
+		while index < len(views):
+			sent = self.__sock.sendmsg(views[index:index + _IOV_MAX])
+			while sent > 0:  # skip the sent buffers, and the sent part of a partially sent buffer
+				if sent >= len(views[index]):
+					sent -= len(views[index])
+					index += 1
+				else:
+					views[index] = views[index][sent:]
+					sent = 0
+
+
+class OutboundQueuePolicy(NamedTuple):
+	max_size: int = 1024  # packets. A full queue means a slow consumer
+	high_water: int = 256  # packets
+	drop_oldest_chat: bool = True  # keep the queue at the high-water mark by dropping the oldest chat packets
+	slow_consumer_timeout: float = 30  # seconds staying over the high-water mark before it's a slow consumer, 0 for no limit
+
+
+class OutboundQueue:
+	"""
+	A bounded queue of the outgoing packets of a connection, drained by a single writer thread running :meth:`run`,
+	or by an event loop with :meth:`poll`
+
+	Senders never block on the socket, so a stalled receiver cannot hold up anyone else.
+	Packets are sealed in the writer thread, so dropping queued ones doesn't break the frame sequence.
+	A receiver that cannot keep up, according to the policy, is a slow consumer:
+	the queue is closed and :meth:`run` raises :class:`SlowConsumer`
+	"""
+
+	def __init__(self, writer: Optional[FrameWriter], policy: OutboundQueuePolicy, *, is_droppable: Callable[[OutgoingPacket], bool], flush_delay: float = 0.0, on_written: Optional[Callable[[List[OutgoingPacket]], Any]] = None):
+		"""
+		:param writer: The writer used by :meth:`run`, None if the queue is drained with :meth:`poll`
+		:param is_droppable: If the packet can be dropped by the drop_oldest_chat policy
+		:param flush_delay: Seconds to wait for more packets before sending them together
+		:param on_written: Called by :meth:`run` with each batch of packets after they are written to the socket
+		"""
+		self.__writer = writer
+		self.__on_written = on_written
+		self.policy = policy
+		self.__is_droppable = is_droppable
+		self.flush_delay = flush_delay
+		self.__queue: Deque[OutgoingPacket] = deque()
+		self.__condition = Condition(Lock())
+		self.__closed = False
+		self.__error: Optional[SlowConsumer] = None
+		self.__over_high_water_since: Optional[float] = None
+		self.dropped_count = 0
+
+	@property
+	def depth(self) -> int:
+		return len(self.__queue)
+
+	@property
+	def error(self) -> Optional[SlowConsumer]:
+		"""
+		The error if the receiver turned out to be a slow consumer
+		"""
+		return self.__error
+
+	def put(self, packet: OutgoingPacket) -> bool:
+		"""
+		:return: If the packet is queued instead of being dropped
+		"""
+		with self.__condition:
+			if self.__closed:
+				return False
+			if len(self.__queue) >= self.policy.high_water:
+				now = time.monotonic()
+				if self.__over_high_water_since is None:
+					self.__over_high_water_since = now
+				elif 0 < self.policy.slow_consumer_timeout < now - self.__over_high_water_since:
+					self.__fail('Outbound queue stayed over the high-water mark {} for {}s'.format(self.policy.high_water, self.policy.slow_consumer_timeout))
+					return False
+			if len(self.__queue) >= self.policy.max_size:
+				if self.__is_droppable(packet):
+					self.dropped_count += 1
+					return False
+				if not (self.policy.drop_oldest_chat and self.__drop_oldest() is not None):
+					self.__fail('Outbound queue is full with {} packets'.format(len(self.__queue)))
+					return False
+			self.__queue.append(packet)
+			if self.policy.drop_oldest_chat and len(self.__queue) > self.policy.high_water:
+				if self.__drop_oldest() is packet:
+					return False
+			self.__condition.notify()
+			return True
+
+	def __drop_oldest(self) -> Optional[OutgoingPacket]:
+		for i, packet in enumerate(self.__queue):
+			if self.__is_droppable(packet):
+				del self.__queue[i]
+				self.dropped_count += 1
+				return packet
+		return None
+
+	def __fail(self, message: str):
+		self.__error = SlowConsumer(message)
+		self.__closed = True
+		self.__condition.notify_all()
+
+	def close(self) -> List[OutgoingPacket]:
+		"""
+		Let :meth:`run` return
+		:return: The packets still queued. They are not sealed, so the caller should keep them to be sent on the next connection
+		"""
+		with self.__condition:
+			self.__closed = True
+			self.__condition.notify_all()
+			return self.__take_all()
+
+	def run(self):
+		"""
+		The writer thread loop. Return after closed
+		:raise SlowConsumer: if the receiver is a slow consumer
+		:raise socket.error: if the connection is broken
+		"""
+		while True:
+			with self.__condition:
+				while len(self.__queue) == 0 and not self.__closed:
+					self.__condition.wait()
+				if not self.__closed and self.flush_delay > 0:
+					self.__condition.wait(self.flush_delay)
+				if self.__error is not None:
+					raise self.__error
+				if self.__closed:
+					return
+				batch = self.__take_all()
+			self.__writer.write_all(batch)
+			if self.__on_written is not None:
+				self.__on_written(batch)
+
+	def poll(self) -> List[OutgoingPacket]:
+		"""
+		Take all queued packets without waiting
+		:raise SlowConsumer: if the receiver is a slow consumer
+		"""
+		with self.__condition:
+			if self.__error is not None:
+				raise self.__error
+			return self.__take_all()
+
+	def __take_all(self) -> List[OutgoingPacket]:
+		batch = list(self.__queue)
+		self.__queue.clear()
+		self.__over_high_water_since = None
+		return batch
+
+
+class OfflineQueuePolicy(NamedTuple):
+	max_size: int = 256  # packets, 0 to disable the queue
+	max_bytes: int = 1024 * 1024  # estimated encoded size of all packets
+	ttl: float = 600  # seconds, older packets are discarded. 0 for no limit
+
+
+class OfflineQueue:
+	"""
+	A ring buffer of packets for a receiver that is offline, kept until it's online again.
+	The oldest packets are evicted when it's over the size limits, and packets older than the ttl are discarded
+
+	The lock is public, so checking if the receiver is online and queueing can be done atomically
+	"""
+
+	def __init__(self, policy: OfflineQueuePolicy):
+		self.policy = policy
+		self.lock = RLock()
+		self.evicted_count = 0
+		self.byte_size = 0
+		self.__queue: Deque[Tuple[float, int, OutgoingPacket]] = deque()  # (time queued, size, packet)
+
+	def __len__(self) -> int:
+		return len(self.__queue)
+
+	def put(self, packet: OutgoingPacket, size: int):
+		with self.lock:
+			self.__discard_expired()
+			self.__queue.append((time.monotonic(), size, packet))
+			self.byte_size += size
+			while len(self.__queue) > self.policy.max_size or (self.byte_size > self.policy.max_bytes and len(self.__queue) > 0):
+				self.__evict()
+
+	def put_first(self, items: List[Tuple[OutgoingPacket, int]]):
+		"""
+		Queue (packet, size) before the packets queued already, e.g. the ones not sent yet when the receiver got offline
+		"""
+		with self.lock:
+			queued_time = self.__queue[0][0] if len(self.__queue) > 0 else time.monotonic()  # keep the queue ordered by time
+			for packet, size in reversed(items):
+				self.__queue.appendleft((queued_time, size, packet))
+				self.byte_size += size
+			while len(self.__queue) > self.policy.max_size or (self.byte_size > self.policy.max_bytes and len(self.__queue) > 0):
+				self.__evict()
+
+	def take_all(self) -> List[OutgoingPacket]:
+		"""
+		Remove and return all packets that are not expired, the oldest first
+		"""
+		with self.lock:
+			self.__discard_expired()
+			packets = [packet for _, _, packet in self.__queue]
+			self.__queue.clear()
+			self.byte_size = 0
+			return packets
+
+	def __evict(self):
+		_, size, _ = self.__queue.popleft()
+		self.byte_size -= size
+		self.evicted_count += 1
+
+	def __discard_expired(self):
+		if self.policy.ttl > 0:
+			deadline = time.monotonic() - self.policy.ttl
+			while len(self.__queue) > 0 and self.__queue[0][0] < deadline:
+				self.__evict()
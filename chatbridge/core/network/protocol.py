@@ -1,10 +1,10 @@
 import uuid
 from abc import ABC
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from mcdreforged.utils.serializer import Serializable
 
-from chatbridge.common.serializer import NoMissingFieldSerializable
+from chatbridge.common.serializer import SlotSerializable
 
 
 # ==============
@@ -12,17 +12,50 @@ from chatbridge.common.serializer import NoMissingFieldSerializable
 # ==============
 
 
-class AbstractPacket(NoMissingFieldSerializable, ABC):
+class AbstractPacket(SlotSerializable, ABC):
 	pass
 
 
+class ProtocolFeature:
+	"""
+	Optional protocol features. Client sends the supported ones in the login packet,
+	and server replies the accepted ones in the login result packet.
+	Features take effect after the login result packet, so peers without them keep working
+	"""
+	binary_frame = 'chatbridge.binary_frame'  # raw binary ciphertext in frames instead of hex string
+	session_cipher = 'chatbridge.session_cipher'  # authenticated stream cipher with per-connection keys derived from the login nonces
+	compress_zstd = 'chatbridge.compress.zstd'  # streaming zstd compression for large messages, requires the zstandard package
+	compress_zlib = 'chatbridge.compress.zlib'  # streaming zlib compression for large messages
+	codec_msgpack = 'chatbridge.codec.msgpack'  # compact binary packet encoding, requires the msgpack package
+	routing_envelope = 'chatbridge.routing_envelope'  # routing header and payload encoded separately, so the server can forward payloads without decoding
+	sequence = 'chatbridge.sequence'  # sequence numbers and acknowledgements in frame headers, so a reconnection resumes without loss or duplicates
+	command_receipt = 'chatbridge.command_receipt'  # the server tells the asker of a broadcast command which clients it reached, so replies can be awaited
+	command_aggregate = 'chatbridge.command_aggregate'  # the server merges the replies of a broadcast command into a single packet for the asker
+
+
 class LoginPacket(AbstractPacket):
 	name: str
 	password: str
+	features: List[str] = []
+	nonce: str = ''  # hex
+	session_id: str = ''  # the sequence session to resume, see ProtocolFeature.sequence
+	received_seq: int = 0  # the last sequence number received in that session
 
 
 class LoginResultPacket(AbstractPacket):
 	message: str  # will be "ok"
+	features: List[str] = []
+	nonce: str = ''  # hex
+	session_id: str = ''  # the sequence session agreed, a new one if the requested one is unknown
+	received_seq: int = 0
+
+
+class AcknowledgePacket(AbstractPacket):
+	"""
+	Sent when there's nothing to carry the acknowledgement of received packets, see ProtocolFeature.sequence.
+	Its frame has the header only
+	"""
+	pass
 
 
 class PacketType:
@@ -30,6 +63,8 @@ class PacketType:
 	chat = 'chatbridge.chat'
 	command = 'chatbridge.command'
 	custom = 'chatbridge.custom'
+	command_receipt = 'chatbridge.command_receipt'
+	command_aggregate = 'chatbridge.command_aggregate'
 
 
 class ChatBridgePacket(AbstractPacket):
@@ -44,7 +79,7 @@ class ChatBridgePacket(AbstractPacket):
 # ==============
 
 
-class AbstractPayload(NoMissingFieldSerializable, ABC):
+class AbstractPayload(SlotSerializable, ABC):
 	pass
 
 
@@ -88,10 +123,10 @@ class CommandPayload(AbstractPayload):
 	result: dict
 
 	@classmethod
-	def ask(cls, command: str, params: Optional[Union[Serializable, dict]] = None) -> 'CommandPayload':
+	def ask(cls, command: str, params: Optional[Union[Serializable, SlotSerializable, dict]] = None) -> 'CommandPayload':
 		if params is None:
 			params = {}
-		if isinstance(params, Serializable):
+		if isinstance(params, (Serializable, SlotSerializable)):
 			params = params.serialize()
 		return CommandPayload(
 			cid=uuid.uuid4().hex,
@@ -102,8 +137,8 @@ class CommandPayload(AbstractPayload):
 		)
 
 	@classmethod
-	def answer(cls, asker_payload: 'CommandPayload', result: Union[Serializable, dict]) -> 'CommandPayload':
-		if isinstance(result, Serializable):
+	def answer(cls, asker_payload: 'CommandPayload', result: Union[Serializable, SlotSerializable, dict]) -> 'CommandPayload':
+		if isinstance(result, (Serializable, SlotSerializable)):
 			result = result.serialize()
 		return CommandPayload(
 			cid=asker_payload.cid,
@@ -114,5 +149,31 @@ class CommandPayload(AbstractPayload):
 		)
 
 
+class CommandReceiptPayload(AbstractPayload):
+	"""
+	Sent by the server to the asker of a broadcast command, see ProtocolFeature.command_receipt
+	"""
+	cid: str
+	receivers: List[str]  # clients the command is forwarded to, i.e. the ones online
+
+
+class CommandAggregatePayload(AbstractPayload):
+	"""
+	Replies of a broadcast command merged by the server, see ProtocolFeature.command_aggregate
+	"""
+	cid: str
+	command: str
+	params: dict = {}
+	results: Dict[str, dict]  # replier -> result
+	missing: List[str]  # receivers that didn't reply before the deadline
+
+	def get_replies(self) -> Dict[str, CommandPayload]:
+		return {
+			sender: CommandPayload(cid=self.cid, command=self.command, responded=True, params=self.params, result=result)
+			for sender, result in self.results.items()
+		}
+
+
 class CustomPayload(AbstractPayload):
 	data: dict
+
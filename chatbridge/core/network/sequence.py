@@ -0,0 +1,130 @@
+import collections
+import struct
+import uuid
+from threading import Lock
+from typing import Deque, List, Tuple, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+	from chatbridge.core.network.session import OutgoingPacket
+
+HEADER = struct.Struct('>QQ')  # sequence number, or 0 if not sequenced; cumulative acknowledgement
+
+
+def new_session_id() -> str:
+	return uuid.uuid4().hex
+
+
+class PacketSequence:
+	"""
+	Sequence numbers and acknowledgements of the packets between a client and the server, see ProtocolFeature.sequence.
+	It's kept by the client and by the connection of the server across reconnections
+
+	Every frame carries the last sequence number received in its header as a cumulative acknowledgement,
+	so acknowledgements cost nothing as long as there is traffic both ways.
+	A frame with the acknowledgement only is needed when ACK_INTERVAL packets are received without replying anything
+
+	Sent packets are kept until acknowledged. When a connection resumes the session, the packets the peer didn't receive
+	are sent again with the same sequence numbers, and the ones received already are dropped by the receiver
+	"""
+	ACK_INTERVAL = 64
+
+	def __init__(self, max_unacked: int):
+		"""
+		:param max_unacked: Oldest unacknowledged packets are forgotten beyond this, and the peer misses them if the connection drops
+		"""
+		self.max_unacked = max_unacked
+		self.session_id = ''  # assigned by the server, empty if no session is established yet
+		self.resent_count = 0  # packets sent again after reconnections
+		self.duplicate_count = 0  # packets received again and dropped
+		self.missed_count = 0  # packets never received, since the peer forgot them
+		self.__lock = Lock()
+		self.__sent = 0  # the last sequence number assigned
+		self.__unacked: Deque[Tuple[int, 'OutgoingPacket']] = collections.deque()
+		self.__received = 0  # the last sequence number received
+		self.__ack_sent = 0  # the last acknowledgement sent
+		self.__ack_queued = False
+
+	def __str__(self):
+		return 'session = {}, received = {}, unacked = {}, resent = {}, duplicates = {}, missed = {}'.format(
+			self.session_id or 'N/A', self.__received, len(self.__unacked), self.resent_count, self.duplicate_count, self.missed_count
+		)
+
+	@property
+	def received_seq(self) -> int:
+		return self.__received
+
+	@property
+	def unacked_count(self) -> int:
+		return len(self.__unacked)
+
+	def on_send(self, packet: Optional['OutgoingPacket']) -> bytes:
+		"""
+		Assign the next sequence number to the packet being sealed, and keep it until acknowledged
+		:param packet: None for frames that are not sequenced, e.g. keep-alive packets and acknowledgements
+		:return: The frame header
+		"""
+		with self.__lock:
+			seq = 0
+			if packet is not None:
+				self.__sent += 1
+				seq = self.__sent
+				self.__unacked.append((seq, packet))
+				if len(self.__unacked) > self.max_unacked:
+					self.__unacked.popleft()
+			self.__ack_sent = self.__received
+			self.__ack_queued = False
+			return HEADER.pack(seq, self.__received)
+
+	def on_receive(self, header: bytes) -> bool:
+		"""
+		:return: If the frame should be processed, i.e. it's not a sequenced packet received already
+		:raise ValueError: if the header is malformed
+		"""
+		try:
+			seq, ack = HEADER.unpack(header)
+		except struct.error as e:
+			raise ValueError('Bad sequence header: {}'.format(e)) from None
+		with self.__lock:
+			while len(self.__unacked) > 0 and self.__unacked[0][0] <= ack:
+				self.__unacked.popleft()
+			if seq == 0:
+				return True
+			if seq <= self.__received:
+				self.duplicate_count += 1
+				return False
+			self.missed_count += seq - self.__received - 1
+			self.__received = seq
+			return True
+
+	def should_ack(self) -> bool:
+		"""
+		If a standalone acknowledgement should be sent now. It's expected to be sent once this returns True
+		"""
+		with self.__lock:
+			if self.__ack_queued or self.__received - self.__ack_sent < self.ACK_INTERVAL:
+				return False
+			self.__ack_queued = True
+			return True
+
+	def resume(self, session_id: str, peer_received: int) -> List['OutgoingPacket']:
+		"""
+		Start sequencing on a new connection
+		:param session_id: The session agreed on login. If it's not the current one, the peer knows nothing about
+		the previous session, so sequence numbers start over and all unacknowledged packets are sent again
+		:param peer_received: The last sequence number the peer has received
+		:return: The packets to be sent before anything else, in order
+		"""
+		with self.__lock:
+			if session_id != self.session_id:
+				self.session_id = session_id
+				self.__received = self.__ack_sent = 0
+				packets = [packet for _, packet in self.__unacked]
+				self.__sent = 0
+			else:
+				packets = [packet for seq, packet in self.__unacked if seq > peer_received]
+				if len(packets) > 0:  # sent again with the same sequence numbers
+					self.__sent = self.__unacked[-1][0] - len(packets)
+			self.__unacked.clear()
+			self.__ack_queued = False
+			self.resent_count += len(packets)
+			return packets
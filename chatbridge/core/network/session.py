@@ -0,0 +1,330 @@
+import os
+from typing import Iterable, List, FrozenSet, Optional, Dict, Any, Union, Tuple
+
+from chatbridge.core.network import compressor, codec
+from chatbridge.core.network.codec import PacketCodec, EnvelopePacket
+from chatbridge.core.network.compressor import StreamCompressor
+from chatbridge.core.network.cryptor import AESCryptor, SessionCipher
+from chatbridge.core.network.protocol import ProtocolFeature, LoginPacket, LoginResultPacket, AbstractPacket, ChatBridgePacket, \
+	AcknowledgePacket, PacketType
+from chatbridge.core.network.sequence import PacketSequence, new_session_id, HEADER as _SEQUENCE_HEADER
+
+_LOGIN_NONCE_SIZE = 16
+_FLAG_RAW = b'\x00'
+_FLAG_COMPRESSED = b'\x01'
+
+
+class SharedPacket:
+	"""
+	A packet to be sent through multiple sessions, e.g. a forwarded broadcast
+
+	The packet is encoded once per codec and packet layout, and sealed once for all sessions that seal it in the same stateless way,
+	i.e. without the session cipher, compression or sequence numbers, whose state is specific to the connection
+	"""
+
+	def __init__(self, packet: AbstractPacket):
+		self.packet = packet
+		self.__encoded: Dict[Tuple[PacketCodec, bool], bytes] = {}
+		self.__frames: Dict[Any, bytes] = {}
+
+	def encode(self, packet_codec: PacketCodec, *, envelope: bool = False) -> bytes:
+		key = (packet_codec, envelope)
+		data = self.__encoded.get(key)
+		if data is None:  # a concurrent encoding gives the same result, no need to lock
+			data = packet_codec.encode_envelope(self.packet) if envelope else packet_codec.encode(self.packet)
+			data = self.__encoded.setdefault(key, data)
+		return data
+
+	def get_frame(self, key: Any) -> Optional[bytes]:
+		return self.__frames.get(key)
+
+	def set_frame(self, key: Any, frame: bytes):
+		self.__frames.setdefault(key, frame)
+
+
+OutgoingPacket = Union[AbstractPacket, SharedPacket]
+
+
+def _is_sequenced(packet: AbstractPacket) -> bool:
+	return isinstance(packet, ChatBridgePacket) and packet.type != PacketType.keep_alive
+
+
+class NetworkSession:
+	"""
+	The wire format state of a single connection
+
+	A new session speaks the basic protocol, which is used for the login packets.
+	Optional features accepted during login are enabled after the login result packet
+	"""
+	SUPPORTED_FEATURES = (
+		ProtocolFeature.binary_frame,
+		ProtocolFeature.session_cipher,
+		*compressor.COMPRESSORS.keys(),
+		*codec.CODECS.keys(),
+		ProtocolFeature.routing_envelope,
+		ProtocolFeature.sequence,
+		ProtocolFeature.command_receipt,
+		ProtocolFeature.command_aggregate,
+	)
+	# at most one feature in each group can be enabled
+	EXCLUSIVE_FEATURE_GROUPS = (
+		tuple(compressor.COMPRESSORS.keys()),
+		tuple(codec.CODECS.keys()),
+	)
+	COMPRESSION_THRESHOLD = 64  # messages shorter than this are not compressed
+
+	def __init__(self, cryptor: AESCryptor, *, max_message_size: int, compression: bool = False):
+		"""
+		:param compression: If compression can be negotiated. See :class:`chatbridge.core.network.compressor.StreamCompressor`
+		"""
+		self.__cryptor = cryptor
+		self.__max_message_size = max_message_size
+		self.__compression = compression
+		self.__features: FrozenSet[str] = frozenset()
+		self.__session_cipher: Optional[SessionCipher] = None
+		self.__compressor: Optional[StreamCompressor] = None
+		self.__codec: PacketCodec = codec.JSON_CODEC
+		self.__login_nonce = os.urandom(_LOGIN_NONCE_SIZE)
+		self.__accepted_login: Optional[LoginPacket] = None
+		self.__accepted_features: List[str] = []
+		self.__sequence: Optional[PacketSequence] = None
+		self.__active_sequence: Optional[PacketSequence] = None  # the sequence if the feature is enabled
+		self.__accepted_session_id = ''
+		self.__resend: List[OutgoingPacket] = []
+		self.__command_aggregation = False
+
+	def get_supported_features(self) -> List[str]:
+		features = list(self.SUPPORTED_FEATURES)
+		if self.__cryptor.key_empty:  # no encryption at all
+			features.remove(ProtocolFeature.session_cipher)
+		for feature, compressor_class in compressor.COMPRESSORS.items():
+			if not self.__compression or not compressor_class.is_available():
+				features.remove(feature)
+		for feature, packet_codec in codec.CODECS.items():
+			if not packet_codec.is_available():
+				features.remove(feature)
+		if self.__sequence is None:
+			features.remove(ProtocolFeature.sequence)
+		if not self.__command_aggregation:
+			features.remove(ProtocolFeature.command_aggregate)
+		return features
+
+	def set_sequence(self, sequence: Optional[PacketSequence]):
+		"""
+		Set the sequence kept across connections, before login. Sequencing is only supported with it
+		"""
+		self.__sequence = sequence
+
+	def set_command_aggregation(self, enabled: bool):
+		"""
+		Set if merged replies of broadcast commands are handled (client side) or made (server side), before login
+		"""
+		self.__command_aggregation = enabled
+
+	# ---------------
+	#      Login
+	# ---------------
+
+	def create_login_packet(self, name: str, password: str) -> LoginPacket:
+		"""
+		Client side. Create the login packet that requests all supported features
+		"""
+		login_packet = LoginPacket(name=name, password=password, features=self.get_supported_features(), nonce=self.__login_nonce.hex())
+		if self.__sequence is not None:
+			login_packet.session_id = self.__sequence.session_id
+			login_packet.received_seq = self.__sequence.received_seq
+		return login_packet
+
+	def on_login_result(self, login_packet: LoginPacket, result: LoginResultPacket):
+		"""
+		Client side. Enable the features accepted by the server
+		"""
+		self.__enable_features(result.features, login_packet.nonce, result.nonce, is_client=True)
+		self.__resume_sequence(result.session_id, result.received_seq)
+
+	def accept_login(self, login_packet: LoginPacket) -> LoginResultPacket:
+		"""
+		Server side. Decide the features to be accepted, and create the login result packet
+		The features will be enabled in :meth:`on_login_result_sent`
+		"""
+		requested_features = set(login_packet.features)
+		try:
+			client_nonce = bytes.fromhex(login_packet.nonce)
+		except ValueError:
+			client_nonce = b''
+		if len(client_nonce) == 0:
+			requested_features.discard(ProtocolFeature.session_cipher)
+		accepted_features = [feature for feature in self.get_supported_features() if feature in requested_features]
+		for group in self.EXCLUSIVE_FEATURE_GROUPS:
+			candidates = [feature for feature in accepted_features if feature in group]
+			for feature in candidates[1:]:  # only the most preferred one
+				accepted_features.remove(feature)
+		self.__accepted_login = login_packet
+		self.__accepted_features = accepted_features
+		result = LoginResultPacket(message='ok', features=self.__accepted_features, nonce=self.__login_nonce.hex())
+		if ProtocolFeature.sequence in accepted_features:
+			if login_packet.session_id != '' and login_packet.session_id == self.__sequence.session_id:
+				result.session_id = login_packet.session_id
+				result.received_seq = self.__sequence.received_seq
+			else:
+				result.session_id = new_session_id()
+			self.__accepted_session_id = result.session_id
+		return result
+
+	def on_login_result_sent(self):
+		"""
+		Server side. Enable the accepted features
+		"""
+		if self.__accepted_login is None:
+			raise AssertionError('No login accepted')
+		self.__enable_features(self.__accepted_features, self.__accepted_login.nonce, self.__login_nonce.hex(), is_client=False)
+		self.__resume_sequence(self.__accepted_session_id, self.__accepted_login.received_seq)
+
+	def __enable_features(self, features: Iterable[str], client_nonce: str, server_nonce: str, *, is_client: bool):
+		features = frozenset(features).intersection(self.get_supported_features())
+		if ProtocolFeature.session_cipher in features:
+			self.__session_cipher = self.__cryptor.create_session_cipher(bytes.fromhex(client_nonce), bytes.fromhex(server_nonce), is_client=is_client)
+		for feature in compressor.COMPRESSORS.keys():
+			if feature in features:
+				self.__compressor = compressor.create_compressor(feature)
+				break
+		self.__codec = codec.select_codec(features)
+		self.__features = features
+
+	def __resume_sequence(self, session_id: str, peer_received: int):
+		if self.__sequence is None:
+			return
+		if self.has_feature(ProtocolFeature.sequence):
+			self.__active_sequence = self.__sequence
+		else:  # unacknowledged packets of previous sessions are sent again without sequence numbers
+			session_id, peer_received = '', 0
+		self.__resend = self.__sequence.resume(session_id, peer_received)
+
+	def take_resend_packets(self) -> List[OutgoingPacket]:
+		"""
+		Packets of previous connections that the peer didn't receive, to be sent before anything else after login
+		"""
+		packets, self.__resend = self.__resend, []
+		return packets
+
+	def has_feature(self, feature: str) -> bool:
+		return feature in self.__features
+
+	@property
+	def features(self) -> FrozenSet[str]:
+		return self.__features
+
+	@property
+	def codec(self) -> PacketCodec:
+		return self.__codec
+
+	# ---------------
+	#     Frames
+	# ---------------
+
+	def __use_envelope(self, packet: AbstractPacket) -> bool:
+		return isinstance(packet, ChatBridgePacket) and self.has_feature(ProtocolFeature.routing_envelope)
+
+	def can_forward(self, packet: ChatBridgePacket) -> bool:
+		"""
+		If the packet can be encoded without decoding its payload, i.e. it's a received envelope in the same codec
+		"""
+		return isinstance(packet, EnvelopePacket) and packet.codec is self.__codec and self.has_feature(ProtocolFeature.routing_envelope)
+
+	def encode_packet(self, packet: OutgoingPacket) -> bytes:
+		sequence = self.__active_sequence
+		if not isinstance(packet, SharedPacket):
+			if isinstance(packet, AcknowledgePacket):
+				if sequence is None:
+					raise ValueError('Acknowledgements need the sequence feature')
+				return self.seal(sequence.on_send(None))
+			if self.__use_envelope(packet):
+				data = self.__codec.encode_envelope(packet)
+			else:
+				data = self.__codec.encode(packet)
+			if sequence is not None:
+				data = sequence.on_send(packet if _is_sequenced(packet) else None) + data
+			return self.seal(data)
+		envelope = self.__use_envelope(packet.packet)
+		data = packet.encode(self.__codec, envelope=envelope)
+		if sequence is not None:
+			return self.seal(sequence.on_send(packet if _is_sequenced(packet.packet) else None) + data)
+		if self.__session_cipher is not None or self.__compressor is not None:
+			return self.seal(data)
+		key = (self.__codec, envelope, self.has_feature(ProtocolFeature.binary_frame), self.__cryptor.key, self.__cryptor.mode)
+		frame = packet.get_frame(key)
+		if frame is None:
+			frame = self.seal(data)
+			packet.set_frame(key, frame)
+		return frame
+
+	def should_acknowledge(self) -> bool:
+		"""
+		If an :class:`AcknowledgePacket` should be sent now, since many packets are received without replying anything
+		"""
+		sequence = self.__active_sequence
+		return sequence is not None and sequence.should_ack()
+
+	def decode_packet(self, frame: bytes) -> dict:
+		"""
+		For packets received before the features are enabled, i.e. the login packets
+		:return: The serialized packet dict
+		"""
+		return self.__codec.decode(self.unseal(frame))
+
+	def decode_chatbridge_packet(self, frame: bytes) -> Optional[ChatBridgePacket]:
+		"""
+		With the routing envelope, the payload of the returned packet is decoded on first access
+		:return: The packet, or None if there's nothing to process, i.e. an acknowledgement or a packet received already
+		:raise ValueError: if the frame cannot be decoded
+		"""
+		data = self.unseal(frame)
+		sequence = self.__active_sequence
+		if sequence is not None:
+			if not sequence.on_receive(data[:_SEQUENCE_HEADER.size]):
+				return None
+			data = data[_SEQUENCE_HEADER.size:]
+			if len(data) == 0:
+				return None
+		if self.has_feature(ProtocolFeature.routing_envelope):
+			return self.__codec.decode_envelope(data)
+		data = self.__codec.decode(data)
+		try:
+			return ChatBridgePacket.deserialize(data)
+		except TypeError as e:
+			raise ValueError('Bad packet {}: {}'.format(data, e)) from None
+
+	def seal(self, data: bytes) -> bytes:
+		"""
+		Compress and encrypt the encoded packet into a frame
+		Frames need to be sent in the order of sealing
+		"""
+		if self.__compressor is not None:
+			if len(data) >= self.COMPRESSION_THRESHOLD:
+				data = _FLAG_COMPRESSED + self.__compressor.compress(data)
+			else:
+				data = _FLAG_RAW + data
+		if self.__session_cipher is not None:
+			return self.__session_cipher.encrypt(data)
+		if self.has_feature(ProtocolFeature.binary_frame):
+			return self.__cryptor.encrypt_bytes(data)
+		return self.__cryptor.encrypt_hex(data)
+
+	def unseal(self, frame: bytes) -> bytes:
+		"""
+		Decrypt and decompress the frame into the encoded packet
+		Frames need to be unsealed in the order of receiving
+		"""
+		if self.__session_cipher is not None:
+			data = self.__session_cipher.decrypt(frame)
+		elif self.has_feature(ProtocolFeature.binary_frame):
+			data = self.__cryptor.decrypt_bytes(frame)
+		else:
+			data = self.__cryptor.decrypt_hex(frame)
+		if self.__compressor is not None:
+			flag, data = data[:1], data[1:]
+			if flag == _FLAG_COMPRESSED:
+				data = self.__compressor.decompress(data, self.__max_message_size)
+			elif flag != _FLAG_RAW:
+				raise ValueError('Unknown frame flag {}'.format(flag))
+		return data
@@ -0,0 +1,133 @@
+import collections
+import itertools
+import json
+import os
+import time
+from threading import Lock
+from typing import Deque, List, Optional, Tuple, Iterable
+
+from chatbridge.core.network.protocol import ChatBridgePacket, PacketType
+
+
+class Outbox:
+	"""
+	Keeps chat and command packets sent while the client is offline, so they can be sent once it's online again
+
+	The outbox is bounded: the oldest packets are dropped when it's full, and packets older than max_age are discarded.
+	With a file path, packets are also appended to the file as json lines, so they survive a process restart.
+	Packets taken stay in the file until :meth:`on_sent` tells they are written to the connection,
+	and the file is rewritten when it grows too long with dropped packets
+	"""
+	PACKET_TYPES = (PacketType.chat, PacketType.command)
+
+	def __init__(self, max_size: int, max_age: float, *, file_path: Optional[str] = None):
+		"""
+		:param max_age: In seconds, 0 for no limit
+		"""
+		self.max_size = max_size
+		self.max_age = max_age
+		self.file_path = file_path
+		self.dropped_count = 0
+		self.__lock = Lock()
+		self.__packets: Deque[Tuple[float, ChatBridgePacket]] = collections.deque()  # (time sent, packet)
+		self.__taken: Deque[Tuple[float, ChatBridgePacket]] = collections.deque()  # taken but not written to the connection yet
+		self.__file_lines = 0
+		if file_path is not None:
+			self.__load()
+
+	@classmethod
+	def accepts(cls, packet) -> bool:
+		return isinstance(packet, ChatBridgePacket) and packet.type in cls.PACKET_TYPES
+
+	def __len__(self) -> int:
+		return len(self.__packets)
+
+	@property
+	def taken_count(self) -> int:
+		"""
+		Packets taken but not written to the connection yet. They are still kept in the file
+		"""
+		return len(self.__taken)
+
+	def put(self, packet: ChatBridgePacket):
+		with self.__lock:
+			item = (time.time(), packet)
+			self.__packets.append(item)
+			if len(self.__packets) > self.max_size:
+				self.__packets.popleft()
+				self.dropped_count += 1
+			if self.file_path is not None:
+				if self.__file_lines >= self.max_size * 2:
+					self.__rewrite()
+				else:
+					self.__append(item)
+
+	def take_all(self) -> List[ChatBridgePacket]:
+		"""
+		Remove and return all packets that are not expired, the oldest first
+		"""
+		with self.__lock:
+			self.__discard_expired()
+			packets = [packet for _, packet in self.__packets]
+			self.__taken.extend(self.__packets)
+			self.__packets.clear()
+			while len(self.__taken) > self.max_size:  # e.g. dropped by the outbound queue, so never written
+				self.__taken.popleft()
+			return packets
+
+	def on_sent(self, packets: Iterable[object]):
+		"""
+		Forget the packets taken that are written to the connection now, including the ones in the file
+		"""
+		if len(self.__taken) == 0:
+			return
+		with self.__lock:
+			sent = set(map(id, packets))
+			count = len(self.__taken)
+			self.__taken = collections.deque(item for item in self.__taken if id(item[1]) not in sent)
+			if len(self.__taken) < count and self.file_path is not None:
+				self.__rewrite()
+
+	def __discard_expired(self):
+		if self.max_age > 0:
+			deadline = time.time() - self.max_age
+			while len(self.__packets) > 0 and self.__packets[0][0] < deadline:
+				self.__packets.popleft()
+				self.dropped_count += 1
+
+	# -----------
+	#   Storage
+	# -----------
+
+	@staticmethod
+	def __to_line(item: Tuple[float, ChatBridgePacket]) -> str:
+		return json.dumps({'time': item[0], 'packet': item[1].serialize()}, ensure_ascii=False) + '\n'
+
+	def __append(self, item: Tuple[float, ChatBridgePacket]):
+		with open(self.file_path, 'a', encoding='utf8') as file:
+			file.write(self.__to_line(item))
+		self.__file_lines += 1
+
+	def __rewrite(self):
+		temp_path = self.file_path + '.tmp'
+		with open(temp_path, 'w', encoding='utf8') as file:
+			file.writelines(self.__to_line(item) for item in itertools.chain(self.__taken, self.__packets))
+		os.replace(temp_path, self.file_path)
+		self.__file_lines = len(self.__taken) + len(self.__packets)
+
+	def __load(self):
+		if not os.path.isfile(self.file_path):
+			return
+		with open(self.file_path, encoding='utf8') as file:
+			for line in file:
+				try:
+					data = json.loads(line)
+					item = (float(data['time']), ChatBridgePacket.deserialize(data['packet']))
+				except (ValueError, TypeError, KeyError):  # e.g. a line cut by a crash
+					continue
+				self.__packets.append(item)
+		while len(self.__packets) > self.max_size:
+			self.__packets.popleft()
+			self.dropped_count += 1
+		self.__discard_expired()
+		self.__rewrite()
@@ -1,25 +1,32 @@
 import json
+import selectors
 import socket
 import time
 from concurrent.futures.thread import ThreadPoolExecutor
-from threading import Thread, Event, RLock, Lock, current_thread
-from typing import Dict, Optional, List, NamedTuple
+from threading import Thread, Event, RLock, Lock
+from typing import Dict, Optional, List, Union, Tuple, Callable, Any
 
 from chatbridge.common import constants
+from chatbridge.common.scheduler import get_scheduler, TimerHandle
+from chatbridge.core.async_server import AsyncioServerEngine, _AsyncClientConnection
 from chatbridge.core.client import ChatBridgeClient, ClientStatus
-from chatbridge.core.config import ClientInfo
+from chatbridge.core.commands import CommandAggregator, CommandCoalescer
+from chatbridge.core.config import ClientInfo, ServerConfig
 from chatbridge.core.network import net_util
 from chatbridge.core.network.basic import Address, ChatBridgeBase
-from chatbridge.core.network.protocol import LoginPacket, ChatBridgePacket, AbstractPacket, LoginResultPacket, \
-	PacketType, ChatPayload
+from chatbridge.core.network.protocol import LoginPacket, ChatBridgePacket, AbstractPacket, AbstractPayload, \
+	PacketType, ChatPayload, CommandPayload, CommandReceiptPayload, CommandAggregatePayload, ProtocolFeature
+from chatbridge.core.network.session import NetworkSession, OutgoingPacket, SharedPacket
 
 
 class _ClientConnection(ChatBridgeClient):
 	def __init__(self, server: 'ChatBridgeServer', info: ClientInfo):
 		self.info = info
 		self.server = server
+		self.__login_packet: Optional[LoginPacket] = None
 		super().__init__(server.aes_key, ClientInfo(name=constants.SERVER_NAME, password=''))
-		self.logger.addHandler(self.server.logger.file_handler)
+		if self.server.logger.file_handler is not None:
+			self.logger.addHandler(self.server.logger.file_handler)
 
 	def get_logging_name(self) -> str:
 		return 'Server.{}'.format(self.get_connection_client_name())
@@ -27,8 +34,8 @@ class _ClientConnection(ChatBridgeClient):
 	def _get_main_loop_thread_name(self):
 		return super()._get_main_loop_thread_name() + '.' + self.get_connection_client_name()
 
-	def _get_keep_alive_thread_name(self):
-		return super()._get_main_loop_thread_name() + '.' + self.get_connection_client_name()
+	def _get_writer_thread_name(self):
+		return super()._get_writer_thread_name() + '.' + self.get_connection_client_name()
 
 	def get_logging_file_name(self) -> Optional[str]:
 		return None
@@ -44,56 +51,150 @@ class _ClientConnection(ChatBridgeClient):
 		No need to login for this class
 		"""
 		self._set_status(ClientStatus.CONNECTED)
-		self._send_packet(LoginResultPacket(message='ok'))
-
-	def _send_packet(self, packet: AbstractPacket):
+		session = self._get_session()
+		session.set_sequence(self.get_packet_sequence())
+		session.set_command_aggregation(self.server.get_command_aggregator() is not None)
+		self._send_packet(session.accept_login(self.__login_packet))  # accepted after the previous connection stops, so the sequence is settled
+		session.on_login_result_sent()
+		self.logger.debug('Enabled protocol features: {}'.format(', '.join(sorted(self._get_session().features)) or 'none'))
+
+	def _send_packet(self, packet: OutgoingPacket):
 		super()._send_packet(packet)
-		self.server.log_packet(packet, to_client=True, client_name=self.get_connection_client_name())
+		self.server.log_packet(packet.packet if isinstance(packet, SharedPacket) else packet, to_client=True, client_name=self.get_connection_client_name())
 
-	def send_packet_invoker(self, packet: AbstractPacket):
+	def send_packet_invoker(self, packet: OutgoingPacket):
 		self._send_packet(packet)
 
 	def _on_packet(self, packet: ChatBridgePacket):
-		super()._on_packet(packet)
+		if packet.type == PacketType.keep_alive:  # other payloads are only decoded if needed
+			super()._on_packet(packet)
 		self.server.process_packet(self, packet)
 
+	def _go_online(self, put: Callable[[OutgoingPacket], Any]):
+		def send(packet: SharedPacket):
+			put(packet)
+			self.server.log_packet(packet.packet, to_client=True, client_name=self.get_connection_client_name())
+
+		self.server._send_offline_packets(self, send, lambda: ChatBridgeClient._go_online(self, put))
+
 	def _on_started(self):
 		super()._on_started()
 		self.logger.info('Started client connection')
 
+	def _keep_unsent_packets(self, packets: List[OutgoingPacket]):
+		self.server._queue_unsent_packets(self, packets)
+
 	def _on_stopped(self):
 		super()._on_stopped()
 		self.logger.info('Stopped client connection')
 
-	def restart_connection(self, conn: socket.socket, addr: Address):
+	def restart_connection(self, conn: socket.socket, addr: Address, reader: net_util.FrameReader, session: NetworkSession, login_packet: LoginPacket):
 		if not self._is_stopped():
 			self.stop()
+		self.__login_packet = login_packet
+		self.max_frame_size = self.server.max_frame_size
+		self.enable_compression = self.server.enable_compression
+		self.send_flush_delay = self.server.send_flush_delay
+		self.outbound_queue_policy = self.server.outbound_queue_policy
 		self.set_server_address(addr)
-		self._set_socket(conn)
+		self._set_socket(conn, reader, session)
 		self.start()
 
 
-class ComingConnection(NamedTuple):
-	sock: socket.socket
-	addr: Address
-	thread: Thread
-	start_time: float
+def _estimate_size(packet: ChatBridgePacket) -> int:
+	envelope = getattr(packet, 'envelope', None)
+	if envelope is not None:  # a routing envelope packet
+		return len(envelope)
+	return len(json.dumps(packet.payload, ensure_ascii=False)) + len(packet.sender) + len(packet.type)
 
-	@classmethod
-	def create(cls, sock: socket.socket, addr: Address) -> 'ComingConnection':
-		return ComingConnection(sock=sock, addr=addr, thread=current_thread(), start_time=time.time())
+
+class LoginStats:
+	"""
+	Counters of the login handshakes of a server
+	"""
+	def __init__(self):
+		self.__lock = Lock()
+		self.accepted = 0  # connections admitted to login
+		self.pending = 0  # connections admitted but not logged in or closed yet
+		self.logged_in = 0
+		self.rate_limited = 0  # connections closed by the rate limit of their address
+		self.rejected = 0  # logins with wrong passwords or unknown client names
+		self.malformed = 0  # connections closed due to bad login packets
+		self.timed_out = 0  # connections closed due to slow handshakes
+
+	def increase(self, field: str, amount: int = 1):
+		with self.__lock:
+			setattr(self, field, getattr(self, field) + amount)
+
+	def __str__(self):
+		return 'accepted = {}, pending = {}, logged in = {}, rate limited = {}, rejected = {}, malformed = {}, timed out = {}'.format(
+			self.accepted, self.pending, self.logged_in, self.rate_limited, self.rejected, self.malformed, self.timed_out
+		)
+
+
+class _RateLimiter:
+	"""
+	A token bucket for each key. Buckets that are full again are forgotten when there are too many of them
+	"""
+	PRUNE_SIZE = 1024
+
+	def __init__(self, rate: float, burst: int):
+		self.rate = rate
+		self.burst = burst
+		self.__buckets: Dict[str, Tuple[float, float]] = {}  # key -> (tokens, last update time)
+		self.__lock = Lock()
+
+	def __tokens(self, key: str, now: float) -> float:
+		tokens, last_time = self.__buckets.get(key, (self.burst, now))
+		return min(self.burst, tokens + (now - last_time) * self.rate)
+
+	def acquire(self, key: str) -> bool:
+		now = time.monotonic()
+		with self.__lock:
+			tokens = self.__tokens(key, now)
+			allowed = tokens >= 1
+			self.__buckets[key] = (tokens - 1 if allowed else tokens, now)
+			if len(self.__buckets) > self.PRUNE_SIZE:
+				self.__buckets = {k: v for k, v in self.__buckets.items() if self.__tokens(k, now) < self.burst}
+			return allowed
+
+
+class ServerEngine:
+	thread = 'thread'  # threads for each connection
+	asyncio = 'asyncio'  # a single asyncio event loop thread for all connections, see AsyncioServerEngine
+
+	ALL = (thread, asyncio)
 
 
 class ChatBridgeServer(ChatBridgeBase):
 	MAXIMUM_LOGIN_DURATION = 20  # 20s
-
-	def __init__(self, aes_key: str, server_address: Address):
+	LOGIN_WORKERS = 8  # threads reading login packets in the thread engine
+	MAX_PENDING_LOGINS = 64  # the thread engine stops accepting connections when that many logins are pending
+	LOGIN_RATE_LIMIT = 2.0  # new connections per second of each address. Many clients might share one host
+	LOGIN_RATE_BURST = 30
+	OFFLINE_QUEUE_POLICY = net_util.OfflineQueuePolicy()
+	COMMAND_AGGREGATE_TIMEOUT = 3  # seconds, shorter than ChatBridgeClient.COMMAND_TIMEOUT so the merged replies arrive in time
+	COMMAND_COALESCE_TIMEOUT = ChatBridgeClient.COMMAND_TIMEOUT  # identical commands are forwarded again if no reply arrives by then
+
+	def __init__(self, aes_key: str, server_address: Address, *, engine: str = ServerEngine.thread):
+		"""
+		:param engine: How connections are served, see :class:`ServerEngine`
+		"""
+		if engine not in ServerEngine.ALL:
+			raise ValueError('Unknown server engine {}, should be one of {}'.format(engine, ', '.join(ServerEngine.ALL)))
 		super().__init__('Server', aes_key)
 		self.server_address = server_address
-		self.clients: Dict[str, _ClientConnection] = {}
-		self.__coming_connections: List[ComingConnection] = []
-		self.__coming_connections_lock = Lock()
+		self.clients: Dict[str, Union[_ClientConnection, _AsyncClientConnection]] = {}
+		self.__async_engine: Optional[AsyncioServerEngine] = AsyncioServerEngine(self) if engine == ServerEngine.asyncio else None
 		self.__sock: Optional[socket.socket] = None
+		self.__wakeup_sender: Optional[socket.socket] = None
+		self.__accepting = False
+		self.__rate_limiter = _RateLimiter(self.LOGIN_RATE_LIMIT, self.LOGIN_RATE_BURST)
+		self.login_stats = LoginStats()
+		self.offline_queue_policy = self.OFFLINE_QUEUE_POLICY
+		self.__offline_queues: Dict[str, net_util.OfflineQueue] = {}
+		self.__command_aggregator: Optional[CommandAggregator] = None
+		self.__command_coalescer: Optional[CommandCoalescer] = None
 		self.__thread_run: Optional[Thread] = None
 		self.__stop_lock = RLock()
 		self.__stopping_flag = False
@@ -104,48 +205,148 @@ class ChatBridgeServer(ChatBridgeBase):
 		return 'ServerThread'
 
 	def add_client(self, client_info: ClientInfo):
-		self.clients[client_info.name] = _ClientConnection(self, client_info)
+		if self.__async_engine is not None:
+			self.clients[client_info.name] = self.__async_engine.create_connection(client_info)
+		else:
+			self.clients[client_info.name] = _ClientConnection(self, client_info)
 
 	def is_running(self) -> bool:
 		return not self.__stopping_flag
 
+	def apply_offline_queue_config(self, config: ServerConfig):
+		"""
+		Apply the offline queue options in the config. Queues created already are not affected
+		"""
+		self.offline_queue_policy = net_util.OfflineQueuePolicy(
+			max_size=config.offline_queue_size,
+			max_bytes=config.offline_queue_bytes,
+			ttl=config.offline_queue_ttl,
+		)
+
+	def get_offline_queue(self, client_name: str) -> Optional[net_util.OfflineQueue]:
+		"""
+		The queue of packets for the client while it's offline, None if nothing has been queued for it
+		"""
+		return self.__offline_queues.get(client_name)
+
+	def set_command_aggregation(self, enabled: bool, timeout: Optional[float] = None):
+		"""
+		Merge the replies of broadcast commands into a single packet for askers supporting it, see ProtocolFeature.command_aggregate.
+		It takes effect for clients logging in afterwards
+		:param timeout: Seconds to wait for the replies, default COMMAND_AGGREGATE_TIMEOUT
+		"""
+		if self.__command_aggregator is not None:
+			self.__command_aggregator.clear()
+		self.__command_aggregator = None
+		if enabled:
+			self.__command_aggregator = CommandAggregator(timeout if timeout is not None else self.COMMAND_AGGREGATE_TIMEOUT, self.__send_command_aggregate)
+
+	def set_command_coalescing(self, enabled: bool, result_ttl: float = 0):
+		"""
+		Forward identical commands in flight to the same client only once, and send the reply to all askers, see :class:`CommandCoalescer`
+		:param result_ttl: Seconds to reuse replies for identical commands afterwards, 0 to disable
+		"""
+		if self.__command_coalescer is not None:
+			self.__command_coalescer.clear()
+		self.__command_coalescer = None
+		if enabled:
+			self.__command_coalescer = CommandCoalescer(self.COMMAND_COALESCE_TIMEOUT, result_ttl, self.__send_coalesced_command)
+
+	def apply_command_config(self, config: ServerConfig):
+		"""
+		Apply the command aggregation and coalescing options in the config
+		"""
+		self.set_command_aggregation(config.aggregate_commands, config.command_aggregate_timeout)
+		self.set_command_coalescing(config.coalesce_commands, config.command_result_ttl)
+
+	def get_command_aggregator(self) -> Optional[CommandAggregator]:
+		return self.__command_aggregator
+
+	def get_command_coalescer(self) -> Optional[CommandCoalescer]:
+		return self.__command_coalescer
+
 	def _main_loop(self):
+		if self.__async_engine is not None:
+			try:
+				self.__async_engine.run(self.__binding_done)
+			finally:
+				self.__stopping_flag = True
+			self.logger.info('bye')
+			return
 		self.__sock = socket.socket()
 		self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		try:
 			self.__sock.bind(self.server_address)
+			self.__sock.listen(5)  # connections are accepted once start() returns
 		except:
 			self.logger.exception('Failed to bind {}'.format(self.server_address))
 			self.__stopping_flag = True
 			return
 		finally:
 			self.__binding_done.set()
+		wakeup_receiver, self.__wakeup_sender = socket.socketpair()  # stop() and login workers wake up the selector with it
+		wakeup_receiver.setblocking(False)
+		self.__wakeup_sender.setblocking(False)
+		selector = selectors.DefaultSelector()
+		selector.register(wakeup_receiver, selectors.EVENT_READ)
+		login_executor = ThreadPoolExecutor(max_workers=self.LOGIN_WORKERS, thread_name_prefix='Login')
+		self.__sock.setblocking(False)
+		self.__accepting = False
 		try:
-			self.__sock.listen(5)
-			self.__sock.settimeout(3)
 			self.logger.info('Server started at {}'.format(self.server_address))
 			counter = 0
 			while self.is_running():
 				try:
-					self.__trim_coming_connections()
+					self.__set_accepting(selector, self.login_stats.pending < self.MAX_PENDING_LOGINS)  # backpressure
+					for key, _ in selector.select():
+						if key.fileobj is wakeup_receiver:
+							try:
+								wakeup_receiver.recv(1024)
+							except BlockingIOError:
+								pass
+					if not self.is_running():
+						break
+					if not self.__accepting:
+						continue
 					try:
 						conn, addr = self.__sock.accept()
-					except socket.timeout:
+					except BlockingIOError:  # the connection is gone already, or it's a wakeup
 						continue
-					if not self.is_running():
-						conn.close()
-						break
+					conn.setblocking(True)
 					address = Address(*addr)
 					counter += 1
+					if not self._admit_connection(address):
+						conn.close()
+						continue
 					self.logger.info('New connection #{} from {}'.format(counter, address))
-					Thread(name='Connection#{}'.format(counter), target=self.__handle_connection, args=(conn, address), daemon=True).start()
+					login_timer = get_scheduler().call_later(self.MAXIMUM_LOGIN_DURATION, self.__on_login_timeout, conn, address, counter)
+					login_executor.submit(self.__handle_connection, conn, address, login_timer)
 				except:
 					if not self.__stopping_flag:
 						self.logger.exception('Error ticking server')
 		finally:
 			self.__stop()
+			login_executor.shutdown(wait=False)
+			selector.close()
+			wakeup_receiver.close()
+			self.__wakeup_sender.close()
 		self.logger.info('bye')
 
+	def __set_accepting(self, selector: selectors.BaseSelector, accepting: bool):
+		if accepting != self.__accepting:
+			if accepting:
+				selector.register(self.__sock, selectors.EVENT_READ)
+			else:
+				self.logger.warning('Too many pending logins, stop accepting connections')
+				selector.unregister(self.__sock)
+			self.__accepting = accepting
+
+	def __wakeup(self):
+		try:
+			self.__wakeup_sender.send(b'\0')
+		except OSError:  # the main loop has exited, or it's woken up already
+			pass
+
 	def start(self):
 		"""
 		Start and wait until port binding done
@@ -156,11 +357,19 @@ class ChatBridgeServer(ChatBridgeBase):
 
 	def __stop(self):
 		self.__stopping_flag = True
+		if self.__command_aggregator is not None:
+			self.__command_aggregator.clear()
+		if self.__command_coalescer is not None:
+			self.__command_coalescer.clear()
+		if self.__async_engine is not None:
+			self.__async_engine.stop()
+			return
 		with self.__stop_lock:
 			if self.__sock is not None:
+				self.__wakeup()
 				try:
 					self.__sock.close()
-					with ThreadPoolExecutor(max_workers=len(self.clients)) as worker:
+					with ThreadPoolExecutor(max_workers=max(len(self.clients), 1)) as worker:
 						for client in self.clients.values():
 							if client.is_running():
 								worker.submit(client.stop)
@@ -173,56 +382,80 @@ class ChatBridgeServer(ChatBridgeBase):
 		self.__stop()
 		super().stop()
 
-	def __trim_coming_connections(self):
-		with self.__coming_connections_lock:
-			to_be_removed = []
-			current_time = time.time()
-			for cc in self.__coming_connections:
-				if current_time - cc.start_time > self.MAXIMUM_LOGIN_DURATION:
-					self.logger.warning('Terminating coming connection from {} in thread {} due to login timeout'.format(cc.addr, cc.thread.getName()))
-					try:
-						cc.sock.close()
-					except:
-						self.logger.exception('Error terminating coming connection from {} in thread {}'.format(cc.addr, cc.thread.getName()))
-					to_be_removed.append(cc)
-			for cc in to_be_removed:
-				self.__coming_connections.remove(cc)
-
-	def __handle_connection(self, conn: socket, addr: Address):
+	def _admit_connection(self, addr: Address) -> bool:
+		"""
+		:return: If the new connection can login, or it should be closed due to the rate limit of its address
+		"""
+		if not self.__rate_limiter.acquire(addr.hostname):
+			self.login_stats.increase('rate_limited')
+			self.logger.warning('Closed connection from {} due to the rate limit'.format(addr))
+			return False
+		self.login_stats.increase('accepted')
+		self.login_stats.increase('pending')
+		return True
+
+	def __handle_connection(self, conn: socket, addr: Address, login_timer: TimerHandle):
+		"""
+		Run in the login worker pool. The login timer covers the time queued too
+		"""
 		success = False
-		cc = ComingConnection.create(conn, addr)
-		with self.__coming_connections_lock:
-			self.__coming_connections.append(cc)
 		try:
 			try:
-				recv_str = net_util.receive_data(conn, self._cryptor, timeout=15)
-				login_packet = LoginPacket.deserialize(json.loads(recv_str))
+				if not self.is_running():
+					raise ConnectionAbortedError('Server stopped')
+				reader = net_util.FrameReader(conn, max_frame_size=self.max_frame_size)
+				session = self._create_session()
+				login_packet = LoginPacket.deserialize(session.decode_packet(reader.read_frame(timeout=15)))
 			except Exception as e:
-				self.logger.error('Failed reading client\'s login packet: {}'.format(e))
-				return
+				if login_timer.cancelled:  # closed by the timer, counted there
+					pass
+				else:
+					self.login_stats.increase('malformed')
+					self.logger.error('Failed reading client\'s login packet: {}'.format(e))
 			else:
+				login_timer.cancel()  # don't close the connection after it's handed to the client
 				self.log_packet(login_packet, to_client=False)
-				client = self.clients.get(login_packet.name, None)
+				client = self._authenticate(login_packet, addr)
 				if client is not None:
-					if client.info.password == login_packet.password:
-						success = True
-						self.logger.info('Identification of {} confirmed: {}'.format(addr, client.info.name))
-						client.restart_connection(conn, addr)
-					else:
-						self.logger.warning('Wrong password during login for client {}: expected {} but received {}'.format(client.info.name, client.info.password, login_packet.password))
-				else:
-					self.logger.warning('Unknown client name during login: {}'.format(login_packet.name))
+					success = True
+					client.restart_connection(conn, addr, reader, session, login_packet)
 			if not success:
 				conn.close()
 				self.logger.warning('Closed connection from {}'.format(addr))
 		finally:
-			with self.__coming_connections_lock:
-				try:
-					self.__coming_connections.remove(cc)
-				except ValueError:
-					pass
+			login_timer.cancel()
+			self.login_stats.increase('pending', -1)
+			self.__wakeup()  # accept again if it stopped accepting
+
+	def __on_login_timeout(self, conn: socket.socket, addr: Address, number: int):
+		self.login_stats.increase('timed_out')
+		self.logger.warning('Terminating coming connection #{} from {} due to login timeout'.format(number, addr))
+		try:
+			conn.shutdown(socket.SHUT_RDWR)  # wakes up the thread reading the login packet, close() alone doesn't
+			conn.close()
+		except OSError:
+			pass
+
+	def _authenticate(self, login_packet: LoginPacket, addr: Address) -> Optional[Union[_ClientConnection, _AsyncClientConnection]]:
+		"""
+		:return: The client that the login packet logs in as, or None if it's rejected
+		"""
+		client = self.clients.get(login_packet.name, None)
+		if client is not None:
+			if client.info.password == login_packet.password:
+				self.logger.info('Identification of {} confirmed: {}'.format(addr, client.info.name))
+				self.login_stats.increase('logged_in')
+				return client
+			else:
+				self.logger.warning('Wrong password during login for client {}: expected {} but received {}'.format(client.info.name, client.info.password, login_packet.password))
+		else:
+			self.logger.warning('Unknown client name during login: {}'.format(login_packet.name))
+		self.login_stats.increase('rejected')
+		return None
 
 	def log_packet(self, packet: AbstractPacket, *, to_client: bool, client_name: str = None):
+		if not self.logger.is_debug_enabled():
+			return
 		if isinstance(packet, ChatBridgePacket):
 			if to_client:
 				assert client_name is not None
@@ -237,29 +470,146 @@ class ChatBridgeServer(ChatBridgeBase):
 				indicator = '? -> {}'.format(constants.SERVER_NAME)
 			self.logger.debug('[{}] {}: {}'.format(indicator, packet.__class__.__name__, packet.serialize()))
 
-	def process_packet(self, client: _ClientConnection, packet: ChatBridgePacket):
+	def process_packet(self, client: Union[_ClientConnection, _AsyncClientConnection], packet: ChatBridgePacket):
 		if packet.sender != client.info.name:
 			self.logger.warning('Un-matched sender name during packet transferring, expected {} but found {}'.format(client.info.name, packet.sender))
 			return
 		self.log_packet(packet, to_client=False)
-		if packet.type == PacketType.chat:
+		if packet.type == PacketType.chat and type(self).on_chat is not ChatBridgeServer.on_chat:
 			try:
 				self.on_chat(client.get_connection_client_name(), ChatPayload.deserialize(packet.payload))
 			except:
 				self.logger.exception('Error when deserialize chat packet from {}'.format(
 					client.get_connection_client_name()))
 		receivers = packet.receivers if not packet.broadcast else self.clients.keys()
+		targets: List[Union[_ClientConnection, _AsyncClientConnection]] = []
+		offline_targets: List[Union[_ClientConnection, _AsyncClientConnection]] = []
 		for receiver_name in set(receivers):
 			if receiver_name != packet.sender:
 				if receiver_name == constants.SERVER_NAME:
 					self.on_packet(packet)
 				else:
-					client = self.clients.get(receiver_name)
-					if client is not None:
-						if client.is_online():
-							client.send_packet_invoker(packet)
+					receiver = self.clients.get(receiver_name)
+					if receiver is not None:
+						if receiver.is_online():
+							targets.append(receiver)
+						elif self.offline_queue_policy.max_size > 0:
+							offline_targets.append(receiver)
 					else:
 						self.logger.warning('Unknown client name {}'.format(receiver_name))
+		if any(not target._get_session().can_forward(packet) for target in targets):
+			try:  # decode here, so a bad payload won't break the writer of the receivers
+				_ = packet.payload
+			except ValueError:
+				self.logger.warning('Dropped packet from {} with undecodable payload'.format(packet.sender))
+				return
+		if packet.type == PacketType.command and not self.__process_command(client, packet, targets):
+			return
+		shared_packet = SharedPacket(packet)  # encoded once for all receivers
+		for target in targets:
+			target.send_packet_invoker(shared_packet)
+		if len(offline_targets) > 0:
+			size = _estimate_size(packet)
+			for target in offline_targets:
+				queue = self.__get_or_create_offline_queue(target.info.name)
+				with queue.lock:  # it might just get online, see _send_offline_packets
+					if target.is_online():
+						target.send_packet_invoker(shared_packet)
+					else:
+						queue.put(shared_packet, size)
+
+	def __process_command(self, client: Union[_ClientConnection, _AsyncClientConnection], packet: ChatBridgePacket, targets: List[Union[_ClientConnection, _AsyncClientConnection]]) -> bool:
+		"""
+		Track broadcast commands for the receipt or the aggregation features, and coalesce identical commands to a client
+		:return: If the packet should be forwarded, i.e. it's not a reply merged by the aggregator or a command answered by the coalescer
+		"""
+		session = client._get_session()
+		aggregator, coalescer = self.__command_aggregator, self.__command_coalescer
+		if packet.broadcast:
+			aggregate = aggregator is not None and session.has_feature(ProtocolFeature.command_aggregate)
+			if not aggregate and not session.has_feature(ProtocolFeature.command_receipt):
+				return True
+		elif len(packet.receivers) != 1 or (coalescer is None and (aggregator is None or len(aggregator) == 0)):
+			return True
+		try:
+			payload = CommandPayload.deserialize(packet.payload)
+		except (ValueError, TypeError):
+			return True
+		if not packet.broadcast:
+			if not payload.responded:  # only commands to an online client are coalesced, not the ones queued
+				return coalescer is None or len(targets) != 1 or coalescer.on_command(client.info.name, targets[0].info.name, payload)
+			if coalescer is not None:
+				coalescer.on_reply(packet.sender, packet.receivers[0], payload)
+			return aggregator is None or not aggregator.on_reply(packet.sender, packet.receivers[0], payload)
+		if payload.responded:
+			return True
+		receivers = [target.info.name for target in targets]
+		if aggregate:
+			aggregator.track(client.info.name, payload, receivers)
+		else:  # tell the asker which clients are going to reply
+			self.__send_to_client(client.info.name, PacketType.command_receipt, CommandReceiptPayload(cid=payload.cid, receivers=receivers))
+		return True
+
+	def __send_command_aggregate(self, asker: str, payload: CommandAggregatePayload):
+		self.__send_to_client(asker, PacketType.command_aggregate, payload)
+
+	def __send_coalesced_command(self, sender: str, receiver: str, payload: CommandPayload):
+		self.__send_to_client(receiver, PacketType.command, payload, sender=sender)
+
+	def __send_to_client(self, client_name: str, type_: str, payload: AbstractPayload, *, sender: str = constants.SERVER_NAME):
+		client = self.clients.get(client_name)
+		if client is None or not client.is_online():
+			self.logger.debug('Dropped {} for {} since it is offline'.format(type_, client_name))
+			return
+		client.send_packet_invoker(ChatBridgePacket(
+			sender=sender,
+			receivers=[client_name],
+			broadcast=False,
+			type=type_,
+			payload=payload.serialize()
+		))
+
+	def __get_or_create_offline_queue(self, client_name: str) -> net_util.OfflineQueue:
+		queue = self.__offline_queues.get(client_name)
+		if queue is None:
+			queue = self.__offline_queues.setdefault(client_name, net_util.OfflineQueue(self.offline_queue_policy))
+		return queue
+
+	def _queue_unsent_packets(self, client: Union[_ClientConnection, _AsyncClientConnection], packets: List[OutgoingPacket]):
+		"""
+		Put the packets not sent to the client when its connection closed into its offline queue, before the ones queued since then
+		"""
+		if len(packets) == 0 or self.offline_queue_policy.max_size <= 0:
+			return
+		items = []
+		for packet in packets:
+			if not isinstance(packet, SharedPacket):
+				packet = SharedPacket(packet)
+			items.append((packet, _estimate_size(packet.packet)))
+		self.logger.info('Queueing {} packets not sent before {} got offline'.format(len(items), client.info.name))
+		self.__get_or_create_offline_queue(client.info.name).put_first(items)
+
+	def _send_offline_packets(self, client: Union[_ClientConnection, _AsyncClientConnection], send: Callable[[SharedPacket], Any], set_online: Optional[Callable[[], Any]] = None):
+		"""
+		Send the packets queued while the client was offline, right after it logs in
+		:param send: Sends a packet to the client, which is not online yet
+		:param set_online: Gets the client online, if it's not yet. It's called with the queue still locked after the queued packets are sent,
+		so packets forwarded to the client afterwards are sent after them, see process_packet
+		"""
+		queue = self.__get_or_create_offline_queue(client.info.name)
+		with queue.lock:
+			packets = queue.take_all()
+			if len(packets) > 0:
+				self.logger.info('Sending {} packets queued while {} was offline'.format(len(packets), client.info.name))
+			for shared_packet in packets:
+				if not client._get_session().can_forward(shared_packet.packet):
+					try:  # the payload was not decoded when queued, if the receivers online could forward it
+						_ = shared_packet.packet.payload
+					except ValueError:
+						continue
+				send(shared_packet)
+			if set_online is not None:
+				set_online()
 
 	def on_chat(self, sender: str, content: ChatPayload):
 		pass
@@ -60,7 +60,17 @@ class CLIServer(ChatBridgeServer):
 			elif text == 'list':
 				self.logger.info('Client count: {}'.format(len(self.clients)))
 				for client in self.clients.values():
-					self.logger.info('- {}: online = {}, ping = {}'.format(client.info.name, client.is_online(), client.get_ping_text()))
+					offline_queue = self.get_offline_queue(client.info.name)
+					self.logger.info('- {}: online = {}, ping = {}, queue = {}, dropped = {}, offline queue = {} ({} bytes), evicted = {}'.format(
+						client.info.name, client.is_online(), client.get_ping_text(), client.get_outbound_queue_depth(), client.get_dropped_packet_count(),
+						len(offline_queue) if offline_queue is not None else 0,
+						offline_queue.byte_size if offline_queue is not None else 0,
+						offline_queue.evicted_count if offline_queue is not None else 0,
+					))
+					self.logger.info('  Sequence: {}'.format(client.get_packet_sequence()))
+				self.logger.info('Logins: {}'.format(self.login_stats))
+				if self.get_command_coalescer() is not None:
+					self.logger.info('Command coalescing: {}'.format(self.get_command_coalescer()))
 			elif text == 'debug on':
 				self.logger.set_debug_all(True)
 				self.logger.info('Debug logging on')
@@ -82,7 +92,11 @@ def main():
 	address = Address(config.hostname, config.port)
 	print('AES Key = {}'.format(config.aes_key))
 	print('Server address = {}'.format(address))
-	server = CLIServer(config.aes_key, address)
+	print('Server engine = {}'.format(config.engine))
+	server = CLIServer(config.aes_key, address, engine=config.engine)
+	server.apply_network_config(config)
+	server.apply_offline_queue_config(config)
+	server.apply_command_config(config)
 	for i, client_info in enumerate(config.clients):
 		print('- Client #{}: name = {}, password = {}'.format(i + 1, client_info.name, client_info.password))
 		server.add_client(client_info)
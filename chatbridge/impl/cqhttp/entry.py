@@ -1,12 +1,13 @@
 import base64
+import functools
 import html
 import json
 import os
 import re
-import threading
 import time
+from concurrent.futures import Future, TimeoutError
 from mcdreforged.api.all import *
-from typing import Callable, Optional
+from typing import Optional, Dict
 
 import requests
 import matplotlib.pyplot as plt
@@ -120,16 +121,12 @@ class CQBot(websocket._app.WebSocketApp):
 						if chatClient.is_online():
 							command = '!!online'
 							if len(args) == 1:
-								self.logger.info('Broadcas command "{}"'.format(command))
-								chatClient.register_collector('!!online', chatClient.collect_online_result)
-								chatClient.online_players = {}
-								chatClient.broadcast_command(command)
-								timer = threading.Timer(0.5, chatClient.stop_collect_online)
-								timer.start()
+								self.logger.info('Broadcast command "{}"'.format(command))
+								chatClient.broadcast_command(command).add_done_callback(chatClient.show_online_players)
 							else:
 								client = self.config.client_to_query_online if len(args) == 1 else args[1]
 								self.logger.info('Sending command "{}" to client {}'.format(command, client))
-								chatClient.send_command(client, command)
+								chatClient.send_command(client, command).add_done_callback(functools.partial(chatClient.show_online_result, client))
 						else:
 							self.send_text('ChatBridge 客户端离线')
 
@@ -139,10 +136,10 @@ class CQBot(websocket._app.WebSocketApp):
 						if len(args) == 1 or len(args) - int(command.find('-bot') != -1) - int(command.find('-all') != -1) != 4:
 							self.send_text(StatsHelpMessage)
 							return
-						if chatClient.is_online:
+						if chatClient.is_online():
 							client = self.config.client_to_query_stats
 							self.logger.info('Sending command "{}" to client {}'.format(command, client))
-							chatClient.send_command(client, command)
+							chatClient.send_command(client, command).add_done_callback(chatClient.show_stats_result)
 						else:
 							self.send_text('ChatBridge 客户端离线')
 		except:
@@ -232,18 +229,6 @@ def get_server_info(self: CQBot):
 
 
 class CqHttpChatBridgeClient(ChatBridgeClient):
-	command_collectors = {}  # command -> List[Callable]
-	online_players = {}
-
-	def register_collector(self, command: str, callback: Callable):
-		self.command_collectors.setdefault(command, []).append(callback)
-
-	def unregister_collector(self, command: str, callback: Callable):
-		if command in self.command_collectors:
-			self.command_collectors[command].remove(callback)
-			if not self.command_collectors[command]:
-				del self.command_collectors[command]
-                
 	def on_chat(self, sender: str, payload: ChatPayload):
 		global cq_bot
 		if cq_bot is None:
@@ -255,49 +240,49 @@ class CqHttpChatBridgeClient(ChatBridgeClient):
 			self.logger.exception('Error in on_chat()')
 
 
-	def on_command(self, sender: str, payload: CommandPayload):
-		if payload.responded and payload.command in self.command_collectors:
-			for callback in self.command_collectors[payload.command]:
-				callback(sender, payload)
+	def show_stats_result(self, future: 'Future[CommandPayload]'):
+		try:
+			payload = future.result()
+		except TimeoutError:
+			cq_bot.send_text('统计信息查询超时')
 			return
-        
-		if not payload.responded:
+		result = StatsQueryResult.deserialize(payload.result)
+		if result.success:
+			messages = ['====== {} ======'.format(result.stats_name)]
+			messages.extend(result.data)
+			messages.append('总数：{}'.format(result.total))
+			cq_bot.send_text('\n'.join(messages))
+		elif result.error_code == 1:
+			cq_bot.send_text('统计信息未找到')
+		elif result.error_code == 2:
+			cq_bot.send_text('StatsHelper 插件未加载')
+
+	def show_online_result(self, client: str, future: 'Future[CommandPayload]'):
+		try:
+			payload = future.result()
+		except TimeoutError:
+			cq_bot.send_text('{} 未响应'.format(client))
 			return
-		if payload.command.startswith('!!stats '):
-			result = StatsQueryResult.deserialize(payload.result)
-			if result.success:
-				messages = ['====== {} ======'.format(result.stats_name)]
-				messages.extend(result.data)
-				messages.append('总数：{}'.format(result.total))
-				cq_bot.send_text('\n'.join(messages))
-			elif result.error_code == 1:
-				cq_bot.send_text('统计信息未找到')
-			elif result.error_code == 2:
-				cq_bot.send_text('StatsHelper 插件未加载')
-		elif payload.command == '!!online':
-			result = OnlineQueryResult.deserialize(payload.result)
-			if result.success:
-				if result.data == []:
-					cq_bot.send_text('当前 {} 没有玩家在线！'.format(sender))
-				else:
-					cq_bot.send_text('====== {} 玩家列表 ======\n{}'.format(sender, '\n'.join(result.data)))
-			elif result.error_code == 2:
-				cq_bot.send_text('OnlinePlayerAPI 插件未加载')
-
-	def collect_online_result(self, sender, payload: CommandPayload):
 		result = OnlineQueryResult.deserialize(payload.result)
-		self.online_players[sender] = result.data
-  
-	def stop_collect_online(self):
-		chatClient.unregister_collector('!!online', self.collect_online_result)
+		if result.success:
+			if result.data == []:
+				cq_bot.send_text('当前 {} 没有玩家在线！'.format(client))
+			else:
+				cq_bot.send_text('====== {} 玩家列表 ======\n{}'.format(client, '\n'.join(result.data)))
+		elif result.error_code == 2:
+			cq_bot.send_text('OnlinePlayerAPI 插件未加载')
+
+	def show_online_players(self, future: 'Future[Dict[str, CommandPayload]]'):
 		message = '====== 玩家列表 ======\n'
-		for sender, result in self.online_players.items():
-			if len(result) > 0:
-				message += '【{}】(共{}人)：\n{}\n'.format(sender, len(result), '\n'.join(result))
+		for sender, payload in future.result().items():
+			result = OnlineQueryResult.deserialize(payload.result)
+			if len(result.data) > 0:
+				message += '【{}】(共{}人)：\n{}\n'.format(sender, len(result.data), '\n'.join(result.data))
 			else:
 				message += '【{}】(无在线玩家)\n'.format(sender)
 		cq_bot.send_text(message)
 
+
 def main():
 	global chatClient, cq_bot
 	config = utils.load_config(ConfigFile, CqHttpConfig)
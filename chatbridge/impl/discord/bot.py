@@ -1,6 +1,4 @@
-import asyncio
 from enum import auto, Enum
-from queue import Queue, Empty
 from typing import NamedTuple, Any, List
 
 import discord
@@ -14,6 +12,7 @@ from chatbridge.impl.discord import stored
 from chatbridge.impl.discord.config import DiscordConfig
 from chatbridge.impl.discord.helps import CommandHelpMessageAll, CommandHelpMessage, StatsCommandHelpMessage
 from chatbridge.impl.tis import bot_util
+from chatbridge.impl.utils import AsyncHandoffQueue
 
 
 class MessageDataType(Enum):
@@ -32,7 +31,7 @@ class DiscordBot(commands.Bot):
 	def __init__(self, command_prefix, **options):
 		options['help_command'] = None
 		super().__init__(command_prefix, **options)
-		self.messages = Queue()
+		self.messages: AsyncHandoffQueue[MessageData] = AsyncHandoffQueue()
 		self.logger = logger.ChatBridgeLogger('Bot', file_handler=stored.client.logger.file_handler)
 		try:
 			from google_trans_new import google_translator
@@ -54,11 +53,7 @@ class DiscordBot(commands.Bot):
 		try:
 			channel_chat = self.get_channel(self.config.channel_for_chat)
 			while True:
-				try:
-					message_data = self.messages.get(block=False)  # type: MessageData
-				except Empty:
-					await asyncio.sleep(0.05)
-					continue
+				message_data = await self.messages.get()
 				data = message_data.data
 				if message_data.type == MessageDataType.CHAT:  # chat message
 					assert isinstance(data, tuple)
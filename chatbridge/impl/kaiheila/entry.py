@@ -3,13 +3,12 @@ import collections
 import logging
 import matplotlib.pyplot as plt
 import os
-import queue
 import re
 import requests
 from mcdreforged.api.all import *
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict
 
-from khl import Bot, Message
+from khl import Bot, Message, PublicChannel
 from khl._types import MessageTypes
 from khl.card import CardMessage, Card, Module, Element, Types, Struct
 
@@ -17,6 +16,7 @@ from chatbridge.core.client import ChatBridgeClient
 from chatbridge.core.config import ClientConfig
 from chatbridge.core.network.protocol import ChatPayload, CommandPayload
 from chatbridge.impl import utils
+from chatbridge.impl.utils import AsyncHandoffQueue
 from chatbridge.impl.kaiheila.helps import StatsCommandHelpMessage, CommandHelpMessage
 from chatbridge.impl.tis import bot_util
 from chatbridge.impl.tis.protocol import OnlineQueryResult, StatsQueryResult
@@ -58,7 +58,8 @@ class KaiHeiLaBot(Bot):
 	def __init__(self, config: KaiHeiLaConfig):
 		self.config = config
 		super().__init__(token=self.config.token)
-		self.messages = queue.Queue()
+		self.messages: AsyncHandoffQueue[MessageData] = AsyncHandoffQueue()
+		self.channels: Dict[str, PublicChannel] = {}  # resolved channels, so sending doesn't fetch them every time
 		self.event_loop = asyncio.get_event_loop()
 #		self._setup_event_loop(self.event_loop)
 
@@ -67,27 +68,36 @@ class KaiHeiLaBot(Bot):
 		asyncio.ensure_future(self.on_ready(), loop=self.event_loop)
 		self.run()
 
+	async def get_public_channel(self, channel_id: str) -> PublicChannel:
+		channel = self.channels.get(channel_id)
+		if channel is None:
+			channel = self.channels[channel_id] = await self.client.fetch_public_channel(channel_id)
+		return channel
+
+	async def send_to_channel(self, channel_id: str, content, **kwargs):
+		try:
+			await self.send(await self.get_public_channel(channel_id), content, **kwargs)
+		except:
+			self.channels.pop(channel_id, None)  # resolve it again next time, in case it's changed
+			raise
+
 	async def listeningMessage(self):
 		chatClient.logger.info('Message listening looping...')
 		try:
 			while True:
-				try:
-					message_data: MessageData = self.messages.get(block=False)
-				except queue.Empty:
-					await asyncio.sleep(0.05)
-					continue
+				message_data: MessageData = await self.messages.get()
 				data = message_data.data
 				if message_data.type == MessageDataType.CHAT:  # chat message
 					assert isinstance(data, tuple)
 					sender: str = data[0]
 					payload: ChatPayload = data[1]
 					message = payload.formatted_str()
-					await self.send(await self.client.fetch_public_channel(self.config.channel_for_chat), f'[{sender}] {message}')
+					await self.send_to_channel(self.config.channel_for_chat, f'[{sender}] {message}')
 				elif message_data.type == MessageDataType.CARD:  # embed
 					assert isinstance(data, Card)
-					await self.send(await self.client.fetch_public_channel(message_data.channel), CardMessage(data), type=MessageTypes.CARD)
+					await self.send_to_channel(message_data.channel, CardMessage(data), type=MessageTypes.CARD)
 				elif message_data.type == MessageDataType.TEXT:
-					await self.send(await self.client.fetch_public_channel(message_data.channel), str(data))
+					await self.send_to_channel(message_data.channel, str(data))
 				else:
 					chatClient.logger.debug('Unknown messageData type {}'.format(message_data.data))
 		except:
@@ -5,3 +5,6 @@ class MCDRClientConfig(ClientConfig):
 	enable: bool = True
 	boardcast_player: bool = False
 	debug: bool = False
+	stats_cache_ttl: float = 60  # seconds to reuse the results of !!stats queries, 0 to disable
+	stats_cache_size: int = 64
+	clear_stats_cache_on_leave: bool = True  # stats of a player are saved when the player leaves
@@ -1,7 +1,7 @@
 import os
 import shutil
 from threading import Event, Lock
-from typing import Optional
+from typing import Optional, Tuple, List
 
 from mcdreforged.api.all import *
 
@@ -12,12 +12,13 @@ from chatbridge.impl.mcdr.config import MCDRClientConfig
 from chatbridge.impl.tis.protocol import StatsQueryResult, OnlineQueryResult
 
 class ChatBridgeMCDRClient(ChatBridgeClient):
-	KEEP_ALIVE_THREAD_NAME = 'ChatBridge-KeepAlive'
-
 	def __init__(self, config: MCDRClientConfig, server: ServerInterface):
 		super().__init__(config.aes_key, config.client_info, server_address=config.server_address)
+		self.apply_network_config(config)
+		self.apply_outbox_config(config)
 		self.config = config
 		self.server: ServerInterface = server
+		self.stats_cache: utils.TtlCache[Tuple[str, str, bool, bool], StatsQueryResult] = utils.TtlCache(config.stats_cache_size, config.stats_cache_ttl)
 		prev_handler = self.logger.console_handler
 		new_handler = SyncStdoutStreamHandler()  # use MCDR's, so the concurrent output won't be messed up
 		new_handler.setFormatter(prev_handler.formatter)
@@ -30,9 +31,6 @@ class ChatBridgeMCDRClient(ChatBridgeClient):
 	def _get_main_loop_thread_name(self):
 		return 'ChatBridge-' + super()._get_main_loop_thread_name()
 
-	def _get_keep_alive_thread_name(self):
-		return 'ChatBridge-' + super()._get_keep_alive_thread_name()
-
 	def _on_stopped(self):
 		super()._on_stopped()
 		self.logger.info('Client stopped')
@@ -44,49 +42,59 @@ class ChatBridgeMCDRClient(ChatBridgeClient):
 		command = payload.command
 		result: Optional[Serializable] = None
 		if command.startswith('!!stats '):
-			try:
-				import stats_helper
-			except (ImportError, ModuleNotFoundError):
-				result = StatsQueryResult.no_plugin()
-			else:
-				trimmed_command = command.replace('-bot', '').replace('-all', '')
-				res_raw: Optional[str]
-				try:
-					prefix, typ, cls, target = trimmed_command.split()
-					assert typ == 'rank' and type(target) is str
-				except:
-					res_raw = None
-				else:
-					res_raw = stats_helper.show_rank(
-						self.server.get_plugin_command_source(),
-						cls, target,
-						list_bot='-bot' in command,
-						is_tell=False,
-						is_all='-all' in command,
-						is_called=True
-					)
-				if res_raw is not None:
-					lines = res_raw.splitlines()
-					stats_name = lines[0]
-					total = int(lines[-1].split(' ')[1])
-					result = StatsQueryResult.create(stats_name, lines[1:-1], total)
-				else:
-					result = StatsQueryResult.unknown_stat()
-		
+			result = self.query_stats(command)
+
 		if command == '!!online':
 			result = OnlineQueryResult.create(self.config.name, get_player_list())
    
 		if result is not None:
 			self.reply_command(sender, payload, result)
 
+	def query_stats(self, command: str) -> StatsQueryResult:
+		"""
+		Results are cached by (class, target, -bot, -all), since stats_helper scans the stats files of all players for each query
+		"""
+		try:
+			import stats_helper
+		except (ImportError, ModuleNotFoundError):
+			return StatsQueryResult.no_plugin()
+		trimmed_command = command.replace('-bot', '').replace('-all', '')
+		try:
+			prefix, typ, cls, target = trimmed_command.split()
+			assert typ == 'rank' and type(target) is str
+		except:
+			return StatsQueryResult.unknown_stat()
+		key = (cls, target, '-bot' in command, '-all' in command)
+		result = self.stats_cache.get(key)
+		if result is None:
+			res_raw: Optional[str] = stats_helper.show_rank(
+				self.server.get_plugin_command_source(),
+				cls, target,
+				list_bot=key[2],
+				is_tell=False,
+				is_all=key[3],
+				is_called=True
+			)
+			if res_raw is not None:
+				lines = res_raw.splitlines()
+				stats_name = lines[0]
+				total = int(lines[-1].split(' ')[1])
+				result = StatsQueryResult.create(stats_name, lines[1:-1], total)
+			else:
+				result = StatsQueryResult.unknown_stat()
+			self.stats_cache.put(key, result)
+		return result
+
 
 META = ServerInterface.get_instance().as_plugin_server_interface().get_self_metadata()
 Prefixes = ('!!ChatBridge', '!!cb')
 client: Optional[ChatBridgeMCDRClient] = None
 config: Optional[MCDRClientConfig] = None
+reconnect_manager: Optional[utils.ReconnectManager] = None
 plugin_unload_flag = False
 cb_stop_done = Event()
 cb_lock = Lock()
+MESSENGER_QUEUE_SIZE = 1024  # chat messages waiting to be sent, the oldest ones are dropped beyond this
 
 online_players = []
 
@@ -110,7 +118,7 @@ def display_status(source: CommandSource):
 	if config is None or client is None:
 		source.reply(tr('status.not_init'))
 	else:
-		source.reply(tr('status.info', client.is_online(), client.get_ping_text()))
+		source.reply(tr('status.info', client.is_online(), client.get_ping_text(), reconnect_manager.stats if reconnect_manager is not None else 'N/A', client.stats_cache))
 
 
 @new_thread('ChatBridge-restart')
@@ -124,6 +132,9 @@ def restart_client(source: CommandSource):
 def on_unload(server: PluginServerInterface):
 	global plugin_unload_flag
 	plugin_unload_flag = True
+	if reconnect_manager is not None:
+		reconnect_manager.stop()
+	messenger.stop(timeout=10)
 	with cb_lock:
 		if client is not None and client.is_running():
 			server.logger.info('Stopping chatbridge client due to plugin unload')
@@ -131,16 +142,27 @@ def on_unload(server: PluginServerInterface):
 	cb_stop_done.set()
 
 
-@new_thread('ChatBridge-messenger')
-def send_chat(message: str, *, author: str = ''):
+def send_chats(chats: List[Tuple[str, str]]):
+	"""
+	Send a burst of (message, author) in the messenger thread. They are queued for the writer thread of the client back to back,
+	so the writer sends them together instead of one write for each
+	"""
 	with cb_lock:
-		if client is not None:
-			if not client.is_running():
-				client.start()
-			if client.is_online():
+		if client is not None and (client.is_online() or client.get_outbox() is not None):  # the reconnect manager starts it
+			for message, author in chats:
 				client.broadcast_chat(message, author)
 
 
+messenger: utils.BatchWorker[Tuple[str, str]] = utils.BatchWorker(send_chats, max_size=MESSENGER_QUEUE_SIZE, name='ChatBridge-messenger')
+
+
+def send_chat(message: str, *, author: str = ''):
+	"""
+	Never blocks, so it's fine to be called in MCDR event handlers
+	"""
+	messenger.put((message, author))
+
+
 def on_load(server: PluginServerInterface, old_module):
 	global online_players
 	if old_module is not None and hasattr(old_module, 'online_players'):
@@ -192,7 +214,8 @@ def on_load(server: PluginServerInterface, old_module):
 					server.logger.warning('Previous chatbridge instance does not stop for 30s')
 			server.logger.info('Starting chatbridge client')
 			client.start()
-			utils.start_guardian(client, wait_time=60, loop_condition=lambda: not plugin_unload_flag)
+			global reconnect_manager
+			reconnect_manager = utils.start_guardian(client, wait_time=60, loop_condition=lambda: not plugin_unload_flag)
 
 	start()
 
@@ -212,6 +235,8 @@ def on_player_joined(server: PluginServerInterface, player_name: str, info: Info
 def on_player_left(server: PluginServerInterface, player_name: str):
 	if player_name in online_players:
 		online_players.remove(player_name)
+	if client is not None and config.clear_stats_cache_on_leave:
+		client.stats_cache.clear()
 	if config.boardcast_player:
 		send_chat('{} left {}'.format(player_name, config.name))
 
@@ -1,13 +1,20 @@
+import asyncio
+import collections
 import json
 import os
+import random
 import time
-from threading import Thread
-from typing import Type, TypeVar, Callable
+from threading import Thread, Lock, Condition
+from typing import Type, TypeVar, Callable, Generic, Optional, List, Hashable, Tuple, Deque
 
-from chatbridge.core.client import ChatBridgeClient
+from chatbridge.common.logger import ChatBridgeLogger
+from chatbridge.common.scheduler import get_scheduler, TimerHandle
+from chatbridge.core.client import ChatBridgeClient, ClientStopEvent
 from chatbridge.core.config import BasicConfig
 
 T = TypeVar('T', BasicConfig, BasicConfig)
+Item = TypeVar('Item')
+Key = TypeVar('Key', bound=Hashable)
 
 
 def load_config(config_path: str, config_class: Type[T]) -> T:
@@ -26,17 +33,286 @@ def load_config(config_path: str, config_class: Type[T]) -> T:
 		return config
 
 
-def start_guardian(client: ChatBridgeClient, wait_time: float = 10, loop_condition: Callable[[], bool] = lambda: True) -> Thread:
-	def loop():
-		first = True
-		while loop_condition():
-			if not client.is_running():
-				client.logger.info('Guardian triggered {}'.format('start' if first else 'restart'))
-				client.start()
-			first = False
-			time.sleep(wait_time)
-		client.logger.info('Guardian stopped')
-
-	thread = Thread(name='ChatBridge Guardian', target=loop, daemon=True)
-	thread.start()
-	return thread
+class ReconnectStats:
+	"""
+	Reconnection timing of a :class:`ReconnectManager`, to tune its delays
+	"""
+	def __init__(self):
+		self.disconnects = 0  # unexpected disconnections after getting online
+		self.attempts = 0  # connection attempts, including the first one
+		self.failures = 0  # attempts that didn't get online
+		self.backoff_level = 0  # failed or short-lived connections in a row, the exponent of the next delay
+		self.last_delay = 0.0  # seconds waited before the latest attempt
+		self.last_downtime = 0.0  # seconds from the latest unexpected disconnection until online again
+		self.max_downtime = 0.0
+
+	def __str__(self):
+		return 'disconnects = {}, attempts = {}, failures = {}, backoff level = {}, last delay = {}s, last downtime = {}s, max downtime = {}s'.format(
+			self.disconnects, self.attempts, self.failures, self.backoff_level, round(self.last_delay, 2), round(self.last_downtime, 2), round(self.max_downtime, 2)
+		)
+
+
+class ReconnectManager:
+	"""
+	Keep a client running. It's reconnected as soon as it stops unexpectedly, i.e. not by stop() or restart().
+	If the connection fails, or doesn't last for stable_time seconds, later attempts are delayed exponentially up to max_delay.
+	Delays are jittered, so clients disconnected together, e.g. by a server restart, don't reconnect in lockstep
+
+	Attempts are scheduler timers, a thread is only used while the client is starting
+	"""
+	def __init__(self, client: ChatBridgeClient, *, initial_delay: float = 1, max_delay: float = 60, stable_time: float = 30, loop_condition: Callable[[], bool] = lambda: True):
+		"""
+		:param loop_condition: Checked before each attempt. The manager stops if it returns False
+		"""
+		self.client = client
+		self.initial_delay = initial_delay
+		self.max_delay = max_delay
+		self.stable_time = stable_time
+		self.loop_condition = loop_condition
+		self.stats = ReconnectStats()
+		self.__lock = Lock()
+		self.__running = False
+		self.__timer: Optional[TimerHandle] = None
+		self.__disconnected_at: Optional[float] = None
+		client.add_stop_listener(self.__on_client_stop)
+
+	def start(self):
+		"""
+		Start the client, and keep it running
+		"""
+		with self.__lock:
+			if not self.__running:
+				self.__running = True
+				self.__schedule(0)
+
+	def stop(self):
+		"""
+		Stop reconnecting. The client is not stopped
+		"""
+		with self.__lock:
+			self.__running = False
+			if self.__timer is not None:
+				self.__timer.cancel()
+				self.__timer = None
+
+	def is_running(self) -> bool:
+		return self.__running
+
+	def get_delay(self, backoff_level: int) -> float:
+		if backoff_level <= 0:
+			return 0
+		delay = min(self.max_delay, self.initial_delay * 2 ** (backoff_level - 1))
+		return delay / 2 + random.uniform(0, delay / 2)
+
+	def __schedule(self, delay: float):
+		self.stats.last_delay = delay
+		self.__timer = get_scheduler().call_later(delay, self.__on_timer)
+
+	def __on_client_stop(self, event: ClientStopEvent):
+		if event.requested:
+			return
+		with self.__lock:
+			if not self.__running:
+				return
+			if event.online_time > 0:
+				self.stats.disconnects += 1
+				self.__disconnected_at = time.monotonic()
+			else:
+				self.stats.failures += 1
+			if event.online_time >= self.stable_time:
+				self.stats.backoff_level = 0
+			else:
+				self.stats.backoff_level += 1
+			delay = self.get_delay(self.stats.backoff_level)
+			if delay > 0:
+				self.client.logger.info('Reconnecting in {}s'.format(round(delay, 2)))
+			self.__schedule(delay)
+
+	def __on_timer(self):
+		with self.__lock:
+			self.__timer = None
+			if not self.__running:
+				return
+			if not self.loop_condition():
+				self.__running = False
+				self.client.logger.info('Reconnect manager stopped')
+				return
+		if not self.client.is_running():
+			Thread(name='ChatBridge-Reconnect', target=self.__attempt, daemon=True).start()
+
+	def __attempt(self):
+		self.stats.attempts += 1
+		self.client.logger.info('Connecting, attempt #{}'.format(self.stats.attempts))
+		try:
+			self.client.start()
+		except Exception:
+			self.client.logger.exception('Failed to start the client')
+			with self.__lock:
+				if self.__running:
+					self.stats.backoff_level += 1
+					self.__schedule(self.get_delay(self.stats.backoff_level))
+			return
+		if self.client.is_online():
+			with self.__lock:
+				if self.__disconnected_at is not None:
+					self.stats.last_downtime = time.monotonic() - self.__disconnected_at
+					self.stats.max_downtime = max(self.stats.max_downtime, self.stats.last_downtime)
+					self.__disconnected_at = None
+
+
+def start_guardian(client: ChatBridgeClient, wait_time: float = 10, loop_condition: Callable[[], bool] = lambda: True) -> ReconnectManager:
+	"""
+	Start the client and keep it running with a :class:`ReconnectManager`, until loop_condition returns False
+	:param wait_time: The maximum delay between reconnection attempts
+	"""
+	manager = ReconnectManager(client, max_delay=wait_time, loop_condition=loop_condition)
+	manager.start()
+	return manager
+
+
+class AsyncHandoffQueue(Generic[Item]):
+	"""
+	Hands items from any thread, e.g. the ChatBridge client threads, over to a coroutine in an asyncio event loop.
+	The waiting coroutine is woken up as soon as an item arrives, instead of polling
+
+	The event loop is the one that first awaits :meth:`get`. Items put before that are kept until then
+	"""
+	def __init__(self):
+		self.__lock = Lock()
+		self.__loop: Optional[asyncio.AbstractEventLoop] = None
+		self.__queue: Optional[asyncio.Queue] = None
+		self.__pending: List[Item] = []
+
+	def put(self, item: Item):
+		with self.__lock:
+			if self.__loop is None:
+				self.__pending.append(item)
+				return
+			loop, queue = self.__loop, self.__queue
+		try:
+			loop.call_soon_threadsafe(queue.put_nowait, item)
+		except RuntimeError:  # the event loop is closed
+			pass
+
+	async def get(self) -> Item:
+		if self.__queue is None:
+			with self.__lock:
+				self.__loop = asyncio.get_event_loop()
+				self.__queue = asyncio.Queue()
+				for item in self.__pending:
+					self.__queue.put_nowait(item)
+				self.__pending.clear()
+		return await self.__queue.get()
+
+
+class BatchWorker(Generic[Item]):
+	"""
+	A single long-lived thread handling items put from any thread, e.g. event handlers that must not block.
+	Items put while a batch is being handled are handled together in the next batch, so bursts cost one handler call
+
+	The queue is bounded, and the oldest items are dropped when it's full, so :meth:`put` never blocks
+	"""
+	def __init__(self, handler: Callable[[List[Item]], None], *, max_size: int, name: str):
+		self.logger = ChatBridgeLogger(name)
+		self.max_size = max_size
+		self.name = name
+		self.dropped_count = 0
+		self.__handler = handler
+		self.__queue: Deque[Item] = collections.deque()
+		self.__condition = Condition(Lock())
+		self.__thread: Optional[Thread] = None
+		self.__stopped = False
+
+	def __len__(self) -> int:
+		return len(self.__queue)
+
+	def put(self, item: Item) -> bool:
+		"""
+		:return: If the item is queued, i.e. the worker is not stopped
+		"""
+		with self.__condition:
+			if self.__stopped:
+				return False
+			self.__queue.append(item)
+			if len(self.__queue) > self.max_size:
+				self.__queue.popleft()
+				self.dropped_count += 1
+			if self.__thread is None:
+				self.__thread = Thread(name=self.name, target=self.__run, daemon=True)
+				self.__thread.start()
+			else:
+				self.__condition.notify()
+			return True
+
+	def stop(self, timeout: Optional[float] = None):
+		"""
+		Stop the thread after the queued items are handled
+		"""
+		with self.__condition:
+			self.__stopped = True
+			self.__condition.notify()
+			thread = self.__thread
+		if thread is not None:
+			thread.join(timeout)
+
+	def __run(self):
+		while True:
+			with self.__condition:
+				while len(self.__queue) == 0 and not self.__stopped:
+					self.__condition.wait()
+				if len(self.__queue) == 0:
+					return
+				batch = list(self.__queue)
+				self.__queue.clear()
+			try:
+				self.__handler(batch)
+			except Exception:
+				self.logger.exception('Error handling {} items'.format(len(batch)))
+
+
+class TtlCache(Generic[Key, Item]):
+	"""
+	A size-bounded cache of results that expire after a ttl. The least recently used result is evicted when it's full
+	"""
+	def __init__(self, max_size: int, ttl: float):
+		"""
+		:param ttl: In seconds, 0 to disable the cache
+		"""
+		self.max_size = max_size
+		self.ttl = ttl
+		self.hit_count = 0
+		self.miss_count = 0
+		self.__lock = Lock()
+		self.__items: 'collections.OrderedDict[Key, Tuple[float, Item]]' = collections.OrderedDict()  # key -> (expiry time, item)
+
+	def __str__(self):
+		return 'size = {}, hits = {}, misses = {}'.format(len(self.__items), self.hit_count, self.miss_count)
+
+	def __len__(self) -> int:
+		return len(self.__items)
+
+	def get(self, key: Key) -> Optional[Item]:
+		with self.__lock:
+			entry = self.__items.get(key)
+			if entry is not None and entry[0] <= time.monotonic():
+				del self.__items[key]
+				entry = None
+			if entry is None:
+				self.miss_count += 1
+				return None
+			self.__items.move_to_end(key)
+			self.hit_count += 1
+			return entry[1]
+
+	def put(self, key: Key, item: Item):
+		if self.ttl <= 0 or self.max_size <= 0:
+			return
+		with self.__lock:
+			self.__items[key] = (time.monotonic() + self.ttl, item)
+			self.__items.move_to_end(key)
+			while len(self.__items) > self.max_size:
+				self.__items.popitem(last=False)
+
+	def clear(self):
+		with self.__lock:
+			self.__items.clear()
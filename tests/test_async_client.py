@@ -0,0 +1,79 @@
+import asyncio
+import unittest
+
+from chatbridge.core.async_client import AsyncChatBridgeClient
+from chatbridge.core.config import ClientInfo
+from chatbridge.core.network.protocol import PacketType, ChatPayload, CommandPayload
+from chatbridge.core.server import ServerEngine
+from tests.test_server import KEY, free_address, _Server
+
+
+class _AsyncClient(AsyncChatBridgeClient):
+	def get_logging_file_name(self):
+		return None
+
+
+class AsyncClientTest(unittest.TestCase):
+	def setUp(self):
+		self.address = free_address()
+		self.server = _Server(KEY, self.address, engine=ServerEngine.asyncio)
+		for name in ('a', 'b'):
+			self.server.add_client(ClientInfo(name=name, password='pw'))
+		self.server.start()
+
+	def tearDown(self):
+		self.server.stop()
+
+	def create_client(self, name: str, password: str = 'pw') -> AsyncChatBridgeClient:
+		return _AsyncClient(KEY, ClientInfo(name=name, password=password), server_address=self.address)
+
+	def run_async(self, coro):
+		loop = asyncio.new_event_loop()
+		try:
+			return loop.run_until_complete(asyncio.wait_for(coro, 10))
+		finally:
+			loop.close()
+
+	def test_chat_and_command(self):
+		async def test():
+			a, b = self.create_client('a'), self.create_client('b')
+			await a.connect()
+			await b.connect()
+			self.assertTrue(a.is_online())
+			await a.broadcast_chat('hello', 'Steve')
+			await a.send_command('b', '!!ping', {'x': 1})
+			packets = b.__aiter__()
+			packet = await packets.__anext__()
+			self.assertEqual((PacketType.chat, 'a'), (packet.type, packet.sender))
+			self.assertEqual('<Steve> hello', ChatPayload.deserialize(packet.payload).formatted_str())
+			packet = await packets.__anext__()
+			command = CommandPayload.deserialize(packet.payload)
+			self.assertEqual(('!!ping', {'x': 1}), (command.command, command.params))
+			await b.reply_command('a', command, {'pong': True})
+			async for packet in a:
+				self.assertEqual({'pong': True}, CommandPayload.deserialize(packet.payload).result)
+				break
+			await a.close()
+			await b.close()
+			self.assertFalse(a.is_online())
+			self.assertEqual(('a', 'hello'), self.server.chats.get(timeout=1))
+
+		self.run_async(test())
+
+	def test_iteration_ends_when_closed(self):
+		async def test():
+			a = self.create_client('a')
+			await a.connect()
+			asyncio.get_event_loop().call_later(0.2, lambda: self.server.clients['a'].stop())
+			async for _ in a:
+				self.fail('Nothing should be received')
+			self.assertFalse(a.is_online())
+
+		self.run_async(test())
+
+	def test_wrong_password(self):
+		async def test():
+			with self.assertRaises(asyncio.IncompleteReadError):
+				await self.create_client('a', 'wrong').connect()
+
+		self.run_async(test())
@@ -0,0 +1,53 @@
+import unittest
+
+from chatbridge.core.network.codec import JSON_CODEC, MsgpackCodec, select_codec
+from chatbridge.core.network.protocol import ChatBridgePacket, PacketType, LoginPacket, ProtocolFeature
+
+
+def packet(type_: str, payload: dict) -> ChatBridgePacket:
+	return ChatBridgePacket(sender='a', receivers=['b', 'c'], broadcast=False, type=type_, payload=payload)
+
+
+@unittest.skipUnless(MsgpackCodec.is_available(), 'msgpack is not installed')
+class MsgpackCodecTest(unittest.TestCase):
+	def setUp(self):
+		self.codec = MsgpackCodec()
+
+	def assertSameAsJson(self, obj):
+		expected = JSON_CODEC.decode(JSON_CODEC.encode(obj))
+		self.assertEqual(expected, self.codec.decode(self.codec.encode(obj)))
+
+	def test_standard_payloads(self):
+		self.assertSameAsJson(packet(PacketType.keep_alive, {'ping_type': 'ping'}))
+		self.assertSameAsJson(packet(PacketType.chat, {'author': 'Steve', 'message': 'hi'}))
+		self.assertSameAsJson(packet(PacketType.command, {'cid': 'x', 'command': '!!stats', 'responded': False, 'params': {}, 'result': {}}))
+		self.assertSameAsJson(packet(PacketType.custom, {'data': {'a': [1, 2.5, None, True]}}))
+
+	def test_non_standard_payload(self):
+		self.assertSameAsJson(packet(PacketType.chat, {'author': 'Steve', 'message': 'hi', 'extra': 1}))
+		self.assertSameAsJson(packet('third_party.type', {'x': 'y'}))
+
+	def test_other_packets(self):
+		self.assertSameAsJson(LoginPacket(name='a', password='b', features=['x'], nonce='00'))
+
+	def test_non_str_keys(self):
+		self.assertSameAsJson(packet(PacketType.custom, {'data': {1: 'a', 1.5: 'b', None: 'c', False: 'd', 'e': {2: (3, 4)}}}))
+
+	def test_big_int(self):
+		self.assertSameAsJson(packet(PacketType.custom, {'data': {'big': 1 << 80, 'small': -(1 << 70)}}))
+
+	def test_bad_data(self):
+		for data in (b'\xc1', b'\x93\x01\x02\x03', b'\x95\x01\xa1a\x90\xc2\x92\x01'):
+			with self.assertRaises(ValueError):
+				self.codec.decode(data)
+
+
+class SelectCodecTest(unittest.TestCase):
+	def test_select(self):
+		self.assertIs(JSON_CODEC, select_codec([]))
+		if MsgpackCodec.is_available():
+			self.assertIsInstance(select_codec([ProtocolFeature.codec_msgpack]), MsgpackCodec)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,113 @@
+import queue
+import time
+import unittest
+
+from chatbridge.core.commands import CommandAggregator, CommandCoalescer
+from chatbridge.core.network.protocol import CommandPayload, CommandAggregatePayload
+
+
+class CommandAggregatorTest(unittest.TestCase):
+	def setUp(self):
+		self.sent = queue.Queue()
+		self.aggregator = CommandAggregator(0.1, lambda asker, payload: self.sent.put((asker, payload)))
+		self.ask = CommandPayload.ask('!!online')
+
+	def test_merge(self):
+		self.aggregator.track('bot', self.ask, ['a', 'b'])
+		self.assertTrue(self.aggregator.on_reply('a', 'bot', CommandPayload.answer(self.ask, {'n': 1})))
+		self.assertTrue(self.sent.empty())
+		self.assertTrue(self.aggregator.on_reply('b', 'bot', CommandPayload.answer(self.ask, {'n': 2})))
+		asker, payload = self.sent.get_nowait()
+		self.assertEqual('bot', asker)
+		self.assertEqual({'a': {'n': 1}, 'b': {'n': 2}}, payload.results)
+		self.assertEqual([], payload.missing)
+		self.assertEqual(0, len(self.aggregator))
+		self.assertEqual(2, self.aggregator.merged_count)
+
+	def test_timeout(self):
+		self.aggregator.track('bot', self.ask, ['a', 'b'])
+		self.aggregator.on_reply('a', 'bot', CommandPayload.answer(self.ask, {'n': 1}))
+		asker, payload = self.sent.get(timeout=5)
+		self.assertEqual({'a': {'n': 1}}, payload.results)
+		self.assertEqual(['b'], payload.missing)
+		self.assertEqual(1, self.aggregator.timed_out_count)
+		self.assertFalse(self.aggregator.on_reply('b', 'bot', CommandPayload.answer(self.ask, {'n': 2})))  # forwarded as usual
+
+	def test_not_tracked(self):
+		self.aggregator.track('bot', self.ask, ['a'])
+		self.assertFalse(self.aggregator.on_reply('c', 'bot', CommandPayload.answer(self.ask, {})))  # not a receiver
+		self.assertFalse(self.aggregator.on_reply('a', 'other', CommandPayload.answer(self.ask, {})))  # not the asker
+		self.assertFalse(self.aggregator.on_reply('a', 'bot', CommandPayload.answer(CommandPayload.ask('!!online'), {})))
+		self.aggregator.clear()
+		self.assertEqual(0, len(self.aggregator))
+
+	def test_no_receivers(self):
+		self.aggregator.track('bot', self.ask, [])
+		asker, payload = self.sent.get_nowait()
+		self.assertEqual(('bot', {}, []), (asker, payload.results, payload.missing))
+		self.assertEqual(0, len(self.aggregator))
+
+	def test_replies(self):
+		payload = CommandAggregatePayload(cid='cid', command='!!online', params={'p': 1}, results={'a': {'n': 1}}, missing=[])
+		reply = payload.get_replies()['a']
+		self.assertTrue(reply.responded)
+		self.assertEqual(('cid', '!!online', {'p': 1}, {'n': 1}), (reply.cid, reply.command, reply.params, reply.result))
+
+
+class CommandCoalescerTest(unittest.TestCase):
+	def setUp(self):
+		self.sent = queue.Queue()
+		self.coalescer = CommandCoalescer(0.1, 0, lambda sender, asker, payload: self.sent.put((sender, asker, payload)))
+
+	def test_coalesce(self):
+		first = CommandPayload.ask('!!stats', {'from_channel': 1})
+		second = CommandPayload.ask('!!stats', {'from_channel': 2})
+		self.assertTrue(self.coalescer.on_command('bot1', 'mc', first))
+		self.assertFalse(self.coalescer.on_command('bot2', 'mc', second))
+		self.coalescer.on_reply('mc', 'bot1', CommandPayload.answer(first, {'n': 1}))
+		sender, asker, reply = self.sent.get_nowait()
+		self.assertEqual(('mc', 'bot2'), (sender, asker))
+		self.assertEqual((second.cid, {'from_channel': 2}, {'n': 1}), (reply.cid, reply.params, reply.result))
+		self.assertTrue(self.sent.empty())
+		self.assertEqual((1, 1, 0), (self.coalescer.hit_count, self.coalescer.miss_count, len(self.coalescer)))
+		self.assertTrue(self.coalescer.on_command('bot2', 'mc', CommandPayload.ask('!!stats')))  # no result ttl
+
+	def test_different_commands(self):
+		self.assertTrue(self.coalescer.on_command('bot', 'mc', CommandPayload.ask('!!stats', {'name': 'a'})))
+		self.assertTrue(self.coalescer.on_command('bot', 'mc', CommandPayload.ask('!!stats', {'name': 'b'})))
+		self.assertTrue(self.coalescer.on_command('bot', 'mc2', CommandPayload.ask('!!stats', {'name': 'a'})))
+		self.assertTrue(self.coalescer.on_command('bot', 'mc', CommandPayload.ask('!!online')))
+		self.assertEqual(4, self.coalescer.miss_count)
+
+	def test_timeout(self):
+		first = CommandPayload.ask('!!online')
+		self.assertTrue(self.coalescer.on_command('bot', 'mc', first))
+		follower = CommandPayload.ask('!!online', {'from_channel': 2})
+		self.assertFalse(self.coalescer.on_command('bot2', 'mc', follower))
+		sender, receiver, command = self.sent.get(timeout=5)  # forwarded on its own once the leader times out
+		self.assertEqual(('bot2', 'mc', follower), (sender, receiver, command))
+		self.assertEqual((1, 1, 1), (self.coalescer.hit_count, self.coalescer.miss_count, self.coalescer.timed_out_count))
+		self.assertTrue(self.coalescer.on_command('bot', 'mc', CommandPayload.ask('!!online')))  # forwarded again
+		self.coalescer.on_reply('mc', 'bot', CommandPayload.answer(first, {}))  # late reply of the expired one
+		self.coalescer.on_reply('mc', 'bot2', CommandPayload.answer(follower, {}))  # forwarded to bot2 as usual
+		self.assertTrue(self.sent.empty())
+		self.assertEqual(1, len(self.coalescer))
+		self.coalescer.clear()
+		self.assertEqual(0, len(self.coalescer))
+
+	def test_result_ttl(self):
+		coalescer = CommandCoalescer(0.1, 0.2, lambda sender, asker, payload: self.sent.put((sender, asker, payload)))
+		first = CommandPayload.ask('!!online')
+		self.assertTrue(coalescer.on_command('bot1', 'mc', first))
+		coalescer.on_reply('mc', 'bot1', CommandPayload.answer(first, {'n': 1}))
+		second = CommandPayload.ask('!!online')
+		self.assertFalse(coalescer.on_command('bot2', 'mc', second))
+		sender, asker, reply = self.sent.get_nowait()
+		self.assertEqual(('mc', 'bot2', second.cid, {'n': 1}), (sender, asker, reply.cid, reply.result))
+		time.sleep(0.3)
+		self.assertTrue(coalescer.on_command('bot2', 'mc', CommandPayload.ask('!!online')))
+		self.assertEqual((1, 2), (coalescer.hit_count, coalescer.miss_count))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from chatbridge.core.config import ClientInfo
+from chatbridge.impl.utils import AsyncHandoffQueue, ReconnectManager, TtlCache, BatchWorker
+from tests.test_server import _Server, _Client, free_address, KEY
+
+
+class AsyncHandoffQueueTest(unittest.TestCase):
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+
+	def tearDown(self):
+		asyncio.set_event_loop(None)
+		self.loop.close()
+
+	def test_items_before_loop(self):
+		queue = AsyncHandoffQueue()
+		queue.put(1)
+		queue.put(2)
+
+		async def get_all():
+			return [await queue.get(), await queue.get()]
+
+		self.assertEqual([1, 2], self.loop.run_until_complete(get_all()))
+
+	def test_wake_up_from_thread(self):
+		queue = AsyncHandoffQueue()
+
+		async def get_all():
+			first = await queue.get()  # no item yet, the loop is bound here
+			threading.Thread(target=lambda: [queue.put(i) for i in range(2, 100)]).start()
+			return [first] + [await asyncio.wait_for(queue.get(), 5) for _ in range(2, 100)]
+
+		self.loop.call_later(0.05, lambda: threading.Thread(target=queue.put, args=(1,)).start())
+		self.assertEqual(list(range(1, 100)), self.loop.run_until_complete(get_all()))
+
+
+class ReconnectManagerTest(unittest.TestCase):
+	def setUp(self):
+		self.address = free_address()
+		self.server = _Server(KEY, self.address)
+		self.server.add_client(ClientInfo(name='a', password='pw'))
+		self.client = _Client(KEY, ClientInfo(name='a', password='pw'), server_address=self.address)
+		self.manager = ReconnectManager(self.client, initial_delay=0.05, max_delay=0.2)
+
+	def tearDown(self):
+		self.manager.stop()
+		if self.client.is_running():
+			self.client.stop()
+		self.server.stop()
+
+	def wait_until(self, condition, message: str):
+		for _ in range(250):
+			if condition():
+				return
+			time.sleep(0.02)
+		self.fail(message)
+
+	def test_delay(self):
+		self.assertEqual(0, self.manager.get_delay(0))
+		for level, delay in ((1, 0.05), (2, 0.1), (3, 0.2), (10, 0.2)):
+			self.assertTrue(delay / 2 <= self.manager.get_delay(level) <= delay)
+
+	def test_reconnect_on_disconnect(self):
+		self.server.start()
+		self.manager.start()
+		self.wait_until(self.client.is_online, 'Client is not started')
+		self.server.clients['a'].stop()
+		self.wait_until(lambda: self.manager.stats.disconnects == 1, 'Disconnection is not noticed')
+		self.wait_until(self.client.is_online, 'Client is not reconnected')
+		self.assertEqual(2, self.manager.stats.attempts)
+		self.assertLess(self.manager.stats.last_downtime, 1)
+
+	def test_backoff(self):
+		self.manager.start()  # no server yet
+		self.wait_until(lambda: self.manager.stats.failures >= 4, 'Client is not retried')
+		self.assertGreaterEqual(self.manager.stats.backoff_level, 4)
+		self.assertLessEqual(self.manager.stats.last_delay, 0.2)
+		self.server.start()
+		self.wait_until(self.client.is_online, 'Client is not reconnected')
+		self.wait_until(lambda: self.server.clients['a'].is_online(), 'Client is not reconnected')
+
+	def test_requested_stop(self):
+		self.server.start()
+		self.manager.start()
+		self.wait_until(self.client.is_online, 'Client is not started')
+		self.client.stop()
+		time.sleep(0.3)
+		self.assertFalse(self.client.is_running())
+		self.assertEqual(1, self.manager.stats.attempts)
+
+	def test_loop_condition(self):
+		self.manager.loop_condition = lambda: False
+		self.manager.start()
+		self.wait_until(lambda: not self.manager.is_running(), 'Manager is not stopped')
+		self.assertEqual(0, self.manager.stats.attempts)
+
+
+class TtlCacheTest(unittest.TestCase):
+	def test_expire(self):
+		cache = TtlCache(10, 0.1)
+		cache.put('a', 1)
+		self.assertEqual(1, cache.get('a'))
+		time.sleep(0.2)
+		self.assertIsNone(cache.get('a'))
+		self.assertEqual((1, 1, 0), (cache.hit_count, cache.miss_count, len(cache)))
+
+	def test_lru(self):
+		cache = TtlCache(2, 60)
+		cache.put('a', 1)
+		cache.put('b', 2)
+		cache.get('a')
+		cache.put('c', 3)
+		self.assertEqual((1, None, 3), (cache.get('a'), cache.get('b'), cache.get('c')))
+		cache.clear()
+		self.assertEqual(0, len(cache))
+
+	def test_disabled(self):
+		cache = TtlCache(10, 0)
+		cache.put('a', 1)
+		self.assertIsNone(cache.get('a'))
+
+
+class BatchWorkerTest(unittest.TestCase):
+	def test_batch(self):
+		batches = []
+		blocked = threading.Event()
+		release = threading.Event()
+
+		def handle(batch):
+			batches.append(batch)
+			blocked.set()
+			release.wait(5)
+
+		worker = BatchWorker(handle, max_size=3, name='TestWorker')
+		worker.put(0)
+		self.assertTrue(blocked.wait(5))
+		for i in range(1, 6):  # queued while the first batch is handled, 1 and 2 are dropped
+			worker.put(i)
+		self.assertEqual(2, worker.dropped_count)
+		release.set()
+		worker.stop(5)
+		self.assertEqual([[0], [3, 4, 5]], batches)
+		self.assertFalse(worker.put(6))
+
+	def test_error_in_handler(self):
+		batches = []
+
+		def handle(batch):
+			batches.append(batch)
+			if batch == [0]:
+				raise ValueError('expected in test')
+
+		worker = BatchWorker(handle, max_size=10, name='TestWorker')
+		worker.put(0)
+		for _ in range(250):
+			if len(batches) > 0:
+				break
+			time.sleep(0.02)
+		worker.put(1)
+		worker.stop(5)
+		self.assertEqual([[0], [1]], batches)
+		self.assertEqual(0, len(worker))
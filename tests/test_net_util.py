@@ -0,0 +1,245 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from chatbridge.core.network import net_util
+from chatbridge.core.network.cryptor import AESCryptor
+from chatbridge.core.network.protocol import ChatBridgePacket
+from chatbridge.core.network.session import NetworkSession
+
+
+def frame(data: bytes) -> bytes:
+	return struct.pack('I', len(data)) + data
+
+
+class FrameReaderTest(unittest.TestCase):
+	def setUp(self):
+		self.sock, self.peer = socket.socketpair()
+
+	def tearDown(self):
+		self.sock.close()
+		self.peer.close()
+
+	def test_multiple_frames_in_one_read(self):
+		reader = net_util.FrameReader(self.sock)
+		self.peer.sendall(frame(b'a') + frame(b'bc') + frame(b''))
+		frames = []
+		while len(frames) < 3:
+			frames.extend(reader.read_frames(timeout=1))
+		self.assertEqual([b'a', b'bc', b''], frames)
+
+	def test_split_frames(self):
+		reader = net_util.FrameReader(self.sock, buffer_size=16)
+		payloads = [bytes([i]) * (i * 7) for i in range(1, 20)]
+		data = b''.join(map(frame, payloads))
+
+		def send():
+			for i in range(0, len(data), 5):  # header and body are split across reads
+				self.peer.sendall(data[i:i + 5])
+		thread = threading.Thread(target=send)
+		thread.start()
+		received = [reader.read_frame(timeout=5) for _ in payloads]
+		thread.join()
+		self.assertEqual(payloads, received)
+
+	def test_large_frame_grows_buffer(self):
+		reader = net_util.FrameReader(self.sock, buffer_size=16)
+		payload = bytes(range(256)) * 64
+		thread = threading.Thread(target=self.peer.sendall, args=(frame(payload) + frame(b'tail'),))
+		thread.start()
+		self.assertEqual(payload, reader.read_frame(timeout=5))
+		self.assertEqual(b'tail', reader.read_frame(timeout=5))
+		thread.join()
+
+	def test_frame_too_large(self):
+		reader = net_util.FrameReader(self.sock, max_frame_size=100)
+		self.peer.sendall(struct.pack('I', 101))
+		with self.assertRaises(net_util.FrameTooLarge):
+			reader.read_frame(timeout=1)
+
+	def test_empty_content(self):
+		reader = net_util.FrameReader(self.sock)
+		self.peer.sendall(b'\x01')
+		self.peer.close()
+		with self.assertRaises(net_util.EmptyContent):
+			reader.read_frame(timeout=1)
+
+
+
+class CountingSocket:
+	def __init__(self, sock: socket.socket):
+		self.sock = sock
+		self.send_count = 0
+
+	def sendmsg(self, buffers):
+		self.send_count += 1
+		return self.sock.sendmsg(buffers)
+
+
+class FrameWriterTest(unittest.TestCase):
+	def setUp(self):
+		self.sock, self.peer = socket.socketpair()
+		self.cryptor = AESCryptor('secret')
+
+	def tearDown(self):
+		self.sock.close()
+		self.peer.close()
+
+	def create_session(self) -> NetworkSession:
+		return NetworkSession(self.cryptor, max_message_size=net_util.DEFAULT_MAX_FRAME_SIZE)
+
+	@staticmethod
+	def packet(sender: str, index: int) -> ChatBridgePacket:
+		return ChatBridgePacket(sender=sender, receivers=[], broadcast=True, type='test', payload={'index': index, 'data': 'x' * (index % 500)})
+
+	def write_concurrently(self, writer: net_util.FrameWriter, thread_count: int, packet_count: int):
+		threads = [
+			threading.Thread(target=lambda name=str(i): [writer.write(self.packet(name, j)) for j in range(packet_count)])
+			for i in range(thread_count)
+		]
+		reader = net_util.FrameReader(self.peer)
+		session = self.create_session()
+		for thread in threads:
+			thread.start()
+		last_indexes = {}
+		for _ in range(thread_count * packet_count):
+			packet = ChatBridgePacket.deserialize(session.decode_packet(reader.read_frame(timeout=10)))
+			self.assertEqual(last_indexes.get(packet.sender, -1) + 1, packet.payload['index'])
+			last_indexes[packet.sender] = packet.payload['index']
+		for thread in threads:
+			thread.join()
+
+	def test_concurrent_writes(self):
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)  # partial sends
+		self.write_concurrently(net_util.FrameWriter(self.sock, self.create_session()), 8, 500)
+
+	def test_flush_delay(self):
+		counting_socket = CountingSocket(self.sock)
+		self.write_concurrently(net_util.FrameWriter(counting_socket, self.create_session(), flush_delay=0.05), 50, 1)
+		self.assertLess(counting_socket.send_count, 10)
+
+	def test_broken_connection(self):
+		writer = net_util.FrameWriter(self.sock, self.create_session())
+		self.peer.close()
+		with self.assertRaises(socket.error):
+			for i in range(100):
+				writer.write(self.packet('a', i))
+		with self.assertRaises(socket.error):
+			writer.write(self.packet('a', 0))
+
+
+
+class FakeWriter:
+	def __init__(self):
+		self.written = []
+		self.block = threading.Event()
+		self.block.set()
+
+	def write_all(self, packets):
+		self.block.wait()
+		self.written.extend(packets)
+
+
+def is_chat(packet) -> bool:
+	return packet.type == 'chat'
+
+
+class OutboundQueueTest(unittest.TestCase):
+	@staticmethod
+	def packet(type_: str, index: int) -> ChatBridgePacket:
+		return ChatBridgePacket(sender='a', receivers=[], broadcast=True, type=type_, payload={'index': index})
+
+	def test_drain(self):
+		writer = FakeWriter()
+		queue = net_util.OutboundQueue(writer, net_util.OutboundQueuePolicy(), is_droppable=is_chat)
+		thread = threading.Thread(target=queue.run)
+		thread.start()
+		packets = [self.packet('chat', i) for i in range(100)]
+		for packet in packets:
+			self.assertTrue(queue.put(packet))
+		while queue.depth > 0:
+			pass
+		queue.close()
+		thread.join()
+		self.assertEqual(packets, writer.written)
+
+	def test_drop_oldest_chat(self):
+		queue = net_util.OutboundQueue(FakeWriter(), net_util.OutboundQueuePolicy(max_size=10, high_water=3), is_droppable=is_chat)
+		queue.put(self.packet('command', 0))
+		for i in range(1, 6):
+			queue.put(self.packet('chat', i))
+		self.assertEqual(3, queue.depth)
+		self.assertEqual(3, queue.dropped_count)
+		self.assertTrue(queue.put(self.packet('chat', 6)))
+		self.assertEqual(4, queue.dropped_count)
+		self.assertEqual(3, queue.depth)
+
+	def test_full(self):
+		queue = net_util.OutboundQueue(FakeWriter(), net_util.OutboundQueuePolicy(max_size=3, high_water=2, drop_oldest_chat=False), is_droppable=is_chat)
+		for i in range(3):
+			self.assertTrue(queue.put(self.packet('command', i)))
+		self.assertFalse(queue.put(self.packet('chat', 3)))
+		self.assertFalse(queue.put(self.packet('command', 4)))
+		with self.assertRaises(net_util.SlowConsumer):
+			queue.run()
+
+	def test_slow_consumer_timeout(self):
+		queue = net_util.OutboundQueue(FakeWriter(), net_util.OutboundQueuePolicy(high_water=1, slow_consumer_timeout=0.05), is_droppable=is_chat)
+		queue.put(self.packet('command', 0))
+		queue.put(self.packet('command', 1))
+		time.sleep(0.1)
+		self.assertFalse(queue.put(self.packet('command', 2)))
+		with self.assertRaises(net_util.SlowConsumer):
+			queue.run()
+
+	def test_close_returns_unsent(self):
+		queue = net_util.OutboundQueue(FakeWriter(), net_util.OutboundQueuePolicy(), is_droppable=is_chat)
+		packets = [self.packet('command', i) for i in range(3)]
+		for packet in packets:
+			queue.put(packet)
+		self.assertEqual(packets, queue.close())
+		self.assertEqual(0, queue.depth)
+		self.assertFalse(queue.put(self.packet('command', 3)))
+		self.assertEqual([], queue.close())
+
+
+class OfflineQueueTest(unittest.TestCase):
+	def test_max_size(self):
+		queue = net_util.OfflineQueue(net_util.OfflineQueuePolicy(max_size=3, max_bytes=1000, ttl=0))
+		for i in range(5):
+			queue.put(i, 10)
+		self.assertEqual((3, 30, 2), (len(queue), queue.byte_size, queue.evicted_count))
+		self.assertEqual([2, 3, 4], queue.take_all())
+		self.assertEqual((0, 0), (len(queue), queue.byte_size))
+
+	def test_max_bytes(self):
+		queue = net_util.OfflineQueue(net_util.OfflineQueuePolicy(max_size=100, max_bytes=25, ttl=0))
+		for i in range(5):
+			queue.put(i, 10)
+		self.assertEqual([3, 4], queue.take_all())
+		queue.put('huge', 100)  # larger than the limit itself
+		self.assertEqual([], queue.take_all())
+		self.assertEqual(4, queue.evicted_count)
+
+	def test_put_first(self):
+		queue = net_util.OfflineQueue(net_util.OfflineQueuePolicy(max_size=4, max_bytes=1000, ttl=0))
+		queue.put(2, 10)
+		queue.put(3, 10)
+		queue.put_first([(0, 10), (1, 10)])
+		self.assertEqual((4, 40), (len(queue), queue.byte_size))
+		queue.put_first([(-1, 10)])  # the oldest are evicted
+		self.assertEqual([0, 1, 2, 3], queue.take_all())
+
+	def test_ttl(self):
+		queue = net_util.OfflineQueue(net_util.OfflineQueuePolicy(max_size=100, max_bytes=1000, ttl=0.05))
+		queue.put('old', 1)
+		time.sleep(0.1)
+		queue.put('new', 1)
+		self.assertEqual(['new'], queue.take_all())
+		self.assertEqual(1, queue.evicted_count)
+
+
+if __name__ == '__main__':
+	unittest.main()
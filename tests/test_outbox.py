@@ -0,0 +1,75 @@
+import os
+import tempfile
+import time
+import unittest
+
+from chatbridge.core.network.protocol import ChatBridgePacket, PacketType, ChatPayload
+from chatbridge.core.outbox import Outbox
+
+
+def chat(message: str) -> ChatBridgePacket:
+	return ChatBridgePacket(sender='a', receivers=[], broadcast=True, type=PacketType.chat, payload=ChatPayload(author='', message=message).serialize())
+
+
+def messages(packets):
+	return [packet.payload['message'] for packet in packets]
+
+
+class OutboxTest(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, 'outbox.jsonl')
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def test_accepts(self):
+		self.assertTrue(Outbox.accepts(chat('hi')))
+		keep_alive = ChatBridgePacket(sender='a', receivers=['server'], broadcast=False, type=PacketType.keep_alive, payload={'ping_type': 'ping'})
+		self.assertFalse(Outbox.accepts(keep_alive))
+
+	def test_max_size(self):
+		outbox = Outbox(3, 0)
+		for i in range(5):
+			outbox.put(chat(str(i)))
+		self.assertEqual(3, len(outbox))
+		self.assertEqual(2, outbox.dropped_count)
+		self.assertEqual(['2', '3', '4'], messages(outbox.take_all()))
+		self.assertEqual([], outbox.take_all())
+
+	def test_max_age(self):
+		outbox = Outbox(10, 0.05)
+		outbox.put(chat('old'))
+		time.sleep(0.1)
+		outbox.put(chat('new'))
+		self.assertEqual(['new'], messages(outbox.take_all()))
+		self.assertEqual(1, outbox.dropped_count)
+
+	def test_persistence(self):
+		outbox = Outbox(3, 0, file_path=self.path)
+		for i in range(10):  # rewritten when there are too many dropped lines
+			outbox.put(chat(str(i)))
+		with open(self.path, encoding='utf8') as file:
+			self.assertLessEqual(len(file.readlines()), 6)
+		with open(self.path, 'a', encoding='utf8') as file:
+			file.write('{"time": 1, "pack')  # cut by a crash
+		outbox = Outbox(3, 0, file_path=self.path)
+		packets = outbox.take_all()
+		self.assertEqual(['7', '8', '9'], messages(packets))
+		outbox.on_sent(packets)
+		self.assertEqual(0, outbox.taken_count)
+		self.assertEqual([], Outbox(3, 0, file_path=self.path).take_all())
+
+	def test_taken_kept_until_sent(self):
+		outbox = Outbox(10, 0, file_path=self.path)
+		for i in range(3):
+			outbox.put(chat(str(i)))
+		packets = outbox.take_all()
+		self.assertEqual((0, 3), (len(outbox), outbox.taken_count))
+		outbox.put(chat('3'))
+		self.assertEqual(['0', '1', '2', '3'], messages(Outbox(10, 0, file_path=self.path).take_all()))  # e.g. crashed before sending
+		outbox.on_sent([packets[0], chat('1')])  # only the packets taken are removed
+		self.assertEqual(2, outbox.taken_count)
+		self.assertEqual(['1', '2', '3'], messages(Outbox(10, 0, file_path=self.path).take_all()))
+		outbox.on_sent(packets)
+		self.assertEqual(['3'], messages(Outbox(10, 0, file_path=self.path).take_all()))
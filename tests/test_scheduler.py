@@ -0,0 +1,64 @@
+import threading
+import time
+import unittest
+
+from chatbridge.common.scheduler import TimerScheduler
+
+
+class TimerSchedulerTest(unittest.TestCase):
+	def setUp(self):
+		self.scheduler = TimerScheduler()
+		self.called = []
+		self.done = threading.Event()
+
+	def tearDown(self):
+		self.scheduler.stop()
+
+	def test_order(self):
+		self.scheduler.call_later(0.1, self.called.append, 3)
+		self.scheduler.call_later(0.05, self.called.append, 2)
+		self.scheduler.call_later(0, self.called.append, 1)
+		self.scheduler.call_later(0.15, self.done.set)
+		self.assertTrue(self.done.wait(5))
+		self.assertEqual([1, 2, 3], self.called)
+
+	def test_nearer_deadline_wakes_up(self):
+		self.scheduler.call_later(60, self.called.append, 'late')
+		start = time.monotonic()
+		self.scheduler.call_later(0.05, self.done.set)
+		self.assertTrue(self.done.wait(5))
+		self.assertLess(time.monotonic() - start, 5)
+		self.assertEqual([], self.called)
+		self.assertEqual(1, len(self.scheduler))
+
+	def test_cancel(self):
+		handle = self.scheduler.call_later(0.05, self.called.append, 'cancelled')
+		handle.cancel()
+		handle.cancel()
+		self.scheduler.call_later(0.1, self.done.set)
+		self.assertTrue(self.done.wait(5))
+		self.assertEqual([], self.called)
+		self.assertEqual(0, len(self.scheduler))
+
+	def test_error_in_callback(self):
+		def fail():
+			raise ValueError('expected in test')
+
+		self.scheduler.logger.disabled = True
+		self.scheduler.call_later(0, fail)
+		self.scheduler.call_later(0.05, self.done.set)
+		self.assertTrue(self.done.wait(5))
+
+	def test_single_thread(self):
+		before = threading.active_count()
+		for i in range(100):
+			self.scheduler.call_later(i / 1000, self.called.append, i)
+		self.scheduler.call_later(0.2, self.done.set)
+		self.assertTrue(self.done.wait(5))
+		self.assertEqual(list(range(100)), self.called)
+		self.assertEqual(before + 1, threading.active_count())
+
+	def test_stopped(self):
+		self.scheduler.stop()
+		with self.assertRaises(RuntimeError):
+			self.scheduler.call_later(0, self.done.set)
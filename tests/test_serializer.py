@@ -0,0 +1,115 @@
+import unittest
+from typing import List, Optional
+
+from chatbridge.common.serializer import NoMissingFieldSerializable, SlotSerializable
+from chatbridge.core.network.protocol import CommandPayload, ChatPayload
+
+
+class SlotData(SlotSerializable):
+	name: str
+	count: int
+	ratio: float
+	flag: bool
+	tags: List[str]
+	extra: dict
+	note: Optional[str] = None
+	items: List[int] = []
+
+
+class ReflectiveData(NoMissingFieldSerializable):
+	name: str
+	count: int
+	ratio: float
+	flag: bool
+	tags: List[str]
+	extra: dict
+	note: Optional[str] = None
+	items: List[int] = []
+
+
+VALID = {'name': 'a', 'count': 1, 'ratio': 0.5, 'flag': True, 'tags': ['x'], 'extra': {'k': [1]}}
+
+
+class SlotSerializableTest(unittest.TestCase):
+	def assertSameResult(self, data: dict, **kwargs):
+		"""
+		Both serializers either accept the data with the same result, or reject it with the same exception type
+		"""
+		try:
+			expected = ReflectiveData.deserialize(data, **kwargs).serialize()
+		except (TypeError, ValueError) as e:
+			with self.assertRaises(type(e), msg=str(data)):
+				SlotData.deserialize(data, **kwargs)
+		else:
+			self.assertEqual(expected, SlotData.deserialize(data, **kwargs).serialize(), msg=str(data))
+
+	def test_validation_parity(self):
+		cases = [
+			VALID,
+			{**VALID, 'ratio': 1},
+			{**VALID, 'count': True},
+			{**VALID, 'count': 1.0},
+			{**VALID, 'flag': 1},
+			{**VALID, 'tags': ['x', 1]},
+			{**VALID, 'tags': 'x'},
+			{**VALID, 'extra': []},
+			{**VALID, 'note': 'n', 'items': [1, 2]},
+			{**VALID, 'note': 1},
+			{**VALID, 'items': ['a']},
+			{**VALID, 'unknown': 1},
+			{key: value for key, value in VALID.items() if key != 'name'},
+		]
+		for data in cases:
+			self.assertSameResult(data)
+			self.assertSameResult(data, error_at_missing=False)
+			self.assertSameResult(data, error_at_redundancy=True)
+
+	def test_not_dict(self):
+		for data in ([], 'x', None):
+			with self.assertRaises(TypeError):
+				SlotData.deserialize(data)
+
+	def test_defaults_are_copied(self):
+		a, b = SlotData.deserialize(VALID), SlotData.deserialize(VALID)
+		a.items.append(1)
+		self.assertEqual([], b.items)
+		self.assertEqual([], SlotData(name='a').items)
+
+	def test_serialize_copies_containers(self):
+		data = SlotData.deserialize(VALID)
+		serialized = data.serialize()
+		self.assertIsNot(serialized['extra'], data.extra)
+		self.assertIsNot(serialized['extra']['k'], data.extra['k'])
+		self.assertIsNot(serialized['tags'], data.tags)
+
+	def test_partial(self):
+		data = SlotData.get_default()
+		self.assertEqual({'note': None, 'items': []}, data.serialize())
+		data.name = 'a'
+		self.assertEqual('a', data.serialize()['name'])
+
+	def test_init(self):
+		with self.assertRaises(KeyError):
+			SlotData(unknown=1)
+		self.assertEqual(SlotData.deserialize(VALID), SlotData(**VALID))
+		self.assertNotEqual(SlotData.deserialize(VALID), SlotData(**{**VALID, 'count': 2}))
+
+	def test_slots(self):
+		data = SlotData.deserialize(VALID)
+		self.assertFalse(hasattr(data, '__dict__'))
+		with self.assertRaises(AttributeError):
+			data.unknown = 1
+
+
+class CommandPayloadTest(unittest.TestCase):
+	def test_serializable_params(self):
+		chat = ChatPayload(author='a', message='m')
+		question = CommandPayload.ask('cmd', chat)
+		self.assertEqual(chat.serialize(), question.params)
+		answer = CommandPayload.answer(question, chat)
+		self.assertEqual(chat.serialize(), answer.result)
+		self.assertEqual(question.cid, answer.cid)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,370 @@
+import queue
+import socket
+import struct
+import threading
+import time
+import unittest
+from concurrent import futures
+from typing import List
+
+from chatbridge.common import constants
+from chatbridge.core.client import ChatBridgeClient
+from chatbridge.core.config import ClientInfo
+from chatbridge.core.network.basic import Address
+from chatbridge.core.network.protocol import ChatPayload, CommandPayload, ChatBridgePacket
+from chatbridge.core.outbox import Outbox
+from chatbridge.core.server import ChatBridgeServer, ServerEngine
+
+KEY = 'secret'
+
+
+def free_address() -> Address:
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return Address('127.0.0.1', sock.getsockname()[1])
+
+
+class _Server(ChatBridgeServer):
+	MAXIMUM_LOGIN_DURATION = 0.5
+	LOGIN_RATE_LIMIT = 0.1
+	LOGIN_RATE_BURST = 5
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.chats = queue.Queue()
+
+	def get_logging_file_name(self):
+		return None
+
+	def on_chat(self, sender: str, content: ChatPayload):
+		self.chats.put((sender, content.message))
+
+
+class _Client(ChatBridgeClient):
+	KEEP_ALIVE_INTERVAL = 0.05
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.chats = queue.Queue()
+		self.command_count = 0
+		self.lost_frame_count = 0  # frames to discard before decoding, as if lost in transit
+
+	def get_logging_file_name(self):
+		return None
+
+	def _decode_packet(self, frame: bytes, packet_type):
+		if packet_type is ChatBridgePacket and self.lost_frame_count > 0:
+			self.lost_frame_count -= 1
+			return None
+		return super()._decode_packet(frame, packet_type)
+
+	def on_chat(self, sender: str, payload: ChatPayload):
+		self.chats.put((sender, payload.message))
+
+	def on_command(self, sender: str, payload: CommandPayload):
+		if payload.responded:
+			return
+		self.command_count += 1
+		if payload.command == 'slow':
+			time.sleep(0.2)
+		if payload.command != 'ignore':
+			self.reply_command(sender, payload, {'name': self.get_name()})
+
+
+class ServerEngineTestBase:
+	ENGINE: str
+
+	def setUp(self):
+		self.address = free_address()
+		self.server = _Server(KEY, self.address, engine=self.ENGINE)
+		for name in ('a', 'b', 'c'):
+			self.server.add_client(ClientInfo(name=name, password='pw'))
+		self.server.start()
+		self.clients: List[_Client] = []
+
+	def tearDown(self):
+		for client in self.clients:
+			if client.is_running():
+				client.stop()
+		self.server.stop()
+
+	def connect(self, name: str, password: str = 'pw') -> _Client:
+		client = _Client(KEY, ClientInfo(name=name, password=password), server_address=self.address)
+		self.clients.append(client)
+		client.start()
+		return client
+
+	def wait_online(self, name: str):
+		self.wait_until(self.server.clients[name].is_online, 'Client {} is not online'.format(name))
+
+	def wait_until(self, condition, message: str):
+		for _ in range(250):
+			if condition():
+				return
+			time.sleep(0.02)
+		self.fail(message)
+
+	def test_forward(self):
+		a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+		for name in 'abc':
+			self.wait_online(name)
+		a.broadcast_chat('hello')
+		b.send_chat('c', 'direct')
+		self.assertEqual(('a', 'hello'), b.chats.get(timeout=5))
+		self.assertEqual({('a', 'hello'), ('b', 'direct')}, {c.chats.get(timeout=5), c.chats.get(timeout=5)})
+		self.assertEqual({('a', 'hello'), ('b', 'direct')}, {self.server.chats.get(timeout=5), self.server.chats.get(timeout=5)})
+		self.assertTrue(a.chats.empty())
+
+	def test_wrong_password(self):
+		client = self.connect('a', password='wrong')
+		self.assertFalse(client.is_online())
+		self.assertFalse(self.server.clients['a'].is_online())
+
+	def test_bad_login(self):
+		with socket.create_connection(self.address, timeout=5) as sock:
+			sock.sendall(struct.pack('I', 5) + b'hello')
+			self.assertEqual(b'', sock.recv(1024))
+
+	def test_login_timeout(self):
+		with socket.create_connection(self.address, timeout=5) as sock:
+			start = time.monotonic()
+			self.assertEqual(b'', sock.recv(1024))
+			self.assertLess(time.monotonic() - start, 4)
+		self.assertEqual(1, self.server.login_stats.timed_out)
+
+	def test_login_stats(self):
+		self.connect('a')
+		self.connect('b', password='wrong')
+		with socket.create_connection(self.address, timeout=5) as sock:
+			sock.sendall(struct.pack('I', 5) + b'hello')
+			self.assertEqual(b'', sock.recv(1024))
+		stats = self.server.login_stats
+		self.wait_until(lambda: stats.pending == 0, 'Logins are still pending')
+		self.assertEqual((3, 1, 1, 1, 0), (stats.accepted, stats.logged_in, stats.rejected, stats.malformed, stats.timed_out))
+
+	def test_rate_limit(self):
+		socks = [socket.create_connection(self.address, timeout=5) for _ in range(7)]
+		try:
+			self.assertEqual(b'', socks[-1].recv(1024))
+			self.assertEqual(2, self.server.login_stats.rate_limited)
+			self.assertEqual(5, self.server.login_stats.accepted)
+		finally:
+			for sock in socks:
+				sock.close()
+
+	def test_keep_alive(self):
+		a = self.connect('a')
+		self.wait_online('a')
+		for _ in range(250):
+			if a.ping >= 0:
+				break
+			time.sleep(0.02)
+		self.assertGreaterEqual(a.ping, 0)
+		self.assertTrue(a.is_online())
+		self.assertFalse(any('KeepAlive' in thread.name for thread in threading.enumerate()))
+
+	def test_outbox(self):
+		a = _Client(KEY, ClientInfo(name='a', password='pw'), server_address=self.address)
+		a.set_outbox(Outbox(10, 0))
+		a.broadcast_chat('sent offline')
+		b = self.connect('b')
+		self.wait_online('b')
+		self.clients.append(a)
+		a.start()
+		self.assertEqual(('a', 'sent offline'), b.chats.get(timeout=5))
+		self.assertEqual(0, len(a.get_outbox()))
+
+	def test_offline_queue(self):
+		a = self.connect('a')
+		self.wait_online('a')
+		for i in range(3):
+			a.broadcast_chat(str(i))
+		a.send_chat('b', 'direct')
+		self.wait_until(lambda: len(self.server.get_offline_queue('b') or ()) == 4, 'Packets are not queued')
+		self.assertEqual(3, len(self.server.get_offline_queue('c')))
+		b = self.connect('b')
+		self.assertEqual([('a', '0'), ('a', '1'), ('a', '2'), ('a', 'direct')], [b.chats.get(timeout=5) for _ in range(4)])
+		self.assertEqual(0, len(self.server.get_offline_queue('b')))
+
+	def test_offline_queue_order(self):
+		a = self.connect('a')
+		self.wait_online('a')
+		for i in range(200):
+			a.send_chat('b', str(i))
+		self.wait_until(lambda: len(self.server.get_offline_queue('b') or ()) == 200, 'Packets are not queued')
+		b = _Client(KEY, ClientInfo(name='b', password='pw'), server_address=self.address)
+		self.clients.append(b)
+		b.start()
+		count = 200
+		while not self.server.clients['b'].is_online() or count < 300:  # sent while the queue drains
+			a.send_chat('b', str(count))
+			count += 1
+			time.sleep(0.001)
+		self.assertEqual([('a', str(i)) for i in range(count)], [b.chats.get(timeout=5) for _ in range(count)])
+
+	def test_unsent_packets_kept(self):
+		self.server.send_flush_delay = 60  # packets wait in the outbound queue of the connection
+		a, b = self.connect('a'), self.connect('b')
+		self.wait_online('a')
+		self.wait_online('b')
+		connection = self.server.clients['b']
+		a.send_chat('b', 'unsent')
+		a.send_chat(constants.SERVER_NAME, 'marker')  # processed after the chat is queued for b
+		self.assertEqual([('a', 'unsent'), ('a', 'marker')], [self.server.chats.get(timeout=5) for _ in range(2)])
+		connection.stop()
+		self.assertEqual(1, len(self.server.get_offline_queue('b')))
+		self.server.send_flush_delay = 0
+		self.wait_until(lambda: not b.is_running(), 'Client is not stopped')
+		b.start()
+		self.wait_online('b')
+		a.send_chat('b', 'after')
+		self.assertEqual([('a', 'unsent'), ('a', 'after')], [b.chats.get(timeout=5) for _ in range(2)])
+		self.assertTrue(b.chats.empty())
+
+	def test_unsent_packets_kept_by_client(self):
+		b = self.connect('b')
+		self.wait_online('b')
+		a = _Client(KEY, ClientInfo(name='a', password='pw'), server_address=self.address)
+		a.send_flush_delay = 60
+		self.clients.append(a)
+		a.start()
+		self.wait_online('a')
+		a.send_chat('b', 'unsent')
+		self.wait_until(lambda: a.get_outbound_queue_depth() == 1, 'Packet is not queued')
+		a.send_flush_delay = 0
+		a.restart()
+		self.assertEqual(('a', 'unsent'), b.chats.get(timeout=5))
+		a.send_chat('b', 'after')
+		self.assertEqual(('a', 'after'), b.chats.get(timeout=5))
+		self.assertTrue(b.chats.empty())
+
+	def test_resume_session(self):
+		a = self.connect('a')
+		b = _Client(KEY, ClientInfo(name='b', password='pw'), server_address=self.address)
+		b.KEEP_ALIVE_INTERVAL = 60
+		self.clients.append(b)
+		b.start()
+		self.wait_online('a')
+		self.wait_online('b')
+		connection = self.server.clients['b']
+		self.wait_until(lambda: b.ping >= 0 and connection.ping >= 0, 'Keep-alive is not done')  # so the next frame b receives is the chat
+		a.send_chat('b', 'before')
+		self.assertEqual(('a', 'before'), b.chats.get(timeout=5))
+		session_id = b.get_packet_sequence().session_id
+		self.assertNotEqual('', session_id)
+		b.lost_frame_count = 1
+		a.send_chat('b', 'lost')
+		self.wait_until(lambda: b.lost_frame_count == 0, 'Frame is not received')
+		self.assertEqual(1, b.get_packet_sequence().received_seq)
+		b.restart()
+		self.wait_online('b')
+		self.assertEqual(('a', 'lost'), b.chats.get(timeout=5))  # resent by the server
+		a.send_chat('b', 'after')
+		self.assertEqual(('a', 'after'), b.chats.get(timeout=5))
+		sequence = self.server.clients['b'].get_packet_sequence()
+		self.assertEqual(session_id, sequence.session_id)
+		self.assertEqual(1, sequence.resent_count)
+		self.assertEqual(3, b.get_packet_sequence().received_seq)
+		self.assertTrue(b.chats.empty())
+
+	def test_send_command(self):
+		a, b = self.connect('a'), self.connect('b')
+		self.wait_online('a')
+		self.wait_online('b')
+		reply = a.send_command('b', 'name').result(timeout=5)
+		self.assertTrue(reply.responded)
+		self.assertEqual({'name': 'b'}, reply.result)
+		self.assertEqual(0, a.get_pending_command_count())
+
+	def test_send_command_timeout(self):
+		a, b = self.connect('a'), self.connect('b')
+		self.wait_online('a')
+		self.wait_online('b')
+		future = a.send_command('b', 'ignore', timeout=0.2)
+		with self.assertRaises(futures.TimeoutError):
+			future.result(timeout=5)
+		self.assertEqual(0, a.get_pending_command_count())
+
+	def test_broadcast_command(self):
+		a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+		for name in 'abc':
+			self.wait_online(name)
+		start = time.monotonic()
+		replies = a.broadcast_command('name', timeout=30).result(timeout=5)  # done on the last reply, not on the timeout
+		self.assertLess(time.monotonic() - start, 5)
+		self.assertEqual({'b': {'name': 'b'}, 'c': {'name': 'c'}}, {sender: reply.result for sender, reply in replies.items()})
+
+	def test_broadcast_command_timeout(self):
+		a, b = self.connect('a'), self.connect('b')
+		self.wait_online('a')
+		self.wait_online('b')
+		replies = a.broadcast_command('ignore', timeout=0.2).result(timeout=5)
+		self.assertEqual({}, replies)
+		replies = a.broadcast_command('name').result(timeout=5)  # c is offline, so it's not waited for
+		self.assertEqual(['b'], list(replies.keys()))
+
+	def test_aggregate_command(self):
+		self.server.set_command_aggregation(True, 0.3)
+		a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+		for name in 'abc':
+			self.wait_online(name)
+		replies = a.broadcast_command('name', timeout=30).result(timeout=5)
+		self.assertEqual({'b': {'name': 'b'}, 'c': {'name': 'c'}}, {sender: reply.result for sender, reply in replies.items()})
+		self.assertEqual(2, self.server.get_command_aggregator().merged_count)
+		start = time.monotonic()
+		self.assertEqual({}, a.broadcast_command('ignore', timeout=30).result(timeout=5))  # merged at the deadline of the server
+		self.assertLess(time.monotonic() - start, 5)
+		self.assertEqual(1, self.server.get_command_aggregator().timed_out_count)
+
+	def test_coalesce_command(self):
+		self.server.set_command_coalescing(True)
+		a, b, c = self.connect('a'), self.connect('b'), self.connect('c')
+		for name in 'abc':
+			self.wait_online(name)
+		future_a = a.send_command('b', 'slow', {'from_channel': 1})
+		future_c = c.send_command('b', 'slow', {'from_channel': 2})
+		reply_a, reply_c = future_a.result(timeout=5), future_c.result(timeout=5)
+		self.assertEqual(({'name': 'b'}, {'name': 'b'}), (reply_a.result, reply_c.result))
+		self.assertEqual(({'from_channel': 1}, {'from_channel': 2}), (reply_a.params, reply_c.params))
+		self.assertEqual(1, b.command_count)
+		self.assertEqual((1, 1), (self.server.get_command_coalescer().hit_count, self.server.get_command_coalescer().miss_count))
+
+	def test_stop_client(self):
+		a = self.connect('a')
+		self.wait_online('a')
+		self.server.clients['a'].stop()
+		self.assertFalse(self.server.clients['a'].is_online())
+		for _ in range(1000):
+			if not a.is_running():
+				break
+			time.sleep(0.02)
+		self.assertFalse(a.is_running())
+		a.start()
+		self.wait_online('a')
+
+
+class ThreadEngineTest(ServerEngineTestBase, unittest.TestCase):
+	ENGINE = ServerEngine.thread
+
+	def test_pending_login_limit(self):
+		self.server.MAX_PENDING_LOGINS = 2
+		idle = [socket.create_connection(self.address, timeout=5) for _ in range(2)]
+		stats = self.server.login_stats
+		self.wait_until(lambda: stats.accepted == 2, 'Connections are not accepted')
+		client = self.connect('a')  # queued in the backlog until the idle connections time out
+		self.assertTrue(client.is_online())
+		self.assertEqual((3, 2), (stats.accepted, stats.timed_out))
+		for sock in idle:
+			sock.close()
+
+
+class AsyncioEngineTest(ServerEngineTestBase, unittest.TestCase):
+	ENGINE = ServerEngine.asyncio
+
+	def test_unknown_engine(self):
+		with self.assertRaises(ValueError):
+			ChatBridgeServer(KEY, self.address, engine='unknown')
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,306 @@
+import os
+import unittest
+from typing import List
+
+from chatbridge.core.network.compressor import ZstdStreamCompressor, ZlibStreamCompressor, DecompressedTooLarge
+from chatbridge.core.network.cryptor import AESCryptor
+from chatbridge.core.network.protocol import ProtocolFeature, LoginPacket, LoginResultPacket, ChatBridgePacket, PacketType, \
+	AcknowledgePacket, KeepAlivePayload
+from chatbridge.core.network.sequence import PacketSequence
+from chatbridge.core.network.session import NetworkSession, SharedPacket
+
+MAX_SIZE = 1024 * 1024
+
+
+def create_session(key: str = 'secret', **kwargs) -> NetworkSession:
+	return NetworkSession(AESCryptor(key), max_message_size=MAX_SIZE, **kwargs)
+
+
+def login(client: NetworkSession, server: NetworkSession):
+	login_packet = client.create_login_packet('name', 'password')
+	received_login = LoginPacket.deserialize(server.decode_packet(client.encode_packet(login_packet)))
+	result = server.accept_login(received_login)
+	client.on_login_result(login_packet, LoginResultPacket.deserialize(client.decode_packet(server.encode_packet(result))))
+	server.on_login_result_sent()
+
+
+def chat_packet(message: str) -> ChatBridgePacket:
+	return ChatBridgePacket(sender='a', receivers=[], broadcast=True, type=PacketType.chat, payload={'author': '', 'message': message})
+
+
+def messages(packets: List[ChatBridgePacket]) -> List[str]:
+	return [packet.payload['message'] for packet in packets]
+
+
+class NegotiationTest(unittest.TestCase):
+	def test_new_peers(self):
+		client, server = create_session(), create_session()
+		login(client, server)
+		self.assertEqual(client.features, server.features)
+		self.assertIn(ProtocolFeature.session_cipher, client.features)
+		self.assertNotIn(ProtocolFeature.compress_zlib, client.features)
+		self.assertNotIn(ProtocolFeature.compress_zstd, client.features)
+
+	def test_compression_requires_both_sides(self):
+		for client_compression, server_compression in ((True, False), (False, True)):
+			client, server = create_session(compression=client_compression), create_session(compression=server_compression)
+			login(client, server)
+			self.assertFalse(any(feature.startswith('chatbridge.compress.') for feature in client.features))
+
+	def test_single_compressor(self):
+		client, server = create_session(compression=True), create_session(compression=True)
+		login(client, server)
+		compressors = [feature for feature in client.features if feature.startswith('chatbridge.compress.')]
+		self.assertEqual(1, len(compressors))
+
+	def test_legacy_server(self):
+		"""
+		A server without feature support replies a login result with the message only
+		"""
+		client = create_session()
+		login_packet = client.create_login_packet('name', 'password')
+		client.on_login_result(login_packet, LoginResultPacket.deserialize({'message': 'ok'}))
+		self.assertEqual(frozenset(), client.features)
+		legacy = AESCryptor('secret')
+		self.assertEqual('{"a": 1}', legacy.decrypt(client.seal(b'{"a": 1}')))
+
+	def test_legacy_client(self):
+		"""
+		A client without feature support sends a login packet without features and nonce
+		"""
+		server = create_session()
+		result = server.accept_login(LoginPacket.deserialize({'name': 'name', 'password': 'password'}))
+		server.on_login_result_sent()
+		self.assertEqual([], result.features)
+		legacy = AESCryptor('secret')
+		self.assertEqual(b'{"a": 1}', server.unseal(legacy.encrypt('{"a": 1}')))
+
+	def test_no_key(self):
+		client, server = create_session(''), create_session('')
+		login(client, server)
+		self.assertNotIn(ProtocolFeature.session_cipher, client.features)
+		self.assertEqual(b'data', server.unseal(client.seal(b'data')))
+
+
+class FrameTest(unittest.TestCase):
+	def test_round_trip(self):
+		for compression in (False, True):
+			client, server = create_session(compression=compression), create_session(compression=compression)
+			login(client, server)
+			for i in range(20):
+				packet = chat_packet('message #{} '.format(i) * i)
+				self.assertEqual(packet, server.decode_chatbridge_packet(client.encode_packet(packet)))
+				self.assertEqual(packet, client.decode_chatbridge_packet(server.encode_packet(packet)))
+
+	def test_tampered_frame(self):
+		client, server = create_session(), create_session()
+		login(client, server)
+		frame = bytearray(client.seal(b'hello world'))
+		frame[0] ^= 1
+		with self.assertRaises(ValueError):
+			server.unseal(bytes(frame))
+
+	def test_replayed_frame(self):
+		client, server = create_session(), create_session()
+		login(client, server)
+		frame = client.seal(b'hello world')
+		self.assertEqual(b'hello world', server.unseal(frame))
+		with self.assertRaises(ValueError):
+			server.unseal(frame)
+
+	def test_trailing_nul(self):
+		cryptor = AESCryptor('secret')
+		for data in (b'', b'data\0', b'\0' * 16, b'x' * 15 + b'\0'):
+			self.assertEqual(data, cryptor.decrypt_bytes(cryptor.encrypt_bytes(data)))
+			client, server = create_session(), create_session()
+			login(client, server)
+			self.assertEqual(data, server.unseal(client.seal(data)))
+		with self.assertRaises(ValueError):
+			cryptor.decrypt_bytes(cryptor.get_cryptor().encrypt(b'\0' * 16))  # zero padded as the hex frames
+
+	def test_wrong_key(self):
+		client, server = create_session('key1'), create_session('key2')
+		with self.assertRaises(Exception):
+			login(client, server)
+
+
+class SharedPacketTest(unittest.TestCase):
+	def test_stateless_sessions_share_frame(self):
+		shared = SharedPacket(chat_packet('hello'))
+		sessions = [create_session() for _ in range(3)]
+		frames = [session.encode_packet(shared) for session in sessions]
+		self.assertTrue(all(frame is frames[0] for frame in frames))
+		self.assertEqual(shared.packet, ChatBridgePacket.deserialize(create_session().decode_packet(frames[0])))
+
+	def test_stateful_sessions(self):
+		shared = SharedPacket(chat_packet('hello'))
+		for compression in (False, True):
+			servers = []
+			for _ in range(3):
+				client, server = create_session(compression=compression), create_session(compression=compression)
+				login(client, server)
+				servers.append(server)
+				self.assertEqual(shared.packet, client.decode_chatbridge_packet(server.encode_packet(shared)))
+			self.assertEqual(3, len({server.encode_packet(shared) for server in servers}))
+
+
+class RoutingEnvelopeTest(unittest.TestCase):
+	def setUp(self):
+		self.sender, self.server = create_session(), create_session()
+		login(self.sender, self.server)
+		self.assertTrue(self.server.has_feature(ProtocolFeature.routing_envelope))
+
+	def test_forward_without_decoding(self):
+		packet = chat_packet('hello')
+		received = self.server.decode_chatbridge_packet(self.sender.encode_packet(packet))
+		self.assertEqual('a', received.sender)
+		receiver, receiver_server = create_session(), create_session()
+		login(receiver, receiver_server)
+		self.assertTrue(receiver_server.can_forward(received))
+		frame = receiver_server.encode_packet(SharedPacket(received))
+		self.assertIsNotNone(received._payload_data)  # still not decoded
+		self.assertEqual(packet, receiver.decode_chatbridge_packet(frame))
+
+	def test_forward_to_legacy_peer(self):
+		received = self.server.decode_chatbridge_packet(self.sender.encode_packet(chat_packet('hello')))
+		legacy = create_session()
+		self.assertFalse(legacy.can_forward(received))
+		self.assertEqual(chat_packet('hello'), ChatBridgePacket.deserialize(create_session().decode_packet(legacy.encode_packet(SharedPacket(received)))))
+
+	def test_bad_payload(self):
+		packet = chat_packet('hello')
+		data = bytearray(self.sender.codec.encode_envelope(packet))
+		data[-1] = 0xc1  # never used in msgpack, and an invalid json character
+		received = self.server.decode_chatbridge_packet(self.sender.seal(bytes(data)))
+		self.assertEqual('a', received.sender)
+		with self.assertRaises(ValueError):
+			_ = received.payload
+
+	def test_bad_header(self):
+		for data in (b'', b'\xff\xff\x00\x00', self.sender.codec.encode_envelope(chat_packet('hello'))[:6]):
+			with self.assertRaises(ValueError):
+				self.server.decode_chatbridge_packet(self.sender.seal(data))
+
+	def test_replaced_payload(self):
+		received = self.server.decode_chatbridge_packet(self.sender.encode_packet(chat_packet('hello')))
+		received.payload = {'author': '', 'message': 'changed'}
+		self.assertFalse(self.server.can_forward(received))
+		self.assertEqual(chat_packet('changed'), self.sender.decode_chatbridge_packet(self.server.encode_packet(received)))
+
+
+class SequenceTest(unittest.TestCase):
+	def setUp(self):
+		self.client_sequence, self.server_sequence = PacketSequence(100), PacketSequence(100)
+		self.reconnect()
+
+	def reconnect(self):
+		self.client, self.server = create_session(), create_session()
+		self.client.set_sequence(self.client_sequence)
+		self.server.set_sequence(self.server_sequence)
+		login(self.client, self.server)
+
+	def transfer(self, sender: NetworkSession, receiver: NetworkSession, messages, *, lost: int = 0):
+		"""
+		:param lost: Amount of the last frames lost with the connection
+		"""
+		frames = [sender.encode_packet(chat_packet(message)) for message in messages]
+		return [receiver.decode_chatbridge_packet(frame) for frame in frames[:len(frames) - lost]]
+
+	def test_negotiation(self):
+		self.assertTrue(self.client.has_feature(ProtocolFeature.sequence))
+		self.assertTrue(self.server.has_feature(ProtocolFeature.sequence))
+		self.assertNotEqual('', self.client_sequence.session_id)
+		self.assertEqual(self.client_sequence.session_id, self.server_sequence.session_id)
+		client, server = create_session(), create_session()
+		server.set_sequence(PacketSequence(100))
+		login(client, server)
+		self.assertFalse(server.has_feature(ProtocolFeature.sequence))
+
+	def test_piggybacked_ack(self):
+		self.transfer(self.client, self.server, ['a', 'b'])
+		self.assertEqual(2, self.client_sequence.unacked_count)
+		self.transfer(self.server, self.client, ['c'])
+		self.assertEqual(0, self.client_sequence.unacked_count)
+		keep_alive = ChatBridgePacket(sender='a', receivers=[], broadcast=False, type=PacketType.keep_alive, payload=KeepAlivePayload.ping().serialize())
+		self.server.decode_chatbridge_packet(self.client.encode_packet(keep_alive))
+		self.assertEqual(0, self.server_sequence.unacked_count)
+		self.assertEqual(2, self.server_sequence.received_seq)  # keep-alive packets are not sequenced
+
+	def test_standalone_ack(self):
+		messages = [str(i) for i in range(PacketSequence.ACK_INTERVAL)]
+		for i, message in enumerate(messages):
+			self.transfer(self.client, self.server, [message])
+			self.assertEqual(i == len(messages) - 1, self.server.should_acknowledge())
+		self.assertFalse(self.server.should_acknowledge())  # only once
+		self.assertIsNone(self.client.decode_chatbridge_packet(self.server.encode_packet(AcknowledgePacket())))
+		self.assertEqual(0, self.client_sequence.unacked_count)
+		self.assertEqual(0, self.client_sequence.received_seq)
+
+	def test_resume(self):
+		session_id = self.client_sequence.session_id
+		self.assertEqual(['a', 'b'], messages(self.transfer(self.client, self.server, ['a', 'b', 'c', 'd'], lost=2)))
+		self.transfer(self.server, self.client, ['x', 'y'], lost=1)
+		self.reconnect()
+		self.assertEqual(session_id, self.server_sequence.session_id)
+		self.assertEqual(['c', 'd'], messages(self.client.take_resend_packets()))  # 'a' and 'b' acked by the login
+		self.assertEqual(['y'], messages(self.server.take_resend_packets()))
+		self.assertEqual(['c', 'd', 'e'], messages(self.transfer(self.client, self.server, ['c', 'd', 'e'])))
+		self.assertEqual(5, self.server_sequence.received_seq)
+		self.assertEqual((2, 0), (self.client_sequence.resent_count, self.server_sequence.missed_count))
+
+	def test_duplicates_dropped(self):
+		frames = [self.client.encode_packet(chat_packet(message)) for message in ('a', 'b')]
+		self.assertEqual(2, len([self.server.decode_chatbridge_packet(frame) for frame in frames]))
+		self.client_sequence.resume(self.client_sequence.session_id, 0)  # as if the peer received nothing
+		for message in ('a', 'b', 'c'):
+			received = self.server.decode_chatbridge_packet(self.client.encode_packet(chat_packet(message)))
+			self.assertEqual(message == 'c', received is not None)
+		self.assertEqual(2, self.server_sequence.duplicate_count)
+
+	def test_unknown_session(self):
+		self.transfer(self.client, self.server, ['a', 'b'], lost=1)
+		self.server_sequence = PacketSequence(100)  # e.g. the server restarted
+		self.reconnect()
+		self.assertEqual(['a', 'b'], messages(self.client.take_resend_packets()))
+		self.assertEqual(0, self.client_sequence.received_seq)
+		self.assertEqual(['a', 'b'], messages(self.transfer(self.client, self.server, ['a', 'b'])))
+
+	def test_buffer_overflow(self):
+		self.client_sequence.max_unacked = 2
+		self.transfer(self.client, self.server, ['a', 'b', 'c', 'd'], lost=4)
+		self.reconnect()
+		self.assertEqual(['c', 'd'], messages(self.client.take_resend_packets()))
+		self.transfer(self.client, self.server, ['c', 'd'])
+		self.assertEqual(2, self.server_sequence.missed_count)
+
+	def test_legacy_server(self):
+		self.transfer(self.client, self.server, ['a'], lost=1)
+		client, server = create_session(), create_session()  # the server doesn't support sequencing
+		client.set_sequence(self.client_sequence)
+		login(client, server)
+		self.assertFalse(client.has_feature(ProtocolFeature.sequence))
+		self.assertEqual(['a'], messages(client.take_resend_packets()))
+		self.assertEqual(chat_packet('a'), server.decode_chatbridge_packet(client.encode_packet(chat_packet('a'))))
+
+
+class CompressorTest(unittest.TestCase):
+	def iterate_compressors(self):
+		for compressor_class in (ZstdStreamCompressor, ZlibStreamCompressor):
+			if compressor_class.is_available():
+				yield compressor_class
+
+	def test_stream(self):
+		for compressor_class in self.iterate_compressors():
+			compressor, decompressor = compressor_class(), compressor_class()
+			for data in (b'', b'a', os.urandom(1000), b'x' * 100000, b'abc' * 10):
+				self.assertEqual(data, decompressor.decompress(compressor.compress(data), MAX_SIZE))
+
+	def test_too_large(self):
+		for compressor_class in self.iterate_compressors():
+			compressor, decompressor = compressor_class(), compressor_class()
+			with self.assertRaises(DecompressedTooLarge):
+				decompressor.decompress(compressor.compress(b'\0' * (MAX_SIZE * 64)), MAX_SIZE)
+
+
+if __name__ == '__main__':
+	unittest.main()